@@ -0,0 +1,197 @@
+# encoding: utf-8
+#
+#  fake_twitter.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import re
+import json
+import time
+import base64
+import bisect
+import random
+import urllib
+import urlparse
+import threading
+from collections import deque
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+_STAMP = '%a %b %d %H:%M:%S +0000 %Y'
+_OAUTH_TOKEN = re.compile(r'oauth_token="([^"]*)"')
+
+class Timeline(object):
+    """
+    Synthetic status stream shared by all simulated users.
+    
+    `authors` accounts post `rate` statuses per second in total. Every
+    user follows `follows` authors, `overlap` of them are drawn from a
+    small pool of popular authors shared by everybody, the rest at
+    random. Statuses are generated lazily whenever a timeline is
+    requested and carry their creation time as `[t=...]` in the text,
+    which lets the XMPP side measure the tweet-to-stanza latency.
+    """
+    
+    def __init__(self, authors=1000, rate=50.0, follows=100, overlap=0.5,
+                 keep=300, seed=0):
+        self._authors = authors
+        self._rate = rate
+        self._follows = min(follows, authors)
+        self._overlap = overlap
+        self._random = random.Random(seed)
+        self._popular = range(0, max(1, int(self._follows * overlap)))
+        self._users = {}
+        self._ids = deque()
+        self._statuses = deque(maxlen=max(1000, int(rate * keep)))
+        self._next_id = 1000
+        self._generated = time.time()
+        self._carry = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.served = 0
+    
+    def _following(self, user):
+        # caller holds self._lock
+        if not user in self._users:
+            others = self._random.sample(xrange(len(self._popular), self._authors),
+                                         self._follows - len(self._popular))
+            self._users[user] = set(self._popular + others)
+        return self._users[user]
+    
+    def _generate(self, now):
+        # caller holds self._lock
+        elapsed = now - self._generated
+        count = elapsed * self._rate + self._carry
+        self._carry = count - int(count)
+        for i in range(0, int(count)):
+            stamp = self._generated + elapsed * (i + 1) / int(count)
+            if self._random.random() < self._overlap:
+                author = self._random.choice(self._popular)
+            else:
+                author = self._random.randrange(0, self._authors)
+            self._next_id += 1
+            if len(self._statuses) == self._statuses.maxlen:
+                self._ids.popleft()
+            self._statuses.append((self._next_id, author, stamp))
+            self._ids.append(self._next_id)
+        self._generated = now
+    
+    def _render(self, status):
+        (id_, author, stamp) = status
+        return {'id'         : id_,
+                'text'       : 'Synthetic status {0} [t={1:.6f}]'.format(id_, stamp),
+                'created_at' : time.strftime(_STAMP, time.gmtime(stamp)),
+                'source'     : 'bench',
+                'truncated'  : False,
+                'favorited'  : False,
+                'user'       : {'id'          : author,
+                                'screen_name' : 'author{0}'.format(author),
+                                'name'        : 'Author {0}'.format(author),
+                                'created_at'  : time.strftime(_STAMP, time.gmtime(0)),
+                                'protected'   : False}}
+    
+    def home_timeline(self, user, since_id=None, count=20):
+        with self._lock:
+            self._generate(time.time())
+            following = self._following(user)
+            
+            start = bisect.bisect_right(self._ids, since_id) if since_id else 0
+            res = []
+            for pos in xrange(len(self._statuses) - 1, start - 1, -1):
+                status = self._statuses[pos]
+                if status[1] in following:
+                    res.append(status)
+                    if len(res) >= count:
+                        break
+            
+            self.requests += 1
+            self.served += len(res)
+        return [self._render(x) for x in res]
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, *args):
+        pass
+    
+    def _user(self):
+        auth = self.headers.get('Authorization', '')
+        if auth.startswith('Basic '):
+            return base64.b64decode(auth[6:]).split(':', 1)[0]
+        if auth.startswith('OAuth '):
+            token = _OAUTH_TOKEN.search(auth)
+            if token:
+                return urllib.unquote(token.group(1))
+        return self.client_address[0]
+    
+    def _reply(self, status, payload):
+        body = json.dumps(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Remaining', '350')
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path.endswith('/statuses/home_timeline.json'):
+            since_id = int(query['since_id']) if 'since_id' in query else None
+            count = int(query.get('count', 20))
+            self._reply(200, self.server.timeline.home_timeline(self._user(), since_id, count))
+        elif url.path.endswith('/account/verify_credentials.json'):
+            self._reply(200, {'id' : 1, 'screen_name' : self._user(), 'name' : self._user()})
+        else:
+            self._reply(404, {'error' : 'Not found'})
+    
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self._reply(200, {'id' : 1})
+
+class FakeTwitter(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the Twitter REST API serving a :class:`Timeline`.
+    
+    Users are told apart by their basic auth user name.
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self, timeline, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.timeline = timeline
+    
+    @property
+    def port(self):
+        return self.server_address[1]
+    
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-twitter')
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,152 @@
+# encoding: utf-8
+#
+#  fake_xmpp.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import re
+import time
+import socket
+import hashlib
+import threading
+from xml.parsers import expat
+
+_STAMP = re.compile(r'\[t=([0-9.]+)\]')
+
+class FakeXMPPServer(object):
+    """
+    Minimal XMPP server accepting a single component connection.
+    
+    It answers the XEP-0114 handshake, lets the driver inject stanzas
+    with :meth:`inject` and otherwise drains everything the component
+    sends. Groupchat messages carrying a `[t=...]` creation stamp are
+    used to collect tweet-to-stanza latencies.
+    """
+    
+    def __init__(self, secret='secret', port=0):
+        self._secret = secret
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('127.0.0.1', port))
+        self._listener.listen(1)
+        self._conn = None
+        self._lock = threading.Lock()
+        self.connected = threading.Event()
+        self.counts = {}
+        self.latencies = []
+        self.bytes = 0
+    
+    @property
+    def port(self):
+        return self._listener.getsockname()[1]
+    
+    def start(self):
+        thread = threading.Thread(target=self._run, name='fake-xmpp')
+        thread.daemon = True
+        thread.start()
+    
+    def inject(self, data):
+        with self._lock:
+            self._conn.sendall(data.encode('utf-8') if isinstance(data, unicode) else data)
+    
+    def snapshot(self):
+        """
+        :returns: `(counts, latencies)` received so far
+        """
+        with self._lock:
+            return (dict(self.counts), list(self.latencies))
+    
+    def _run(self):
+        (self._conn, addr) = self._listener.accept()
+        state = {'depth' : 0, 'stanza' : None, 'body' : None, 'text' : []}
+        
+        def _start(name, attrs):
+            state['depth'] += 1
+            if state['depth'] == 1:
+                # stream header
+                with self._lock:
+                    self._stream_id = str(time.time())
+                    self._conn.sendall("<?xml version='1.0'?><stream:stream "
+                                       "xmlns:stream='http://etherx.jabber.org/streams' "
+                                       "xmlns='jabber:component:accept' from='{0}' id='{1}'>"
+                                       .format(attrs.get('to', ''), self._stream_id))
+            elif state['depth'] == 2:
+                state['stanza'] = (name.split(' ')[-1], attrs)
+                state['body'] = None
+            if name.endswith(' body') or name == 'body':
+                state['text'] = []
+        
+        def _end(name):
+            if name.endswith(' body') or name == 'body':
+                state['body'] = u''.join(state['text'])
+            
+            if state['depth'] == 2:
+                self._stanza(state['stanza'][0], state['stanza'][1], state['body'],
+                             u''.join(state['text']))
+            state['depth'] -= 1
+        
+        def _data(data):
+            state['text'].append(data)
+        
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.StartElementHandler = _start
+        parser.EndElementHandler = _end
+        parser.CharacterDataHandler = _data
+        
+        while True:
+            data = self._conn.recv(65536)
+            if not data:
+                break
+            self.bytes += len(data)
+            try:
+                parser.Parse(data, False)
+            except expat.ExpatError, e:
+                print 'Fake XMPP server: broken stream: {0}'.format(e)
+                break
+    
+    def _stanza(self, name, attrs, body, text):
+        now = time.time()
+        if name == 'handshake':
+            expected = hashlib.sha1(self._stream_id + self._secret).hexdigest()
+            if text.strip() != expected:
+                print 'Fake XMPP server: handshake mismatch'
+            with self._lock:
+                self._conn.sendall('<handshake/>')
+            self.connected.set()
+            return
+        
+        kind = name
+        if name == 'message':
+            kind = 'message.{0}'.format(attrs.get('type', 'normal'))
+        elif name == 'presence':
+            kind = 'presence.{0}'.format(attrs.get('type', 'available'))
+        
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            if body:
+                match = _STAMP.search(body)
+                if match:
+                    self.latencies.append(now - float(match.group(1)))
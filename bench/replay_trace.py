@@ -0,0 +1,227 @@
+# encoding: utf-8
+#
+#  replay_trace.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Replays a trace recorded with `trace: yes` through a Satori Core.
+
+The recorded presences and messages are injected through the fake XMPP
+server, the recorded timeline polls are served by the fake Twitter API
+in the order they were recorded. With `--speed 1` events are replayed
+at their original pace, `--speed 0` replays them as fast as possible
+(every poll is answered with the next recorded response, so
+`--poll-interval` decides the pace). Latencies are measured from the
+moment a response is served, so they cover Satori itself but not the
+recorded poll delays. Results use the format of run_bench.py.
+
+    python bench/replay_trace.py --speed 0 spool/trace-20101010-101010.json.gz
+"""
+
+import os
+import gzip
+import json
+import time
+import struct
+import tempfile
+import threading
+from collections import deque
+from optparse import OptionParser
+from xml.sax.saxutils import escape, quoteattr
+
+from fake_twitter import FakeTwitter, _STAMP
+from fake_xmpp import FakeXMPPServer
+import run_bench
+
+class TraceTimeline(object):
+    """
+    Serves the recorded timeline polls of every user in order.
+    """
+    
+    def __init__(self, polls, speed=1.0):
+        self._polls = polls
+        self._speed = speed
+        self._started = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.served = 0
+    
+    def start(self):
+        self._started = time.time()
+    
+    def pending(self):
+        with self._lock:
+            return sum([len(x) for x in self._polls.values()])
+    
+    def _render(self, status, stamp):
+        (id_, author, created_at, length) = status
+        return {'id'         : id_,
+                'text'       : 'x' * max(0, length - 32) + ' [t={0:.6f}]'.format(stamp),
+                'created_at' : time.strftime(_STAMP, time.gmtime(created_at)),
+                'source'     : 'replay',
+                'truncated'  : False,
+                'favorited'  : False,
+                'user'       : {'id'          : int(author, 16),
+                                'screen_name' : 'a{0}'.format(author),
+                                'name'        : 'Author {0}'.format(author),
+                                'created_at'  : time.strftime(_STAMP, time.gmtime(0)),
+                                'protected'   : False}}
+    
+    def home_timeline(self, user, since_id=None, count=20):
+        now = time.time()
+        with self._lock:
+            queue = self._polls.get(user, deque())
+            batches = []
+            if not self._speed:
+                if queue:
+                    batches.append(queue.popleft()[1])
+            elif self._started:
+                elapsed = (now - self._started) * self._speed
+                while queue and queue[0][0] <= elapsed:
+                    batches.append(queue.popleft()[1])
+            
+            statuses = dict([(x[0], x) for batch in batches for x in batch
+                             if not since_id or x[0] > since_id])
+            self.requests += 1
+            self.served += len(statuses)
+        return [self._render(statuses[x], now) for x in sorted(statuses, reverse=True)]
+
+def load(path):
+    events = []
+    polls = {}
+    try:
+        with gzip.open(path, 'rb') as trace:
+            for line in trace:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line was cut short
+                    break
+                if entry['k'] == 'tl':
+                    polls.setdefault('u' + entry['u'], deque()).append((entry['t'], entry['s']))
+                elif entry['k'] in ('p', 'm'):
+                    events.append(entry)
+    except (IOError, EOFError, struct.error), e:
+        # the recorder was killed before closing the file
+        print 'Trace is truncated ({0}), replaying what was read'.format(e)
+    events.sort(key=lambda x: x['t'])
+    return (events, polls)
+
+def _room(event, name):
+    # version 1 traces did not record the room
+    room = event['o'] if event.get('o') else name
+    return u'{0}@satori.bench'.format(room)
+
+def inject(xmpp, event):
+    name = 'u' + event['u']
+    room = _room(event, name)
+    if event['k'] == 'm':
+        xmpp.inject(u"<message type='groupchat' from='{0}@bench.local/bench' "
+                    u"to='{1}'><body>{2}</body></message>".format(name, room, escape(event['b'])))
+        return
+    
+    room = u'{0}/{1}'.format(room, 'n' + event['n'] if event.get('n') else name)
+    if event['y'] == 'unavailable':
+        run_bench.leave(xmpp, name, 'r' + event['r'], room)
+    else:
+        history = ''
+        if event.get('h'):
+            history = '<history {0}/>'.format(' '.join(['{0}={1}'.format(k, quoteattr(v))
+                                                         for (k, v) in event['h'].items()]))
+        run_bench.join(xmpp, name, 'r' + event['r'], history, room)
+
+def main():
+    parser = OptionParser(usage='%prog [options] trace')
+    parser.add_option('--speed', type='float', default=1.0, help='replay speed, 0 for as fast as possible')
+    parser.add_option('--poll-interval', type='int', default=None)
+    parser.add_option('--drain', type='float', default=60, help='seconds to wait for pending polls')
+    parser.add_option('--engine', default='threaded')
+    parser.add_option('--workers', type='int', default=8)
+    parser.add_option('--output', default=None)
+    parser.add_option('--keep', action='store_true', default=False, help='keep the spool directory')
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected exactly one trace file')
+    
+    (events, polls) = load(args[0])
+    names = sorted(set(['u' + x['u'] for x in events] + polls.keys()))
+    print 'Replaying {0} events and {1} polls of {2} users'.format(
+            len(events), sum([len(x) for x in polls.values()]), len(names))
+    
+    timeline = TraceTimeline(polls, opts.speed)
+    api = FakeTwitter(timeline)
+    api.start()
+    xmpp = FakeXMPPServer()
+    xmpp.start()
+    
+    spool = tempfile.mkdtemp(prefix='satori-replay-')
+    poll_interval = opts.poll_interval or (60 if opts.speed else 1)
+    run_bench.write_config(spool, xmpp.port, api.port, poll_interval, opts.engine, opts.workers)
+    run_bench.prepare(spool, names)
+    
+    (satori, log) = run_bench.start_satori(spool)
+    try:
+        if not xmpp.connected.wait(30) and not xmpp.connected.is_set():
+            raise RuntimeError('Satori did not connect, see {0}'.format(log.name))
+        
+        (cpu_start, rss_max) = run_bench.process_stats(satori.pid)
+        metrics_start = run_bench.read_metrics(spool)
+        start = time.time()
+        timeline.start()
+        
+        for event in events:
+            if opts.speed:
+                delay = start + event['t'] / opts.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            inject(xmpp, event)
+        
+        drained = time.time()
+        while timeline.pending() and time.time() - drained < opts.drain:
+            time.sleep(1)
+            if satori.poll() is not None:
+                raise RuntimeError('Satori exited, see {0}'.format(log.name))
+            rss_max = max(rss_max, run_bench.process_stats(satori.pid)[1])
+        
+        # give the last metrics dump a chance
+        time.sleep(2)
+        elapsed = time.time() - start
+        (cpu_end, rss) = run_bench.process_stats(satori.pid)
+        (counts, latencies) = xmpp.snapshot()
+        metrics_end = run_bench.read_metrics(spool)
+    finally:
+        run_bench.stop_satori(satori, log)
+    
+    results = run_bench.summarize(opts, elapsed, (cpu_start, cpu_end), max(rss_max, rss),
+                                  (metrics_start, metrics_end), ({}, counts),
+                                  latencies, timeline.requests)
+    results['trace'] = os.path.abspath(args[0])
+    results['unserved_polls'] = timeline.pending()
+    run_bench.write_results(results, opts.output, spool, opts.keep)
+
+if __name__ == '__main__':
+    main()
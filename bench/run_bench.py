@@ -0,0 +1,266 @@
+# encoding: utf-8
+#
+#  run_bench.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Offline throughput benchmark for Satori.
+
+Starts a fake Twitter API and a fake XMPP server, runs a Satori Core
+against them in a child process, joins `--users` simulated users and
+reports polls/sec, statuses delivered/sec, tweet-to-stanza latency
+percentiles, CPU and RSS of the Satori process. Results are written
+as JSON to `--output` (default `bench/results/<version>-<time>.json`).
+
+    python bench/run_bench.py --users 200 --duration 120
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_ROOT_DIR = os.path.dirname(_BENCH_DIR)
+sys.path.insert(0, _ROOT_DIR)
+
+from fake_twitter import Timeline, FakeTwitter
+from fake_xmpp import FakeXMPPServer
+
+_CONFIG = """--- !<tag:www.bitspin.org,2010:satori-mb/core>
+settings:
+    jid           : satori.bench
+    pid           : {spool}/satori-mb.pid
+    spoolDir      : {spool}
+    mainServer    : 127.0.0.1
+    mainServerJid : bench.local
+    port          : {xmpp_port}
+    secret        : secret
+    pollInterval  : {poll_interval}
+    engine        : {engine}
+    workerThreads : {workers}
+    metricsInterval : 1
+    snapshot      : no
+    archive       : no
+    watchdogThreshold : 0
+
+services:
+    - tag         : bench
+      type        : twitter_BasicAuth
+      useHttps    : no
+      apiHost     : 127.0.0.1:{api_port}
+      apiRoot     : /1
+"""
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def process_stats(pid):
+    # linux only: (cpu seconds, rss in kB)
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+        with open('/proc/{0}/status'.format(pid)) as status:
+            rss = [int(x.split()[1]) for x in status if x.startswith('VmRSS:')][0]
+        return (cpu, rss)
+    except (IOError, IndexError), e:
+        return (None, None)
+
+def version():
+    try:
+        return subprocess.Popen(['git', 'describe', '--always', '--dirty'], cwd=_ROOT_DIR,
+                                stdout=subprocess.PIPE).communicate()[0].strip() or 'unknown'
+    except OSError, e:
+        return 'unknown'
+
+def write_config(spool, xmpp_port, api_port, poll_interval, engine, workers):
+    path = os.path.join(spool, 'satori-mb.conf')
+    with open(path, 'w') as conf:
+        conf.write(_CONFIG.format(spool=spool, xmpp_port=xmpp_port, api_port=api_port,
+                                  poll_interval=poll_interval, engine=engine,
+                                  workers=workers))
+    return path
+
+def prepare(spool, names):
+    # the Satori config is read from sys.argv, hide our own options
+    sys.argv = [sys.argv[0], '-c', os.path.join(spool, 'satori-mb.conf')]
+    from satori.config import Config
+    from satori.book_keeper import BookKeeper
+    
+    config = Config.get().core
+    book_keeper = BookKeeper(os.path.join(spool, 'bookkeeper.db'))
+    book_keeper.reflect_services(config)
+    for name in names:
+        jid = '{0}@bench.local'.format(name)
+        book_keeper.user(jid, create=True)
+        account = book_keeper.account(jid, 'bench', create=True)[0]
+        account.auth_key = name
+        account.auth_secret = 'secret'
+        book_keeper.commit(account)
+    book_keeper.close()
+
+def join(xmpp, name, resource='bench', history='', room=None):
+    room = room or '{0}@satori.bench/{0}'.format(name)
+    xmpp.inject("<presence from='{0}@bench.local/{1}' to='{3}'>"
+                "<x xmlns='http://jabber.org/protocol/muc'>{2}</x></presence>".format(name, resource, history, room))
+
+def leave(xmpp, name, resource='bench', room=None):
+    room = room or '{0}@satori.bench/{0}'.format(name)
+    xmpp.inject("<presence type='unavailable' from='{0}@bench.local/{1}' "
+                "to='{2}'/>".format(name, resource, room))
+
+def start_satori(spool):
+    log = open(os.path.join(spool, 'satori.log'), 'w')
+    satori = subprocess.Popen([sys.executable, '-c', 'from satori.core import Core; Core().run()',
+                               '-c', os.path.join(spool, 'satori-mb.conf')],
+                              cwd=_ROOT_DIR, stdout=log, stderr=subprocess.STDOUT)
+    return (satori, log)
+
+def stop_satori(satori, log):
+    if satori.poll() is None:
+        satori.send_signal(signal.SIGTERM)
+        time.sleep(1)
+        if satori.poll() is None:
+            satori.kill()
+    log.close()
+
+def read_metrics(spool):
+    try:
+        with open(os.path.join(spool, 'metrics.json')) as metrics:
+            counters = json.load(metrics)['counters']
+        return dict([(k, v['value']) for (k, v) in counters.items()])
+    except (IOError, ValueError, KeyError), e:
+        return {}
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--users', type='int', default=100)
+    parser.add_option('--duration', type='float', default=60, help='measured seconds')
+    parser.add_option('--warmup', type='float', default=15, help='seconds before measuring')
+    parser.add_option('--rate', type='float', default=50, help='statuses/sec over all authors')
+    parser.add_option('--authors', type='int', default=1000)
+    parser.add_option('--follows', type='int', default=100, help='authors followed per user')
+    parser.add_option('--overlap', type='float', default=0.5, help='share of popular authors')
+    parser.add_option('--poll-interval', type='int', default=15)
+    parser.add_option('--engine', default='threaded')
+    parser.add_option('--workers', type='int', default=8)
+    parser.add_option('--output', default=None)
+    parser.add_option('--keep', action='store_true', default=False, help='keep the spool directory')
+    (opts, args) = parser.parse_args()
+    
+    timeline = Timeline(opts.authors, opts.rate, opts.follows, opts.overlap)
+    api = FakeTwitter(timeline)
+    api.start()
+    xmpp = FakeXMPPServer()
+    xmpp.start()
+    
+    spool = tempfile.mkdtemp(prefix='satori-bench-')
+    write_config(spool, xmpp.port, api.port, opts.poll_interval, opts.engine, opts.workers)
+    names = ['bench{0}'.format(i) for i in range(0, opts.users)]
+    prepare(spool, names)
+    
+    (satori, log) = start_satori(spool)
+    try:
+        if not xmpp.connected.wait(30) and not xmpp.connected.is_set():
+            raise RuntimeError('Satori did not connect, see {0}'.format(log.name))
+        for name in names:
+            join(xmpp, name)
+        time.sleep(opts.warmup)
+        
+        (cpu_start, rss) = process_stats(satori.pid)
+        (counts_start, latencies_start) = xmpp.snapshot()
+        metrics_start = read_metrics(spool)
+        start = time.time()
+        rss_max = rss
+        while time.time() - start < opts.duration:
+            time.sleep(1)
+            if satori.poll() is not None:
+                raise RuntimeError('Satori exited, see {0}'.format(log.name))
+            rss_max = max(rss_max, process_stats(satori.pid)[1])
+        
+        elapsed = time.time() - start
+        (cpu_end, rss) = process_stats(satori.pid)
+        (counts_end, latencies_end) = xmpp.snapshot()
+        metrics_end = read_metrics(spool)
+    finally:
+        stop_satori(satori, log)
+    
+    results = summarize(opts, elapsed, (cpu_start, cpu_end), rss_max,
+                        (metrics_start, metrics_end), (counts_start, counts_end),
+                        latencies_end[len(latencies_start):], timeline.requests)
+    write_results(results, opts.output, spool, opts.keep)
+
+def summarize(opts, elapsed, cpu, rss_max, metrics, counts, latencies, api_requests):
+    def _rate(key):
+        return round((metrics[1].get(key, 0) - metrics[0].get(key, 0)) / elapsed, 3)
+    
+    return {'version'    : version(),
+            'time'       : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'parameters' : vars(opts),
+            'elapsed'    : round(elapsed, 3),
+            'polls_per_sec'      : _rate('polls.bench'),
+            'api_errors_per_sec' : _rate('api.errors.bench'),
+            'delivered_per_sec'  : _rate('statuses.delivered'),
+            'stanzas_per_sec'    : round((sum(counts[1].values()) - sum(counts[0].values())) / elapsed, 3),
+            'latency_ms'         : dict([(name, round(percentile(latencies, x) * 1000, 1)
+                                                if latencies else None)
+                                         for (name, x) in (('p50', 0.5), ('p90', 0.9),
+                                                           ('p99', 0.99), ('max', 1.0))]),
+            'cpu_percent'  : round(100 * (cpu[1] - cpu[0]) / elapsed, 1)
+                             if cpu[0] is not None and cpu[1] is not None else None,
+            'rss_max_kb'   : rss_max,
+            'stanzas'      : counts[1],
+            'api_requests' : api_requests}
+
+def write_results(results, output, spool, keep=False):
+    output = output or os.path.join(_BENCH_DIR, 'results',
+                                    '{0}-{1}.json'.format(results['version'],
+                                                          time.strftime('%Y%m%d-%H%M%S')))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as out:
+        json.dump(results, out, indent=1, sort_keys=True)
+    
+    if keep:
+        print 'Spool kept in {0}'.format(spool)
+    else:
+        shutil.rmtree(spool, True)
+    
+    print json.dumps(results, indent=1, sort_keys=True)
+    print 'Results written to {0}'.format(output)
+
+if __name__ == '__main__':
+    main()
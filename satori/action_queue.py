@@ -0,0 +1,190 @@
+# encoding: utf-8
+#
+#  action_queue.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import threading
+from collections import deque
+
+class TokenBucket(object):
+    """
+    Classic token bucket, `rate` tokens per second up to `burst` tokens.
+    """
+    
+    def __init__(self, rate, burst):
+        self._rate = float(rate)
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._stamp = time.time()
+    
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+    
+    def wait(self, now=None):
+        """
+        :returns: seconds until a token is available (0 if there is one)
+        """
+        now = now or time.time()
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        if not self._rate:
+            return None
+        return (1 - self._tokens) / self._rate
+    
+    def take(self, now=None):
+        """
+        Take a token if one is available.
+        
+        :returns: True if a token was taken
+        """
+        if self.wait(now) != 0:
+            return False
+        self._tokens -= 1
+        return True
+
+class Action(object):
+    """
+    A single outbound request (update, reply, favor, ...) of one account.
+    """
+    __slots__ = ('action', 'status_id', 'nick', 'message', 'room', 'attempts', 'due', 'queued')
+    
+    def __init__(self, action, status_id, nick, message, room=None):
+        self.action = action
+        self.status_id = status_id
+        self.nick = nick
+        self.message = message
+        self.room = room
+        self.attempts = 0
+        self.due = 0
+        self.queued = time.time()
+    
+    def __repr__(self):
+        return '<Action({0}, status_id={1}, attempts={2})>'.format(self.action, self.status_id,
+                                                                   self.attempts)
+
+class ActionQueue(object):
+    """
+    Ordered queue of the outbound actions of one account.
+    
+    Only the head of the queue is ever handed out by :meth:`next` and it
+    stays there until :meth:`done` is called, so actions are performed
+    strictly in the order they were queued - a retried action holds back
+    everything queued after it. :meth:`next` also takes a token from the
+    account's :class:`TokenBucket`, `rate` is given in actions per hour.
+    """
+    
+    def __init__(self, rate=40, burst=5, retries=3, backoff=5.0, size=20):
+        self._bucket = TokenBucket(rate / 3600.0, burst)
+        self._retries = retries
+        self._backoff = backoff
+        self._size = size
+        self._actions = deque()
+        self._busy = False
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._actions)
+    
+    @property
+    def busy(self):
+        """True while the head action is being performed."""
+        with self._lock:
+            return self._busy
+    
+    def put(self, action, status_id, nick, message, room=None):
+        """
+        Append a new action.
+        
+        :param room: the search room the action was requested from (if any)
+        :returns: the queued :class:`Action` or None if the queue is full
+        """
+        with self._lock:
+            if self._size and len(self._actions) >= self._size:
+                return None
+            entry = Action(action, status_id, nick, message, room)
+            self._actions.append(entry)
+            return entry
+    
+    def next(self, now=None):
+        """
+        :returns: the head action if it is due and the rate limit allows
+                  it, None otherwise
+        """
+        now = now or time.time()
+        with self._lock:
+            if self._busy or not self._actions or self._actions[0].due > now:
+                return None
+            if not self._bucket.take(now):
+                return None
+            self._busy = True
+            head = self._actions[0]
+            head.attempts += 1
+            return head
+    
+    def done(self):
+        """
+        Remove the head action (performed or given up on).
+        """
+        with self._lock:
+            self._busy = False
+            if self._actions:
+                self._actions.popleft()
+    
+    def retry(self, now=None):
+        """
+        Back off the head action after a transient error.
+        
+        :returns: False if it ran out of retries, the caller is expected
+                  to give up on it with :meth:`done` then
+        """
+        now = now or time.time()
+        with self._lock:
+            self._busy = False
+            if not self._actions:
+                return False
+            head = self._actions[0]
+            if head.attempts > self._retries:
+                return False
+            head.due = now + self._backoff * 2 ** (head.attempts - 1)
+            return True
+    
+    def clear(self):
+        """
+        Drop all actions not yet handed out.
+        
+        :returns: the number of dropped actions
+        """
+        with self._lock:
+            keep = 1 if self._busy and self._actions else 0
+            dropped = len(self._actions) - keep
+            while len(self._actions) > keep:
+                self._actions.pop()
+            return dropped
@@ -0,0 +1,394 @@
+# encoding: utf-8
+#
+#  archive.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import mmap
+import time
+import array
+import struct
+import bisect
+import calendar
+import datetime
+import threading
+
+from status_cache import CachedStatus
+
+# record header: type, status id, stamp (unix time), account, payload length
+# the stamp is created_at for status records and the write time for deliveries
+_RECORD = struct.Struct('<BQIII')
+_STATUS = 1
+_DELIVERY = 2
+
+# sealed index: id and delivery counts, the id entries sorted by status id,
+# then the delivery entries by account in delivery (= write time) order
+_IDX_HEADER = struct.Struct('<II')
+_IDX_ID = struct.Struct('<QI')          # status id, offset
+_IDX_DELIVERY = struct.Struct('<IIQ')   # account, write stamp, status id
+
+_NO_DELIVERIES = (array.array('L'), array.array('I'))
+
+def _stamp(created_at):
+    return calendar.timegm(created_at.utctimetuple())
+
+class _Segment(object):
+    """
+    One append-only data file plus its indexes.
+    
+    Statuses are indexed by id, deliveries per account by write time
+    (their order of delivery). The active segment keeps both indexes in
+    memory, sealed segments store them in a sidecar `.idx` file and serve
+    status reads from memory maps.
+    """
+    
+    def __init__(self, path, created):
+        self.path = path
+        self.created = created
+        self.size = 0
+        self.first_stamp = None
+        self.last_stamp = None
+        self._ids = []          # sorted [(status id, offset)] (active segment only)
+        self._deliveries = {}   # account -> (status ids, write stamps)
+        self._data = None
+        self._index = None
+        self._count = 0
+        self._file = None
+        self._reader = None
+    
+    def _track(self, rtype, status_id, stamp, account):
+        if rtype == _DELIVERY:
+            if not account in self._deliveries:
+                self._deliveries[account] = (array.array('L'), array.array('I'))
+            (ids, stamps) = self._deliveries[account]
+            ids.append(status_id)
+            stamps.append(stamp)
+        self.first_stamp = min(self.first_stamp or stamp, stamp)
+        self.last_stamp = max(self.last_stamp or stamp, stamp)
+    
+    def _scan(self, buf):
+        # yields (offset, header) of every complete record in `buf`
+        offset = 0
+        while offset + _RECORD.size <= len(buf):
+            header = _RECORD.unpack_from(buf, offset)
+            if offset + _RECORD.size + header[4] > len(buf):
+                break
+            yield (offset, header)
+            offset += _RECORD.size + header[4]
+    
+    # --- writing (active segment, caller holds the archive lock)
+    
+    def open(self):
+        self._file = open(self.path, 'ab')
+        self._reader = open(self.path, 'rb')
+        self.size = self._file.tell()
+    
+    def append(self, rtype, status_id, stamp, account, payload=''):
+        offset = self.size
+        self._file.write(_RECORD.pack(rtype, status_id, stamp, account, len(payload)) + payload)
+        self.size += _RECORD.size + len(payload)
+        if rtype == _STATUS:
+            bisect.insort(self._ids, (status_id, offset))
+        self._track(rtype, status_id, stamp, account)
+    
+    def flush(self):
+        if self._file:
+            self._file.flush()
+    
+    def seal(self):
+        for f in [self._file, self._reader]:
+            if f:
+                f.close()
+        (self._file, self._reader) = (None, None)
+        deliveries = [_IDX_DELIVERY.pack(account, stamps[i], ids[i])
+                      for (account, (ids, stamps)) in sorted(self._deliveries.items())
+                      for i in xrange(len(ids))]
+        with open(self.path + '.idx', 'wb') as idx:
+            idx.write(_IDX_HEADER.pack(len(self._ids), len(deliveries)))
+            idx.write(''.join([_IDX_ID.pack(*x) for x in self._ids]))
+            idx.write(''.join(deliveries))
+        self._ids = []
+        # the delivery index is in memory already
+        self.load(deliveries=False)
+    
+    def rebuild(self):
+        # recover the in-memory indexes of an unsealed segment after a restart
+        with open(self.path, 'rb') as data:
+            buf = data.read()
+        end = 0
+        for (offset, (rtype, status_id, stamp, account, length)) in self._scan(buf):
+            if rtype == _STATUS:
+                self._ids.append((status_id, offset))
+            self._track(rtype, status_id, stamp, account)
+            end = offset + _RECORD.size + length
+        self._ids.sort()
+        if end != len(buf):
+            # drop a torn record left by a crash
+            with open(self.path, 'r+b') as data:
+                data.truncate(end)
+    
+    # --- reading
+    
+    def load(self, deliveries=True):
+        """
+        Open a sealed segment.
+        
+        :raises ValueError: if the `.idx` file is damaged or outdated
+        """
+        with open(self.path, 'rb') as data:
+            self.size = os.fstat(data.fileno()).st_size
+            self._data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) if self.size else ''
+        with open(self.path + '.idx', 'rb') as idx:
+            self._index = mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ) \
+                              if os.fstat(idx.fileno()).st_size else ''
+        
+        if len(self._index) < _IDX_HEADER.size:
+            raise ValueError('truncated index {0}.idx'.format(self.path))
+        (self._count, count) = _IDX_HEADER.unpack_from(self._index, 0)
+        start = _IDX_HEADER.size + self._count * _IDX_ID.size
+        if len(self._index) != start + count * _IDX_DELIVERY.size:
+            raise ValueError('index {0}.idx does not match its header'.format(self.path))
+        
+        if deliveries:
+            for i in xrange(count):
+                (account, stamp, status_id) = _IDX_DELIVERY.unpack_from(self._index,
+                                                                        start + i * _IDX_DELIVERY.size)
+                self._track(_DELIVERY, status_id, stamp, account)
+    
+    def close(self):
+        for f in [self._file, self._reader]:
+            if f:
+                f.close()
+        for m in [self._data, self._index]:
+            if isinstance(m, mmap.mmap):
+                m.close()
+    
+    def _id_entry(self, i):
+        return _IDX_ID.unpack_from(self._index, _IDX_HEADER.size + i * _IDX_ID.size)
+    
+    def _read(self, offset):
+        if self._data is None:
+            # active segment, the writer flushes after every append()
+            self._reader.seek(offset)
+            header = _RECORD.unpack(self._reader.read(_RECORD.size))
+            return (header, self._reader.read(header[4]))
+        header = _RECORD.unpack_from(self._data, offset)
+        start = offset + _RECORD.size
+        return (header, self._data[start:start + header[4]])
+    
+    def find(self, status_id):
+        """
+        :returns: the payload of status `status_id` or None
+        """
+        if self._index is None:
+            i = bisect.bisect_left(self._ids, (status_id, 0))
+            if i < len(self._ids) and self._ids[i][0] == status_id:
+                return self._read(self._ids[i][1])
+            return None
+        
+        (lo, hi) = (0, self._count)
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self._id_entry(mid)[0] < status_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._id_entry(lo)[0] == status_id:
+            return self._read(self._id_entry(lo)[1])
+        return None
+    
+    def deliveries(self, account):
+        """
+        :returns: `(status ids, write stamps)` delivered to `account`, in
+                  delivery order
+        """
+        return self._deliveries.get(account, _NO_DELIVERIES)
+
+class TimelineArchive(object):
+    """
+    Append-only on-disk archive of rendered statuses for one service.
+    
+    Every status is stored once (with its rendered body) together with a
+    small delivery record per account, so a room's history can be replayed
+    from disk. Segments rotate after `segment_size` bytes or `segment_age`
+    seconds and are removed once older than `retention` seconds or when
+    the archive exceeds `max_size` bytes.
+    """
+    
+    _archives = {}
+    _archives_lock = threading.Lock()
+    
+    @classmethod
+    def shared(cls, spool, tag, **kwargs):
+        with cls._archives_lock:
+            if not tag in cls._archives:
+                path = os.path.join(spool, 'archive', tag.replace(os.sep, '_'))
+                cls._archives[tag] = TimelineArchive(path, tag, **kwargs)
+            return cls._archives[tag]
+    
+    @classmethod
+    def close_all(cls):
+        with cls._archives_lock:
+            for archive in cls._archives.values():
+                archive.close()
+            cls._archives = {}
+    
+    def __init__(self, path, tag, segment_size=16 << 20, segment_age=86400,
+                 retention=7 * 86400, max_size=1 << 30):
+        self._path = path
+        self._tag = tag
+        self._segment_size = segment_size
+        self._segment_age = segment_age
+        self._retention = retention
+        self._max_size = max_size
+        self._lock = threading.RLock()
+        self._segments = []
+        self._sequence = 0
+        self._seen = set()
+        
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        
+        for name in sorted(os.listdir(path)):
+            if not name.endswith('.dat'):
+                continue
+            (prefix, created, sequence) = name.split('.')[0].split('-')
+            segment = _Segment(os.path.join(path, name), int(created))
+            self._sequence = int(sequence)
+            if os.path.exists(segment.path + '.idx'):
+                try:
+                    segment.load()
+                    self._segments.append(segment)
+                    continue
+                except (ValueError, struct.error), e:
+                    print 'Rebuilding archive index: {0}'.format(e)
+                    segment.close()
+                    segment = _Segment(segment.path, segment.created)
+            segment.rebuild()
+            segment.seal()
+            self._segments.append(segment)
+        self._rotate()
+    
+    def _rotate(self):
+        # caller holds self._lock
+        now = int(time.time())
+        self._sequence += 1
+        name = 'segment-{0:012d}-{1:06d}.dat'.format(now, self._sequence % 1000000)
+        segment = _Segment(os.path.join(self._path, name), now)
+        segment.open()
+        if self._segments and self._segments[-1]._file:
+            self._segments[-1].seal()
+        self._segments.append(segment)
+        self._seen = set()
+        self._expire(now)
+    
+    def _expire(self, now):
+        # caller holds self._lock, never removes the active segment
+        total = sum([x.size for x in self._segments])
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            if now - (oldest.last_stamp or oldest.created) < self._retention and total <= self._max_size:
+                break
+            oldest.close()
+            for path in [oldest.path, oldest.path + '.idx']:
+                if os.path.exists(path):
+                    os.unlink(path)
+            total -= oldest.size
+            self._segments.pop(0)
+    
+    def append(self, account, statuses):
+        """
+        Archive `statuses` (:class:`CachedStatus`) as delivered to `account`.
+        """
+        with self._lock:
+            active = self._segments[-1]
+            if active.size > self._segment_size or time.time() - active.created > self._segment_age:
+                self._rotate()
+                active = self._segments[-1]
+            
+            now = int(time.time())
+            for status in statuses:
+                if not status.id in self._seen:
+                    payload = u'\0'.join([status.screen_name, status.name, status.body]).encode('utf-8')
+                    active.append(_STATUS, status.id, _stamp(status.created_at), 0, payload)
+                    self._seen.add(status.id)
+                active.append(_DELIVERY, status.id, now, account)
+            active.flush()
+    
+    def _status(self, status_id):
+        # caller holds self._lock
+        for segment in reversed(self._segments):
+            record = segment.find(status_id)
+            if record:
+                (screen_name, name, body) = record[1].decode('utf-8').split(u'\0', 2)
+                created_at = datetime.datetime.utcfromtimestamp(record[0][2])
+                tagged_name = u'{1}| {0}'.format(name, self._tag)
+                return CachedStatus(status_id, screen_name, name, tagged_name, created_at, body)
+        return None
+    
+    def replay(self, account, limit=20, max_id=None):
+        """
+        Return up to `limit` statuses last delivered to `account`, oldest first.
+        
+        :param max_id: only return statuses with an id up to `max_id`
+        """
+        ids = []
+        with self._lock:
+            for segment in reversed(self._segments):
+                delivered = segment.deliveries(account)[0]
+                for i in xrange(len(delivered) - 1, -1, -1):
+                    status_id = delivered[i]
+                    if (max_id and status_id > max_id) or status_id in ids:
+                        continue
+                    ids.append(status_id)
+                    if len(ids) >= limit:
+                        break
+                if len(ids) >= limit:
+                    break
+            
+            statuses = [self._status(x) for x in ids]
+        return sorted([x for x in statuses if x], key=lambda x: x.id)
+    
+    def since(self, account, stamp):
+        """
+        Return all statuses delivered to `account` at or after `stamp`
+        (unix time), oldest first.
+        """
+        ids = set()
+        with self._lock:
+            for segment in reversed(self._segments):
+                (delivered, stamps) = segment.deliveries(account)
+                if not stamps or stamps[-1] < stamp:
+                    continue
+                ids.update(delivered[bisect.bisect_left(stamps, stamp):])
+            statuses = [self._status(x) for x in ids]
+        return sorted([x for x in statuses if x], key=lambda x: x.id)
+    
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
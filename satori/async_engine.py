@@ -0,0 +1,454 @@
+# encoding: utf-8
+#
+#  async_engine.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import ssl
+import time
+import Queue
+import socket
+import asyncore
+import threading
+import traceback
+from collections import deque
+
+class AsyncError(Exception):
+    """Raised into a coroutine when a request failed on the transport level."""
+    pass
+
+def split_host(host, secure=False):
+    """
+    Split the port off `host` ('host:port' as accepted by httplib).
+    
+    :returns: a tuple `(host, port)`, the port defaults to 80 or 443
+    """
+    (name, sep, port) = host.rpartition(':')
+    if sep and port.isdigit():
+        return (name, int(port))
+    return (host, 443 if secure else 80)
+
+class Return(object):
+    """
+    Yielded by a coroutine to finish with a result
+    (generators can't `return value` in Python 2).
+    """
+    __slots__ = ('value',)
+    
+    def __init__(self, value):
+        self.value = value
+
+class Call(object):
+    """
+    Yielded by a coroutine to run a blocking `func(*args)` (database, disk)
+    off the engine's loop, the result is sent back (or the error thrown in).
+    """
+    __slots__ = ('func', 'args')
+    
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+class HttpRequest(object):
+    __slots__ = ('host', 'port', 'secure', 'method', 'path', 'headers', 'body', 'deadline', 'task')
+    
+    def __init__(self, host, port, secure, method, path, headers=None, body=''):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.method = method
+        self.path = path
+        self.headers = headers or {}
+        self.body = body
+        self.deadline = None
+        self.task = None
+    
+    @property
+    def pool_key(self):
+        return (self.host, self.port, self.secure)
+    
+    def serialize(self):
+        headers = dict(self.headers)
+        headers['Host'] = self.host
+        if self.port != (443 if self.secure else 80):
+            headers['Host'] += ':{0}'.format(self.port)
+        headers['Connection'] = 'keep-alive'
+        headers['Content-Length'] = str(len(self.body))
+        lines = ['{0} {1} HTTP/1.1'.format(self.method, self.path)]
+        lines.extend(['{0}: {1}'.format(k, v) for (k, v) in headers.items()])
+        return '\r\n'.join(lines) + '\r\n\r\n' + self.body
+
+class HttpResponse(object):
+    __slots__ = ('status', 'reason', 'headers', 'body')
+    
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+    
+    def getheader(self, name, default=None):
+        # same interface as httplib.HTTPResponse
+        return self.headers.get(name.lower(), default)
+
+class _HttpConnection(asyncore.dispatcher):
+    """
+    A single keep-alive HTTP/1.1 connection driven by the engine's loop.
+    """
+    
+    def __init__(self, engine, pool_key):
+        asyncore.dispatcher.__init__(self, map=engine._map)
+        self._engine = engine
+        self.pool_key = pool_key
+        self._handshaking = pool_key[2]
+        self._request = None
+        self._out = ''
+        self._in = ''
+        self._head = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((pool_key[0], pool_key[1]))
+    
+    # --- request / response handling
+    
+    def start(self, request):
+        self._request = request
+        self._out = request.serialize()
+        self._in = ''
+        self._head = None
+    
+    def _parse(self, closed=False):
+        if not self._head:
+            (head, sep, rest) = self._in.partition('\r\n\r\n')
+            if not sep:
+                return None
+            lines = head.split('\r\n')
+            (version, status, reason) = (lines[0].split(' ', 2) + [''])[:3]
+            headers = {}
+            for line in lines[1:]:
+                (key, sep, value) = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            self._head = (int(status), reason, headers)
+            self._in = rest
+        
+        (status, reason, headers) = self._head
+        if status in (204, 304) or self._request.method == 'HEAD':
+            # never has a body, whatever Content-Length says
+            body = ''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = []
+            data = self._in
+            while True:
+                (size, sep, data) = data.partition('\r\n')
+                if not sep:
+                    return None
+                size = int(size.split(';')[0], 16)
+                if len(data) < size + 2:
+                    return None
+                if not size:
+                    break
+                body.append(data[:size])
+                data = data[size + 2:]
+            body = ''.join(body)
+        elif 'content-length' in headers:
+            if len(self._in) < int(headers['content-length']):
+                return None
+            body = self._in[:int(headers['content-length'])]
+        elif closed:
+            body = self._in
+        else:
+            return None
+        return HttpResponse(status, reason, headers, body)
+    
+    def _complete(self, response, closed=False):
+        request = self._request
+        self._request = None
+        keep_alive = not closed and response.headers.get('connection', '').lower() != 'close'
+        if not keep_alive:
+            self.close()
+        self._engine._request_done(self, request, response, keep_alive)
+    
+    def _fail(self, error):
+        request = self._request
+        self._request = None
+        self.close()
+        self._engine._request_done(self, request, error, False)
+    
+    # --- asyncore callbacks
+    
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+            self._handshaking = False
+        except ssl.SSLError, e:
+            if e.args[0] not in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                raise
+    
+    def handle_connect(self):
+        if self._handshaking:
+            self.socket = ssl.wrap_socket(self.socket, do_handshake_on_connect=False)
+            self._handshake()
+    
+    def writable(self):
+        return not self.connected or self._handshaking or bool(self._out)
+    
+    def handle_write(self):
+        if self._handshaking:
+            return self._handshake()
+        try:
+            sent = self.send(self._out)
+            self._out = self._out[sent:]
+        except ssl.SSLError, e:
+            if e.args[0] not in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                raise
+    
+    def handle_read(self):
+        if self._handshaking:
+            return self._handshake()
+        try:
+            data = self.recv(65536)
+            while self.pool_key[2] and self.socket.pending():
+                data += self.recv(65536)
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        
+        if not self._request:
+            # unsolicited data on an idle connection
+            self.close()
+            self._engine._request_done(self, None, None, False)
+            return
+        
+        self._in += data
+        response = self._parse()
+        if response:
+            self._complete(response)
+    
+    def handle_close(self):
+        if self._request:
+            response = self._parse(closed=True)
+            if response:
+                # whatever the headers said, this connection is gone
+                return self._complete(response, closed=True)
+            return self._fail(AsyncError('connection closed by {0}'.format(self.pool_key[0])))
+        self.close()
+        self._engine._request_done(self, None, None, False)
+    
+    def handle_error(self):
+        error = AsyncError(traceback.format_exc().splitlines()[-1])
+        if self._request:
+            return self._fail(error)
+        self.close()
+        self._engine._request_done(self, None, None, False)
+
+class _Task(object):
+    __slots__ = ('key', 'gen', 'callback', 'errback')
+    
+    def __init__(self, key, gen, callback, errback):
+        self.key = key
+        self.gen = gen
+        self.callback = callback
+        self.errback = errback
+
+class _Resume(object):
+    __slots__ = ('task', 'value', 'error')
+    
+    def __init__(self, task, value=None, error=None):
+        self.task = task
+        self.value = value
+        self.error = error
+
+class AsyncEngine(object):
+    """
+    Single threaded engine running connector coroutines over non-blocking
+    keep-alive HTTP connections.
+    
+    A coroutine is a generator which yields :class:`HttpRequest` objects and
+    gets the matching :class:`HttpResponse` sent back (or :class:`AsyncError`
+    thrown in). Coroutines sharing a `key` are run one after another, every
+    (host, port, secure) triple uses at most `host_limit` sockets.
+    Callbacks are handed to `defer` so they run on the caller's thread.
+    
+    A coroutine may also yield a :class:`Call`, it is handed to `offload`
+    (with the signature of :meth:`WorkerPool.submit`) and the coroutine
+    resumes once a worker thread finished it. Without `offload` calls are
+    run on the engine's thread.
+    """
+    
+    def __init__(self, defer, host_limit=4, timeout=30, offload=None):
+        self._defer = defer
+        self._offload = offload
+        self._host_limit = host_limit
+        self._timeout = timeout
+        self._map = {}
+        self._inbox = Queue.Queue()
+        self._pending = {}      # key -> deque of tasks waiting for that key
+        self._idle = {}         # pool key -> list of idle connections
+        self._open = {}         # pool key -> number of open connections
+        self._waiting = {}      # pool key -> deque of requests waiting for a connection
+        self._active = {}       # connection -> request
+        self._running = False
+        self._thread = None
+    
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='satori-async')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        self._running = False
+    
+    def spawn(self, key, gen, callback=None, errback=None):
+        """
+        Schedule the coroutine `gen` (thread-safe).
+        
+        :param key:      serialization key, coroutines with the same key never overlap
+        :param callback: called as `callback(result)` through `defer`
+        :param errback:  called as `errback(traceback)` through `defer`
+        """
+        self._inbox.put(_Task(key, gen, callback, errback))
+    
+    # --- engine thread
+    
+    def _run(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, map=self._map, count=1)
+            while True:
+                try:
+                    task = self._inbox.get_nowait()
+                except Queue.Empty:
+                    break
+                if isinstance(task, _Resume):
+                    self._step(task.task, task.value, task.error)
+                elif task.key in self._pending:
+                    self._pending[task.key].append(task)
+                else:
+                    self._pending[task.key] = deque()
+                    self._step(task)
+            self._check_timeouts()
+    
+    def _step(self, task, value=None, error=None):
+        try:
+            if error:
+                res = task.gen.throw(error)
+            else:
+                res = task.gen.send(value)
+        except StopIteration:
+            return self._finish(task, None)
+        except Exception, e:
+            return self._finish(task, None, traceback.format_exc())
+        
+        if isinstance(res, Return):
+            task.gen.close()
+            return self._finish(task, res.value)
+        if isinstance(res, Call):
+            return self._call(task, res)
+        
+        res.task = task
+        res.deadline = time.time() + self._timeout
+        self._submit(res)
+    
+    def _finish(self, task, result, error=None):
+        if error:
+            if task.errback:
+                self._defer(task.errback, (error,))
+            else:
+                print 'Coroutine failed: {0}'.format(error)
+        elif task.callback:
+            self._defer(task.callback, (result,))
+        
+        pending = self._pending[task.key]
+        if pending:
+            self._step(pending.popleft())
+        else:
+            del self._pending[task.key]
+    
+    def _call(self, task, call):
+        def _run():
+            try:
+                self._inbox.put(_Resume(task, call.func(*call.args)))
+            except Exception, e:
+                self._inbox.put(_Resume(task, error=e))
+        
+        if self._offload:
+            # tasks sharing a key never overlap, neither do their calls
+            self._offload(task.key, None, _run)
+        else:
+            _run()
+    
+    def _submit(self, request):
+        key = request.pool_key
+        idle = self._idle.get(key)
+        if idle:
+            connection = idle.pop()
+        elif self._open.get(key, 0) < self._host_limit:
+            try:
+                connection = _HttpConnection(self, key)
+            except socket.error, e:
+                return self._step(request.task, error=AsyncError(str(e)))
+            self._open[key] = self._open.get(key, 0) + 1
+        else:
+            self._waiting.setdefault(key, deque()).append(request)
+            return
+        
+        self._active[connection] = request
+        connection.start(request)
+    
+    def _request_done(self, connection, request, response, keep_alive):
+        key = connection.pool_key
+        self._active.pop(connection, None)
+        if keep_alive:
+            self._idle.setdefault(key, []).append(connection)
+        else:
+            if connection in self._idle.get(key, []):
+                self._idle[key].remove(connection)
+            self._open[key] -= 1
+        
+        waiting = self._waiting.get(key)
+        if waiting:
+            self._submit(waiting.popleft())
+        
+        if request:
+            if isinstance(response, Exception):
+                self._step(request.task, error=response)
+            else:
+                self._step(request.task, response)
+    
+    def _check_timeouts(self):
+        now = time.time()
+        for (connection, request) in self._active.items():
+            if request.deadline < now:
+                connection._fail(AsyncError('request to {0} timed out'.format(request.host)))
+        
+        # requests still waiting for a connection time out just the same
+        expired = []
+        for waiting in self._waiting.values():
+            for request in [x for x in waiting if x.deadline < now]:
+                waiting.remove(request)
+                expired.append(request)
+        for request in expired:
+            self._step(request.task, error=AsyncError('request to {0} timed out'.format(request.host)))
@@ -27,15 +27,26 @@
 # OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import sys
+import time
+import fcntl
+import Queue
 import thread, threading
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.interfaces import PoolListener
 from sqlalchemy import MetaData, Column, Table, ForeignKey
-from sqlalchemy import Integer, String
+from sqlalchemy import ForeignKeyConstraint, Index
+from sqlalchemy import Integer, BigInteger, String
+from sqlalchemy import and_, bindparam, select
 from sqlalchemy.orm import backref, relationship, sessionmaker, scoped_session
+from sqlalchemy.orm import joinedload, joinedload_all
 from sqlalchemy.orm import mapper as sqla_mapper
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import SQLAlchemyError
 
+from metrics import Metrics
+
 def _session_mapper(cls, scoped_session_):
     """
     support for scoped_session aware mapper class as described in
@@ -51,6 +62,35 @@ _Base = declarative_base()
 _mapper = _session_mapper(_Base, _Session)
 _Base.mapper = _mapper
 
+CURSOR_HOME = 'home'
+CURSOR_DM = 'dm'
+CURSOR_MENTIONS = 'mentions'
+CURSOR_SEARCH = 'search'
+
+class Cursor(_Base):
+    __tablename__ = 'cursor'
+    __table_args__ = (ForeignKeyConstraint(['user_id', 'service_id'],
+                                           ['account.user_id', 'account.service_id']),
+                      {})
+    
+    user_id = Column(Integer, primary_key=True)
+    service_id = Column(Integer, primary_key=True)
+    kind = Column(String, primary_key=True)
+    since_id = Column(BigInteger, nullable=False, default=0)
+    
+    def __init__(self, account, kind, since_id=0):
+        self.user_id = account.user_id
+        self.service_id = account.service_id
+        self.kind = kind
+        self.since_id = since_id
+    
+    def __repr__(self):
+        return '<Cursor(user_id={0}, service_id={1}, kind="{2}", since_id={3})>'.format(
+            self.user_id, self.service_id, self.kind, self.since_id)
+
+# declared on the columns, SQLAlchemy 0.6 doesn't resolve names in __table_args__
+Index('ix_cursor_account', Cursor.__table__.c.user_id, Cursor.__table__.c.service_id)
+
 class Account(_Base):
     __tablename__ = 'account'
     
@@ -59,8 +99,11 @@ class Account(_Base):
     
     auth_key = Column(String, nullable=False)
     auth_secret = Column(String, nullable=False)
+    # legacy "home_id:dm_id" cursors, see BookKeeper.migrate_cursors()
     status = Column(String)
     
+    cursors = relationship(Cursor, cascade='all, delete, delete-orphan')
+    
 
     def __init__(self, user, service, auth_key='', auth_secret=''):
         self.user_id = user.id_
@@ -124,55 +167,256 @@ class User(_Base):
         return '<User(id={0}, jid="{1}")>'.format(self.id_, self.jid)
 
 
+class _SQLitePragmas(PoolListener):
+    """
+    Apply journal and cache settings to every new SQLite connection.
+    """
+    
+    def __init__(self, synchronous='NORMAL', cache_size=2000):
+        self._pragmas = ['PRAGMA journal_mode=WAL',
+                         'PRAGMA synchronous={0}'.format(synchronous),
+                         'PRAGMA cache_size={0}'.format(int(cache_size))]
+    
+    def connect(self, dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        for pragma in self._pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+class _Writer(object):
+    """
+    Dedicated thread owning the only connection used for writing.
+    
+    :meth:`call` runs `func(session, *args)` on the writer thread and
+    returns its result (or re-raises its exception) to the caller. With
+    `lock_path` given every call holds an exclusive lock on that file, so
+    the writers of several processes (shards) take turns as well.
+    """
+    
+    def __init__(self, engine, lock_path=None):
+        self._session = sessionmaker(bind=engine, expire_on_commit=False)()
+        self._lock = open(lock_path, 'a') if lock_path else None
+        self._latency = Metrics.shared().histogram('db.commit')
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='satori-db-writer')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def _run(self):
+        while True:
+            (func, args, done, result) = self._queue.get()
+            start = time.time()
+            if self._lock:
+                fcntl.flock(self._lock, fcntl.LOCK_EX)
+            try:
+                result.append(func(self._session, *args))
+            except Exception, e:
+                self._session.rollback()
+                result.append(e)
+                result.append(sys.exc_info()[2])
+            finally:
+                # keep the writer's identity map from growing
+                self._session.expunge_all()
+                if self._lock:
+                    fcntl.flock(self._lock, fcntl.LOCK_UN)
+                self._latency.observe(time.time() - start)
+                done.set()
+    
+    def call(self, func, *args):
+        if threading.current_thread() is self._thread:
+            return func(self._session, *args)
+        
+        (done, result) = (threading.Event(), [])
+        self._queue.put((func, args, done, result))
+        done.wait()
+        if len(result) > 1:
+            raise result[0], None, result[1]
+        return result[0]
+
 class BookKeeper(object):
-    def __init__(self, dbpath):
-        self._engine = create_engine('sqlite:///{0}'.format(dbpath))
+    def __init__(self, dbpath, flush_interval=0, flush_updates=500,
+                 synchronous='NORMAL', cache_size=2000, read_connections=4,
+                 lock_path=None):
+        url = 'sqlite:///{0}'.format(dbpath)
+        pragmas = _SQLitePragmas(synchronous, cache_size)
+        # readers share a small pool, all writes go through one connection
+        self._engine = create_engine(url, poolclass=QueuePool,
+                                     pool_size=read_connections,
+                                     listeners=[pragmas],
+                                     connect_args={'check_same_thread' : False,
+                                                   'timeout' : 30})
+        self._write_engine = create_engine(url, poolclass=QueuePool,
+                                           pool_size=1, max_overflow=0,
+                                           listeners=[pragmas],
+                                           connect_args={'check_same_thread' : False,
+                                                         'timeout' : 30})
         _Session.configure(bind=self._engine)
-        _Base.metadata.create_all(self._engine)
+        _Base.metadata.create_all(self._write_engine)
         self._sessions = {}
+        self._writer = _Writer(self._write_engine, lock_path)
+        
+        # detached snapshots of user() / account() results, see _cached()
+        self._snapshot_session = sessionmaker(bind=self._engine)
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        self._cache_generation = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
+        
+        # write-behind status cursors, see update_status()
+        self._flush_interval = flush_interval
+        self._flush_updates = flush_updates
+        self._dirty = {}
+        self._flushing = {}
+        self._dirty_lock = threading.RLock()
+        self._flusher = None
+        if self._flush_interval:
+            self._flusher = threading.Thread(target=self._run_flusher, name='satori-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
 
     def _local_session(self):
         if not thread.get_ident() in self._sessions:
             self._sessions[thread.get_ident()] = _Session()
         return self._sessions[thread.get_ident()]
 
+    # --- identity map cache
+    
+    def _cached(self, key, load):
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache_hits += 1
+                return list(self._cache[key])
+            self._cache_misses += 1
+            generation = self._cache_generation
+        
+        session = self._snapshot_session()
+        try:
+            res = load(session)
+            session.expunge_all()
+        finally:
+            session.close()
+        
+        with self._cache_lock:
+            # don't store anything that was invalidated while loading
+            if generation == self._cache_generation:
+                self._cache[key] = res
+        return list(res)
+    
+    def _invalidate(self, obj=None):
+        with self._cache_lock:
+            self._cache_generation += 1
+            if isinstance(obj, Account):
+                ids = set([(obj.user_id, obj.service_id)])
+            elif isinstance(obj, tuple):
+                ids = set([obj])
+            elif isinstance(obj, list):
+                ids = set(obj)
+            else:
+                # users, services or unknown - start over
+                self._cache = {}
+                return
+            
+            user_ids = set([x[0] for x in ids])
+            for (key, res) in self._cache.items():
+                if not res:
+                    # might be the one that was just created
+                    del self._cache[key]
+                for x in res:
+                    if (isinstance(x, Account) and (x.user_id, x.service_id) in ids) or \
+                       (isinstance(x, User) and x.id_ in user_ids):
+                        del self._cache[key]
+                        break
+    
+    def evict(self, jid):
+        """
+        Drop all cached lookups for `jid` (e.g. once its room was evicted).
+        """
+        with self._cache_lock:
+            for key in self._cache.keys():
+                if key[1] == jid:
+                    del self._cache[key]
+    
+    def cache_stats(self):
+        with self._cache_lock:
+            return {'entries' : len(self._cache),
+                    'hits'    : self._cache_hits,
+                    'misses'  : self._cache_misses}
+    
     def reflect_services(self, config):
+        try:
+            return self._writer.call(self._reflect_services, config)
+        finally:
+            self._invalidate()
+    
+    def _reflect_services(self, session, config):
         if not getattr(config, 'services', None):
             return
         
+        services = Service.__table__
+        service_types = ServiceType.__table__
+        accounts = Account.__table__
+        cursors = Cursor.__table__
+        users = User.__table__
+        
+        tags = set([x['tag'] for x in config.services])
+        type_names = set([x['type'] for x in config.services])
+        timings = []
+        started = time.time()
+        
+        def _step(name, count):
+            timings.append((name, count, time.time()))
+        
         try:
-            session = self._local_session()
             # step 1, remove all services _not_ in the config file
-            # this will cascade down to the accounts using them
-            for service in session.query(Service).all():
-                if not service.name in [x['tag'] for x in config.services]:
-                    print '* removing obsolete {0}'.format(service)
-                    session.delete(service)
+            # including the accounts (and cursors) using them
+            obsolete = select([services.c.id], ~services.c.name.in_(tags))
+            session.execute(cursors.delete().where(cursors.c.service_id.in_(obsolete)))
+            session.execute(accounts.delete().where(accounts.c.service_id.in_(obsolete)))
+            _step('removed obsolete services', session.execute(
+                    services.delete().where(~services.c.name.in_(tags))).rowcount)
             
             # step 2, add new service types (if any)
-            known_service_types = [x[0] for x in session.query(ServiceType.name).all()]
-            for service_type in [x['type'] for x in config.services if not x['type'] in known_service_types]:
-                session.add(ServiceType(service_type))
-                print '* creating new service_type {0}'.format(service_type)
-            session.commit()
+            known = set([x[0] for x in session.execute(select([service_types.c.name]))])
+            missing = type_names - known
+            if missing:
+                session.execute(service_types.insert(), [{'name' : x} for x in missing])
+            _step('created service types', len(missing))
             
-            # step 3, add new services (if any)
-            known_services = [x[0] for x in session.query(Service.name).all()]
-            for service in [x for x in config.services if not x['tag'] in known_services]:
-                service_type = session.query(ServiceType).filter(ServiceType.name == service['type']).first()
-                session.add(Service(service['tag'], service_type))
-                print '* creating new service {0} - {1}'.format(service['tag'], service_type)
+            # step 3, add new services (if any) and follow type changes
+            type_ids = dict(session.execute(select([service_types.c.name,
+                                                    service_types.c.id])).fetchall())
+            known = set([x[0] for x in session.execute(select([services.c.name]))])
+            missing = [{'name'    : x['tag'],
+                        'type_id' : type_ids[x['type']]}
+                       for x in config.services if not x['tag'] in known]
+            if missing:
+                session.execute(services.insert(), missing)
+            session.execute(services.update().where(
+                                and_(services.c.name == bindparam('b_name'),
+                                     services.c.type_id != bindparam('b_type_id'))).values(
+                                type_id=bindparam('b_type_id')),
+                            [{'b_name'    : x['tag'],
+                              'b_type_id' : type_ids[x['type']]} for x in config.services])
+            _step('created services', len(missing))
             
             # step 4, remove service types no longer in use
-            for service_type in session.query(ServiceType):
-                if not len(service_type.services):
-                    print '* removing orphaned {0}'.format(service_type)
-                    
+            _step('removed orphaned service types', session.execute(
+                    service_types.delete().where(
+                        ~service_types.c.id.in_(select([services.c.type_id])))).rowcount)
+            
             # step 5, remove orphaned users
-            for user in session.query(User):
-                if not len(user.accounts):
-                    print '* removing orphaned {0}'.format(user)
+            _step('removed orphaned users', session.execute(
+                    users.delete().where(
+                        ~users.c.id.in_(select([accounts.c.user_id])))).rowcount)
             session.commit()
+            _step('commit', 0)
+            
+            last = started
+            for (name, count, stamp) in timings:
+                print '* {0}: {1} ({2:.3f}s)'.format(name, count, stamp - last)
+                last = stamp
+            print '* reflect_services took {0:.3f}s'.format(last - started)
             return True
         except SQLAlchemyError as err:
             print '\n***'
@@ -182,8 +426,8 @@ class BookKeeper(object):
             session.rollback()
             return False
         
-    def account(self, jid=None, service=None, create=False):
-        sql = self._local_session().query(Account)
+    def _query_accounts(self, session, jid=None, service=None):
+        sql = session.query(Account)
         if service:
             sql = sql.join(Service)
             sql = sql.filter(Account.service_id == Service.id_)
@@ -192,38 +436,93 @@ class BookKeeper(object):
             sql = sql.join(User)
             sql = sql.filter(Account.user_id == User.id_)
             sql = sql.filter(User.jid == jid)
+        return sql
+    
+    def account(self, jid=None, service=None, create=False):
+        """
+        Lookups by jid are answered from the cache and return detached
+        snapshots with `user`, `service` and `service.type_` loaded.
+        """
+        if jid:
+            load = lambda session: self._query_accounts(session, jid, service).options(
+                                        joinedload('user'),
+                                        joinedload_all('service.type_')).all()
+            res = self._cached(('account', jid, service), load)
+        else:
+            res = self._query_accounts(self._local_session(), jid, service).all()
         
-        res = sql.all()
         if create and jid and service and not res:
-            user = self._local_session().query(User).filter(User.jid == jid).first()
-            service_ = self._local_session().query(Service).filter(Service.name == service).first()
-            res = [Account(user, service_)]
-            self.commit(res[0])
+            key = self._writer.call(self._create_account, jid, service)
+            self._invalidate()
+            res = [self._local_session().query(Account).get(key)]
         
         return res
     
     def user(self, jid=None, create=False):
-        sql = self._local_session().query(User)
+        """
+        Lookups by jid are answered from the cache and return detached
+        snapshots with all `accounts` (and their services) loaded.
+        """
         if jid:
-            sql = sql.filter(User.jid == jid)
+            load = lambda session: session.query(User).filter(User.jid == jid).options(
+                                        joinedload_all('accounts.service.type_'),
+                                        joinedload('accounts.user')).all()
+            res = self._cached(('user', jid), load)
+        else:
+            res = self._local_session().query(User).all()
         
-        res = sql.all()
         if create and not res:
-            res = [User(jid),]
-            self.commit(res[0])
+            key = self._writer.call(self._create_user, jid)
+            self._invalidate()
+            res = [self._local_session().query(User).get(key)]
             
         return res
     
     def remove(self, obj):
         session = self._local_session()
         if obj:
-            session.delete(obj)
-        session.commit()
+            try:
+                self._writer.call(self._remove, obj)
+            finally:
+                self._invalidate(obj)
+            if obj in session:
+                session.expunge(obj)
     
     def commit(self, obj):
         session = self._local_session()
         if obj:
-            session.add(obj)
+            try:
+                self._writer.call(self._commit, obj)
+            finally:
+                self._invalidate(obj)
+            if obj in session:
+                # the changes are persisted, don't let autoflush write them again
+                session.expire(obj)
+        else:
+            session.commit()
+    
+    # --- executed by the writer thread
+    
+    def _create_account(self, session, jid, service):
+        user = session.query(User).filter(User.jid == jid).first()
+        service_ = session.query(Service).filter(Service.name == service).first()
+        account = Account(user, service_)
+        session.add(account)
+        session.commit()
+        return (account.user_id, account.service_id)
+    
+    def _create_user(self, session, jid):
+        user = User(jid)
+        session.add(user)
+        session.commit()
+        return user.id_
+    
+    def _commit(self, session, obj):
+        session.merge(obj)
+        session.commit()
+    
+    def _remove(self, session, obj):
+        session.delete(session.merge(obj))
         session.commit()
     
     def release(self):
@@ -231,6 +530,130 @@ class BookKeeper(object):
             self._sessions[thread.get_ident()].close()
             del self._sessions[thread.get_ident()]
     
+    # --- status cursors
+    
+    def cursor(self, account, kind=CURSOR_HOME):
+        """
+        Return the since_id stored for timeline `kind` of `account`
+        (including unflushed updates), 0 if there is none.
+        """
+        key = (account.user_id, account.service_id, kind)
+        with self._dirty_lock:
+            if key in self._dirty:
+                return self._dirty[key]
+            if key in self._flushing:
+                return self._flushing[key]
+        
+        since_id = self._local_session().query(Cursor.since_id).filter(
+                        and_(Cursor.user_id == key[0],
+                             Cursor.service_id == key[1],
+                             Cursor.kind == kind)).scalar()
+        return since_id or 0
+    
+    def update_cursor(self, account, kind, since_id):
+        """
+        Store a new since_id for timeline `kind` of `account`.
+        
+        With a flush interval configured the update is only recorded in
+        memory and written by the next :meth:`flush` (every `flush_interval`
+        seconds, after `flush_updates` updates or on :meth:`close`).
+        """
+        key = (account.user_id, account.service_id, kind)
+        if not self._flush_interval:
+            self._writer.call(self._flush, {key : since_id})
+            return
+        
+        with self._dirty_lock:
+            self._dirty[key] = since_id
+            if len(self._dirty) < self._flush_updates:
+                return
+        self.flush()
+    
+    def flush(self):
+        """
+        Write all pending cursor updates in a single transaction.
+        """
+        with self._dirty_lock:
+            if not self._dirty:
+                return 0
+            dirty = self._dirty
+            self._dirty = {}
+            # still visible through cursor() until they are written
+            self._flushing.update(dirty)
+        
+        try:
+            self._writer.call(self._flush, dirty)
+        except SQLAlchemyError as err:
+            print 'Failed to flush status cursors: {0}'.format(err)
+            with self._dirty_lock:
+                # keep anything newer which arrived in the meantime
+                dirty.update(self._dirty)
+                self._dirty = dirty
+                for key in dirty:
+                    self._flushing.pop(key, None)
+            return 0
+        
+        with self._dirty_lock:
+            for key in dirty:
+                self._flushing.pop(key, None)
+        return len(dirty)
+    
+    def _flush(self, session, dirty):
+        sql = Cursor.__table__.insert().prefix_with('OR REPLACE')
+        session.execute(sql, [{'user_id'    : user_id,
+                               'service_id' : service_id,
+                               'kind'       : kind,
+                               'since_id'   : since_id}
+                              for ((user_id, service_id, kind), since_id) in dirty.items()])
+        session.commit()
+    
+    def migrate_cursors(self):
+        """
+        Convert legacy "home_id:dm_id" strings in `account.status` into
+        cursor rows (in place, safe to run more than once).
+        
+        :returns: the number of migrated accounts
+        """
+        return self._writer.call(self._migrate_cursors)
+    
+    def _migrate_cursors(self, session):
+        table = Account.__table__
+        rows = session.execute(select([table.c.user_id, table.c.service_id, table.c.status],
+                                      table.c.status != '')).fetchall()
+        values = []
+        for (user_id, service_id, status) in rows:
+            for (kind, since_id) in zip([CURSOR_HOME, CURSOR_DM], status.split(':')):
+                try:
+                    since_id = long(since_id)
+                except ValueError:
+                    print '* skipping corrupt cursor "{0}" for account ({1}, {2})'.format(
+                            status, user_id, service_id)
+                    continue
+                if since_id:
+                    values.append({'user_id'    : user_id,
+                                   'service_id' : service_id,
+                                   'kind'       : kind,
+                                   'since_id'   : since_id})
+        
+        if values:
+            # cursors which already exist are newer than the legacy ones
+            session.execute(Cursor.__table__.insert().prefix_with('OR IGNORE'), values)
+        session.execute(table.update().where(table.c.status != '').values(status=''))
+        session.commit()
+        return len(rows)
+    
+    def _run_flusher(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+    
+    def close(self):
+        """
+        Flush pending updates, to be called on clean shutdown.
+        """
+        self.flush()
+        self.release()
+    
     def do_tests(self):
         import time, random, thread, threading
         
@@ -344,11 +767,14 @@ class BookKeeper(object):
                 print '- OK\n'
             
             print '* Attempting a multi-threaded data update..'
-            threading.Thread(target=_thread_updater, args=(self, users[0].jid,)).start()
-            threading.Thread(target=_thread_updater, args=(self, users[0].jid,)).start()
+            updaters = [threading.Thread(target=_thread_updater, args=(self, users[0].jid,)),
+                        threading.Thread(target=_thread_updater, args=(self, users[0].jid,))]
+            for updater in updaters:
+                updater.start()
             
-            while threading.active_count() > 1:
-                time.sleep(1)
+            # the writer thread stays around, wait for the updaters only
+            for updater in updaters:
+                updater.join()
             print '- OK\n'
             
         except SQLAlchemyError as err:
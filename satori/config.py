@@ -84,6 +84,56 @@ class _SatoriCoreConfig(_BaseConfig):
         self.port = self.settings.get('port', 5347)
         self.secret = self.settings.get('secret', 'secret')
         self.register_ok = self.settings.get('allowRegister', True)
+        self.poll_interval = self.settings.get('pollInterval', 60)
+        self.poll_tick = self.settings.get('pollTick', 1)
+        self.poll_batch = self.settings.get('pollBatch', 25)
+        self.poll_jitter = self.settings.get('pollJitter', 0.1)
+        self.worker_threads = self.settings.get('workerThreads', 8)
+        self.host_concurrency = self.settings.get('hostConcurrency', 4)
+        self.engine = self.settings.get('engine', 'threaded')
+        self.status_cache_size = self.settings.get('statusCacheSize', 10000)
+        self.outbound_depth = self.settings.get('outboundDepth', 5000)
+        self.outbound_policy = self.settings.get('outboundPolicy', 'block')
+        self.outbound_batch = self.settings.get('outboundBatch', 50)
+        self.presence_ttl = self.settings.get('presenceTtl', 86400)
+        self.room_occupant_cap = self.settings.get('roomOccupantCap', 0)
+        self.search_interval = self.settings.get('searchInterval', 60)
+        self.history_size = self.settings.get('historySize', 50)
+        self.history_chars = self.settings.get('historyChars', 65536)
+        self.idle_poll_interval = self.settings.get('idlePollInterval', 600)
+        self.suspend_after = self.settings.get('suspendAfter', 3600)
+        self.evict_after = self.settings.get('evictAfter', 86400)
+        self.snapshot = self.settings.get('snapshot', True)
+        self.snapshot_interval = self.settings.get('snapshotInterval', 300)
+        self.admission_rate = self.settings.get('admissionRate', 5)
+        self.restart_window = self.settings.get('restartWindow', 300)
+        self.admins = self.settings.get('admins', [])
+        self.metrics_interval = self.settings.get('metricsInterval', 60)
+        self.watchdog_threshold = self.settings.get('watchdogThreshold', 2.0)
+        self.profile = self.settings.get('profile', False)
+        self.profile_interval = self.settings.get('profileInterval', 0.01)
+        self.trace = self.settings.get('trace', False)
+        self.cursor_flush_interval = self.settings.get('cursorFlushInterval', 0)
+        self.cursor_flush_updates = self.settings.get('cursorFlushUpdates', 500)
+        self.db_synchronous = self.settings.get('dbSynchronous', 'NORMAL')
+        self.db_cache_size = self.settings.get('dbCacheSize', 2000)
+        self.db_read_connections = self.settings.get('dbReadConnections', 4)
+        self.archive = self.settings.get('archive', False)
+        self.archive_history = self.settings.get('archiveHistory', 20)
+        self.archive_segment_size = self.settings.get('archiveSegmentSize', 16 << 20)
+        self.archive_segment_age = self.settings.get('archiveSegmentAge', 86400)
+        self.archive_retention = self.settings.get('archiveRetention', 7 * 86400)
+        self.archive_max_size = self.settings.get('archiveMaxSize', 1 << 30)
+        self.archive_spool = self.spool
+        self.shards = self.settings.get('shards', 0)
+        self.shard_replicas = self.settings.get('shardReplicas', 100)
+        
+        if not self.engine in ['threaded', 'async']:
+            raise RuntimeError('Unknown engine "{0}" in settings'.format(self.engine))
+        if not str(self.db_synchronous).upper() in ['OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3']:
+            raise RuntimeError('Invalid dbSynchronous "{0}" in settings'.format(self.db_synchronous))
+        if not self.outbound_policy in ['block', 'drop_presence', 'summarize']:
+            raise RuntimeError('Unknown outboundPolicy "{0}" in settings'.format(self.outbound_policy))
         
         if getattr(self, 'services', None):
             for service in self.services:
@@ -101,9 +151,26 @@ class _SatoriCoreConfig(_BaseConfig):
         
                 for (key, default) in [('useHttps', False), 
                                        ('searchRoot', None),
-                                       ('searchHost', None)]:
+                                       ('searchHost', None),
+                                       ('pollAdaptive', False),
+                                       ('pollMinInterval', 15),
+                                       ('pollMaxInterval', 900),
+                                       ('pollBackoff', 2.0),
+                                       ('pollSpeedup', 0.5),
+                                       ('pollPageSize', 20),
+                                       ('poolSize', 4),
+                                       ('poolIdleTimeout', 60),
+                                       ('poolHealthCheck', 30),
+                                       ('actionRate', 40),
+                                       ('actionBurst', 5),
+                                       ('actionRetries', 3),
+                                       ('actionBackoff', 5.0),
+                                       ('actionQueueSize', 20)]:
                     if not key in service:
                         service[key] = default
+                
+                if service['pollMinInterval'] > service['pollMaxInterval']:
+                    raise RuntimeError('pollMinInterval > pollMaxInterval in service definition for "{0}"'.format(service['tag']))
         
         return self
     
@@ -179,10 +246,24 @@ class Config(object):
         
         raise RuntimeError('Failed to load satori-mb.conf')
     
+    @classmethod
+    def reload(cls):
+        """
+        Re-read the config file of the shared instance.
+        
+        :rtype:   :class:`satori.config.Config`
+        :returns: the new shared instance
+        """
+        
+        config = Config.get()
+        Config._sharedConfig = Config(config.path, config.options, *config.optargs)
+        return Config._sharedConfig
+    
     def __init__(self, path, options, *optargs):
         super(Config, self).__init__()
 
         self.core = None
+        self.path = path
         self.options = options
         self.optargs = optargs
         
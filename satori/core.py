@@ -27,9 +27,17 @@
 # OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import sys
 import os
+import json
+import time
+import signal
+import heapq
+import datetime
+import random
+import itertools
+import threading
 import traceback
+from collections import deque, OrderedDict
 from supay import Daemon
 from xml.etree import cElementTree as ET
 
@@ -37,16 +45,312 @@ import satori
 from satori.config import Config
 from satori.book_keeper import BookKeeper
 from satori.twitter_connector import TwitterConnector
+from satori.worker_pool import WorkerPool
+from satori.async_engine import AsyncEngine
+from satori.http_pool import HttpPool
+from satori.stanza_writer import StanzaWriter
+from satori.presence_store import PresenceStore
+from satori.status_cache import StatusCache
+from satori.metrics import Metrics
+from satori.profiler import Watchdog, SamplingProfiler
+from satori.trace_recorder import TraceRecorder
+from satori.archive import TimelineArchive
+from satori.room_history import HistoryRequest, RoomHistory
+from satori.shard import ShardRouter
+from satori.search_feed import SearchFeed, room_query
 
 sleekxmpp = satori.sleekxmpp
 
+# connector lifecycle, shared by all connectors of a room
+CONNECTOR_ACTIVE    = 'active'
+CONNECTOR_IDLE      = 'idle'
+CONNECTOR_SUSPENDED = 'suspended'
+CONNECTOR_EVICTED   = 'evicted'
+
+_LIFECYCLE_CHECK = 10
+_SEARCH_OCCUPANTS = 50
+
+_COMMANDS_NS = 'http://jabber.org/protocol/commands'
+
+class _PollSlot(object):
+    __slots__ = ('connector', 'interval', 'due', 'seq', 'lateness', 'runs')
+
+    def __init__(self, connector, interval):
+        self.connector = connector
+        self.interval = interval
+        self.due = 0.0
+        self.seq = 0
+        self.lateness = 0.0
+        self.runs = 0
+
+class PollScheduler(object):
+    """
+    Central poll scheduler shared by all connectors.
+    
+    Every connector owns exactly one slot which is kept in a heap keyed
+    by its next due time. New slots are spread randomly across their
+    interval, rescheduled slots get a small jitter so they never drift
+    back into lockstep. :meth:`due` hands out at most `batch` slots per
+    call and records how late each of them was dispatched.
+    """
+    
+    def __init__(self, interval=60, batch=25, jitter=0.1):
+        self._interval = interval
+        self._batch = batch
+        self._jitter = jitter
+        self._heap = []
+        self._slots = {}
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+    
+    def _push(self, slot, delay):
+        slot.due = time.time() + delay
+        slot.seq = self._seq.next()
+        heapq.heappush(self._heap, (slot.due, slot.seq, slot))
+    
+    def schedule(self, connector, interval=None):
+        """
+        (Re-)schedule the poll slot for `connector`.
+        
+        :param connector: the connector to be polled
+        :param interval:  seconds until the next poll (defaults to the scheduler interval)
+        :returns: the next due time of this slot
+        """
+        interval = interval or self._interval
+        with self._lock:
+            slot = self._slots.get(connector)
+            if not slot:
+                slot = self._slots[connector] = _PollSlot(connector, interval)
+                delay = random.uniform(0, interval)
+            else:
+                delay = interval + random.uniform(-self._jitter, self._jitter) * interval
+            slot.interval = interval
+            self._push(slot, max(0, delay))
+            return slot.due
+    
+    def remove(self, connector):
+        with self._lock:
+            # stale heap entries are skipped in due()
+            self._slots.pop(connector, None)
+    
+    def due(self, now=None):
+        """
+        Pop the next batch of due slots.
+        
+        Each slot is handed out once, the connector is expected to call
+        :meth:`schedule` again when it is done polling.
+        
+        :param now: reference time (defaults to `time.time()`)
+        :returns: a list of connectors which should be polled now
+        """
+        now = now or time.time()
+        res = []
+        with self._lock:
+            while self._heap and len(res) < self._batch:
+                (due, seq, slot) = self._heap[0]
+                if self._slots.get(slot.connector) is not slot or slot.seq != seq:
+                    heapq.heappop(self._heap)
+                    continue
+                if due > now:
+                    break
+                
+                heapq.heappop(self._heap)
+                slot.seq = 0
+                slot.lateness = now - due
+                slot.runs += 1
+                res.append(slot.connector)
+        return res
+    
+    def lateness(self, now=None):
+        """
+        :returns: seconds the oldest pending slot is overdue (0 if none)
+        """
+        now = now or time.time()
+        with self._lock:
+            late = [now - slot.due for slot in self._slots.values() 
+                    if slot.seq and slot.due < now]
+        return max(late) if late else 0.0
+    
+    def stats(self):
+        """
+        :returns: a list of `(connector, next_due, lateness, runs)` tuples, one per slot
+        """
+        with self._lock:
+            return [(slot.connector, slot.due if slot.seq else None,
+                     slot.lateness, slot.runs) for slot in self._slots.values()]
+
+class AdmissionQueue(object):
+    """
+    Rate limited FIFO for joins which need new connectors.
+    
+    Queued callbacks are admitted at `rate` per second (0 means no
+    limit). After a warm restart :meth:`spread` raises the rate just
+    enough to admit a known backlog within the given window.
+    """
+    
+    def __init__(self, rate=5):
+        self._rate = float(rate)
+        self._boost = 0.0
+        self._boost_until = 0.0
+        self._tokens = 1.0
+        self._stamp = time.time()
+        self._queue = deque()
+        self._keys = set()
+    
+    def __len__(self):
+        return len(self._queue)
+    
+    def put(self, key, callback):
+        """
+        Queue `callback()` unless `key` is already waiting.
+        
+        :returns: True if the callback was queued
+        """
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        self._queue.append((key, callback))
+        return True
+    
+    def spread(self, count, window):
+        self._boost = float(count) / max(1, window)
+        self._boost_until = time.time() + window
+    
+    def due(self, now=None):
+        """
+        :returns: the callbacks which may run now
+        """
+        now = now or time.time()
+        rate = self._rate
+        if rate and now < self._boost_until:
+            rate = max(rate, self._boost)
+        
+        res = []
+        if rate:
+            self._tokens = min(max(1.0, rate), self._tokens + (now - self._stamp) * rate)
+        self._stamp = now
+        
+        while self._queue and (not rate or self._tokens >= 1):
+            (key, callback) = self._queue.popleft()
+            self._keys.discard(key)
+            self._tokens -= 1
+            res.append(callback)
+        return res
+
+class _DeferredCore(object):
+    """
+    Core proxy handed to connectors running on a worker thread.
+    
+    Everything producing stanzas is queued back to the XMPP thread,
+    all other attributes are forwarded unchanged.
+    """
+    
+    _deferred = ('send_room_message', 'send_user_message', 'send_user_presence',
+                 'send_search_results', 'send_search_message')
+    
+    def __init__(self, core, pool):
+        self._core = core
+        self._pool = pool
+    
+    def __getattr__(self, name):
+        attr = getattr(self._core, name)
+        if name in self._deferred:
+            return lambda *args, **kwargs: self._pool.defer(attr, args, kwargs)
+        return attr
+
 class Core(object):
-    def __init__(self):
+    def __init__(self, stream=None, shard=None):
+        """
+        :param stream: a :class:`satori.shard.ShardStream` when running as shard
+                       worker, by default a component connection is created
+        :param shard:  number of this shard (if any)
+        """
         self._config = Config.get().core
+        self._shard = shard
+        lock_path = None
+        if shard is not None:
+            # shards share the database, their writers take turns
+            lock_path = os.path.join(self._config.spool, 'bookkeeper.lock')
         self._book_keeper = BookKeeper(os.path.join(self._config.spool, 
-                                                    'bookkeeper.db'))
-        self._book_keeper.reflect_services(self._config)
+                                                    'bookkeeper.db'),
+                                       self._config.cursor_flush_interval,
+                                       self._config.cursor_flush_updates,
+                                       self._config.db_synchronous,
+                                       self._config.db_cache_size,
+                                       self._config.db_read_connections,
+                                       lock_path)
+        if stream is None:
+            # shards are started after the front process did this
+            self._book_keeper.reflect_services(self._config)
+            self._book_keeper.migrate_cursors()
+        else:
+            # the archive is not shared between processes
+            self._config.archive_spool = os.path.join(self._config.spool,
+                                                      'shard-{0}'.format(shard))
+        if self._config.trace:
+            name = 'trace-{0}.json.gz'.format(time.strftime('%Y%m%d-%H%M%S'))
+            if shard is not None:
+                name = 'shard-{0}-{1}'.format(shard, name)
+            TraceRecorder.start(os.path.join(self._config.spool, name))
         self._room_map = {}
+        self._history = {}
+        self._lifecycle_checked = time.time()
+        self._actions = set()
+        self._search_rooms = {}
+        self._search_feeds = {}
+        self._reply_connectors = {}
+        self._admission = AdmissionQueue(self._config.admission_rate)
+        if self._config.snapshot:
+            self._load_snapshot()
+        self._poll_scheduler = PollScheduler(self._config.poll_interval,
+                                             self._config.poll_batch,
+                                             self._config.poll_jitter)
+        self._engine = None
+        if self._config.engine == 'async':
+            # the pool hands results back to the XMPP thread, its workers
+            # only run the blocking calls of coroutines
+            self._workers = WorkerPool(self._config.worker_threads)
+            self._engine = AsyncEngine(self._workers.defer,
+                                       self._config.host_concurrency,
+                                       offload=self._workers.submit)
+        else:
+            self._workers = WorkerPool(self._config.worker_threads,
+                                       self._config.host_concurrency)
+        self._deferred_core = _DeferredCore(self, self._workers)
+        self._writer = StanzaWriter(self._xmpp_send, self._make_summary,
+                                    self._config.outbound_depth,
+                                    self._config.outbound_policy,
+                                    self._config.outbound_batch)
+        self._metrics = Metrics.shared()
+        self._metrics_dumped = time.time()
+        self._snapshot_saved = time.time()
+        self._metrics.gauge('outbound.depth', lambda: self._writer.stats()['depth'])
+        self._metrics.gauge('http_pool', HttpPool.stats_all)
+        self._metrics.gauge('connectors', self.lifecycle_stats)
+        self._metrics.gauge('admission.queue', lambda: len(self._admission))
+        self._metrics.gauge('poll.lateness', self._poll_scheduler.lateness)
+        self._metrics.gauge('rooms', lambda: len(self._room_map))
+        self._metrics.gauge('searches', lambda: {'feeds' : len(self._search_feeds),
+                                                 'rooms' : len(self._search_rooms)})
+        self._metrics.gauge('status_cache', StatusCache.shared(self._config.status_cache_size).stats)
+        self._metrics.gauge('bookkeeper.cache', self._book_keeper.cache_stats)
+        self._metrics.gauge('actions.pending', lambda: sum([x.pending_actions() for x in self._actions]))
+        
+        self._watchdog = Watchdog(self._config.watchdog_threshold,
+                                  os.path.join(self._config.spool, 'stalls.log'))
+        self._profiler = SamplingProfiler(self._config.spool, self._config.profile_interval)
+        watch = self._watchdog.watch
+        
+        if stream:
+            # the front process owns the component connection
+            self._xmpp = stream
+            self._xmpp.add_event_handler('message', watch('message', self._on_message))
+            self._xmpp.add_event_handler('changed_status', watch('presence', self._on_presence))
+            self._xmpp.add_event_handler('got_offline', watch('presence', self._on_presence))
+            self._xmpp.add_event_handler('shard_release', self._on_shard_release)
+            self._xmpp.add_event_handler('shard_release_search', self._on_shard_release_search)
+            return
+        
         self._xmpp = sleekxmpp.componentxmpp.ComponentXMPP(
                         self._config.jid,
                         self._config.secret,
@@ -54,12 +358,12 @@ class Core(object):
                         self._config.port)
         
         # setup callbacks
-        self._xmpp.add_event_handler('message', self._on_message)
-        self._xmpp.add_event_handler('changed_status', self._on_presence)
-        self._xmpp.add_event_handler('got_offline', self._on_presence)
+        self._xmpp.add_event_handler('message', watch('message', self._on_message))
+        self._xmpp.add_event_handler('changed_status', watch('presence', self._on_presence))
+        self._xmpp.add_event_handler('got_offline', watch('presence', self._on_presence))
         
         # load additional plugins
-        for plugin in ['xep_0004', 'xep_0030', 'xep_0050']:
+        for plugin in ['xep_0004', 'xep_0030']:
             self._xmpp.registerPlugin(plugin)
         
         # setup xmpp discovery information
@@ -68,6 +372,14 @@ class Core(object):
         self._xmpp.plugin['xep_0030'].add_identity(category='conference', itype='microblog', name='Satori')
         self._xmpp.plugin['xep_0030'].add_feature('http://jabber.org/protocol/muc')
         
+        # admin-only ad-hoc commands, answered by _on_command alone
+        # (xep_0050 would answer the same IQs with its own sessions)
+        self._admin_commands = {}
+        self._xmpp.plugin['xep_0030'].add_feature(_COMMANDS_NS)
+        self._xmpp.add_handler("<iq type='set' xmlns='jabber:component:accept'><command xmlns='{0}'/></iq>".format(_COMMANDS_NS), self._on_command)
+        self._add_admin_command('satori-metrics', 'Satori metrics', self._metrics_command)
+        self._add_admin_command('satori-profile', 'Toggle Satori profiler', self._profile_command)
+        
         ## thank you libpurple.. jabber:iq:register would be so much easier!!
         ## but since you don't respect (or even show) register options..
         # self._xmpp.plugin['xep_0030'].add_feature('jabber:iq:register')
@@ -90,6 +402,11 @@ class Core(object):
         self._room_map[jid]['room'] = room_id.bare
         self._room_map[jid]['nick'] = room_id.resource
         self._room_map[jid]['services'] = []
+        self._room_map[jid]['joining'] = None
+        self._room_map[jid]['pending'] = 0
+        self._room_map[jid]['resources'] = set()
+        self._room_map[jid]['state'] = CONNECTOR_ACTIVE
+        self._room_map[jid]['left'] = None
         return added
 
     def _get_room_from_jid(self, jid):
@@ -109,6 +426,19 @@ class Core(object):
 
         return '{0}/{1}'.format(room, name)
 
+    def _make_summary(self, mto, count):
+        mfrom = self._make_room_user(mto, 'Satori')
+        if not mfrom:
+            return None
+        mbody = '{0} messages were skipped, the component link is congested.'.format(count)
+        return self._xmpp.makeMessage(mto, mbody, None, 'groupchat', None, mfrom)
+    
+    def _xmpp_send(self, data):
+        self._xmpp.send(data)
+    
+    def _send(self, stanza, kind='message', mto=None):
+        self._writer.put(stanza, kind, mto)
+    
     def _make_muc_presence(self, pfrom, pto, pshow=None, ptype=None, prole=None, pcode=None):
         presence = self._xmpp.makePresence(pfrom=pfrom, pto=pto,
                                            pshow=pshow, ptype=ptype)
@@ -123,48 +453,125 @@ class Core(object):
 
             presence.append(x)
         return presence
+    
+    def _make_room_message(self, mto, mfrom, mbody, mpubdate=None):
+        message = self._xmpp.makeMessage(mto, mbody, None, 'groupchat', None, mfrom)
+        if mpubdate:
+            delay = ET.Element('{urn:xmpp:delay}delay',
+                               {'from' : mfrom,
+                                'stamp': mpubdate.isoformat().split('.')[0] + 'Z'
+                               })
+            message.append(delay)
+        return message
+    
+    def _send_history(self, jid, request):
+        entries = self._history[jid].select(request)
+        
+        # the buffered authors need to be in the room before they speak,
+        # current occupants got their presence with the join already
+        present = set([x[0] for store in PresenceStore.stores().values()
+                            for x in store.occupants(jid)])
+        for nick in set([x[1] for x in entries]) - present:
+            if nick != 'Satori':
+                self.send_user_presence(jid, nick, True)
+        
+        for (stamp, nick, body) in entries:
+            mfrom = self._make_room_user(jid, nick)
+            if mfrom:
+                self._send(self._make_room_message(jid, mfrom, body, stamp), mto=jid)
+    
+    def _on_join_polled(self, jid):
+        room = self._room_map.get(jid)
+        if not room or not room['joining']:
+            return
+        
+        room['pending'] -= 1
+        if room['pending'] <= 0:
+            (request, room['joining']) = (room['joining'], None)
+            self._send_history(jid, request)
 
     # --- SleekXMPP event handlers
     
     def _on_message(self, event):
+        if TraceRecorder.active():
+            TraceRecorder.active().message(event)
+        
         mfrom = event['from']
-        services = ''
         
         if type(event['from']) != str and type(event['from']) != unicode:
             mfrom = event['from'].bare
         
-        if not mfrom in self._room_map:
+        room = None
+        if room_query(getattr(event['to'], 'user', None)):
+            room = event['to'].bare
+            if not (mfrom, room) in self._search_rooms or not event['body'].startswith('@'):
+                # chatting in a search room is no status update
+                return
+            services = self._search_connectors(mfrom)
+            if not services:
+                self.send_search_message(mfrom, room, 'No account to reply with is configured.')
+                return
+        elif mfrom in self._room_map:
+            services = self._room_map[mfrom]['services']
+        else:
             return
         
-        for service in self._room_map[mfrom]['services']:
-            # let the service decide about the message..
-            services += service.handle_message(mfrom, event['body'])
-        
-        if services:
-            services = 'Message was handled by {0}'.format(services)
-            mfrom = self._make_room_user(event['from'], 'Satori')
-            self._xmpp.sendMessage(event['from'], None, services, 'groupchat', None, mfrom)
+        for service in services:
+            # let the service decide about the message, it is acknowledged once performed
+            if service.queue_message(event['body'], self, room):
+                self._actions.add(service)
+                self._run_actions(service)
         
     def _on_presence(self, event):
+        if TraceRecorder.active():
+            TraceRecorder.active().presence(event)
+        
+        query = room_query(event['to'].user)
+        if query:
+            self._on_search_presence(event, query)
+            return
+        
+        jid = event['from'].bare
+        
         if event['type'] == 'unavailable':
             # user got offline
-            self._xmpp.send(self._make_muc_presence(event['to'],
-                                                    event['from'],
-                                                    'unavailable',
-                                                    prole='member',
-                                                    pcode='110'))
+            self._send(self._make_muc_presence(event['to'],
+                                               event['from'],
+                                               'unavailable',
+                                               prole='member',
+                                               pcode='110'), 'presence')
+            self._leave(jid, event['from'].full)
             return
         
-        if not self._update_room_map_with_jid(event['from'], event['to']):
-            # initial presence was already sent
+        room = self._room_map.get(jid)
+        if room:
+            room['resources'].add(event['from'].full)
+            if room['state'] != CONNECTOR_ACTIVE:
+                self._resume(jid, event)
+            # otherwise the initial presence was already sent
             return
         
+        self._update_room_map_with_jid(event['from'], event['to'])
+        self._room_map[jid]['resources'].add(event['from'].full)
+        request = HistoryRequest.from_xml(getattr(event, 'xml', None))
+        self._history[jid] = RoomHistory(self._config.history_size,
+                                         self._config.history_chars)
+        
         # send initial presence
         pfrom = self._make_room_user(event['from'], 'Satori')
-        self._xmpp.sendPresence(pfrom=pfrom, pto=event['from'])
+        self._send(self._xmpp.makePresence(pfrom=pfrom, pto=event['from']), 'presence')
+        
+        # hold back history until every connector did its first poll
+        self._room_map[jid]['joining'] = request
+        self._admission.put(jid, lambda: self._add_connectors(jid, request))
+    
+    def _add_connectors(self, jid, request=None):
+        room = self._room_map.get(jid)
+        if not room or room['services']:
+            return
         
         # check for subscribed accounts
-        user = self._book_keeper.user(event['from'].bare)
+        user = self._book_keeper.user(jid)
         if user and user[0].accounts:
             for account in user[0].accounts:
                 if not account.auth_key or not account.auth_secret:
@@ -173,18 +580,490 @@ class Core(object):
                 try:
                     print 'Add connector for {0}'.format(account)
                     connector = TwitterConnector(self._book_keeper, account)
-                    connector.perform_updates(self, True)
-                    self._room_map[event['from'].bare]['services'].append(connector)
+                    room['services'].append(connector)
+                    if request is None:
+                        # history was restored, catch up from the stored cursor
+                        self._fill_gap(jid, connector)
+                        self._poll(connector)
+                    else:
+                        room['pending'] += 1
+                        self._poll(connector, request.wants_history,
+                                   lambda jid=jid: self._on_join_polled(jid))
                 except Exception, e:
                     print 'Failed to add Connector: {0}'.format(traceback.format_exc())
                     pass
-#                else:
-#                    self._xmpp.schedule(5, connector.perform_updates, (self, True))
-#                    self._room_map[event['from'].bare]['services'].append(connector)
+        
+        if not room['pending']:
+            room['joining'] = None
+        room['restored'] = None
+    
+    def _fill_gap(self, jid, connector):
+        # statuses delivered after the snapshot was saved are past the
+        # stored cursor already, the archive still has them
+        saved = self._room_map[jid].get('restored')
+        history = self._history.get(jid)
+        if not saved or history is None:
+            return
+        
+        known = set([x[2] for x in history.select(HistoryRequest())])
+        for status in connector.archived_since(int(saved)):
+            if not status.body in known:
+                self.send_room_message(jid, status.tagged_name, status.body, status.created_at)
+
+    # --- search rooms
+    
+    def _on_search_presence(self, event, query):
+        key = (event['from'].bare, event['to'].bare)
+        room = self._search_rooms.get(key)
+        
+        if event['type'] == 'unavailable':
+            self._send(self._make_muc_presence(event['to'],
+                                               event['from'],
+                                               'unavailable',
+                                               prole='member',
+                                               pcode='110'), 'presence')
+            if room:
+                room['resources'].discard(event['from'].full)
+                if not room['resources']:
+                    self._leave_search(key)
+            return
+        
+        if room:
+            room['resources'].add(event['from'].full)
+            return
+        
+        room = self._search_rooms[key] = {'room'      : event['to'].bare,
+                                          'query'     : query,
+                                          'resources' : set([event['from'].full]),
+                                          'feeds'     : [],
+                                          'occupants' : OrderedDict()}
+        self._send(self._xmpp.makePresence(pfrom='{0}/Satori'.format(room['room']),
+                                           pto=event['from']), 'presence')
+        
+        services = [x for x in getattr(self._config, 'services', None) or [] if x['searchHost']]
+        if not services:
+            self.send_search_message(key[0], room['room'], 'No search service is configured.')
+            return
+        
+        for service in services:
+            feed = self._search_feeds.get(('search', service['tag'], query))
+            if feed:
+                # catch up with what the other rooms already got
+                self._send_search(key, room, feed.recent(), True)
+            else:
+                try:
+                    feed = SearchFeed(service, query, self._config.search_interval)
+                except Exception, e:
+                    print 'Failed to add SearchFeed: {0}'.format(traceback.format_exc())
+                    continue
+                print 'Start search {0}'.format(feed)
+                self._search_feeds[feed.key] = feed
+                self._poll(feed)
+            feed.subscribers.add(key)
+            room['feeds'].append(feed)
+    
+    def _search_connectors(self, jid):
+        # replies from a search room use the account room's connectors if
+        # there are any, otherwise connectors of their own
+        room = self._room_map.get(jid)
+        if room and room['services']:
+            return room['services']
+        
+        if not jid in self._reply_connectors:
+            connectors = []
+            user = self._book_keeper.user(jid)
+            for account in (user[0].accounts if user else []):
+                if not account.auth_key or not account.auth_secret:
+                    continue
+                try:
+                    connectors.append(TwitterConnector(self._book_keeper, account))
+                except Exception, e:
+                    print 'Failed to add reply connector: {0}'.format(traceback.format_exc())
+            self._reply_connectors[jid] = connectors
+        return self._reply_connectors[jid]
+    
+    def _leave_search(self, key):
+        room = self._search_rooms.pop(key)
+        if not [x for x in self._search_rooms if x[0] == key[0]]:
+            # queued actions keep their connector in self._actions
+            self._reply_connectors.pop(key[0], None)
+        for feed in room['feeds']:
+            feed.subscribers.discard(key)
+            if not feed.subscribers:
+                print 'Stop search {0}'.format(feed)
+                self._search_feeds.pop(feed.key, None)
+                self.cancel_poll(feed)
+    
+    def _send_search(self, key, room, statuses, history=False):
+        cap = self._config.room_occupant_cap or _SEARCH_OCCUPANTS
+        for status in statuses:
+            mfrom = '{0}/{1}'.format(room['room'], status.tagged_name)
+            if room['occupants'].pop(status.tagged_name, None) is None:
+                if len(room['occupants']) >= cap:
+                    (gone, unused) = room['occupants'].popitem(last=False)
+                    self._send(self._make_muc_presence('{0}/{1}'.format(room['room'], gone), key[0],
+                                                       ptype='unavailable', prole='none'), 'presence')
+                self._send(self._xmpp.makePresence(pfrom=mfrom, pto=key[0]), 'presence')
+            room['occupants'][status.tagged_name] = True
+            
+            self._send(self._make_room_message(key[0], mfrom, status.body,
+                                               status.created_at if history else None), mto=key[0])
+    
+    # --- connector lifecycle
+    
+    def _set_state(self, jid, state):
+        room = self._room_map[jid]
+        print 'Connectors for {0}: {1} -> {2}'.format(jid, room['state'], state)
+        room['state'] = state
+        if state == CONNECTOR_SUSPENDED:
+            for connector in room['services']:
+                self.cancel_poll(connector)
+    
+    def _leave(self, jid, resource):
+        room = self._room_map.get(jid)
+        if not room:
+            return
+        
+        room['resources'].discard(resource)
+        if room['resources'] or room['state'] != CONNECTOR_ACTIVE:
+            return
+        
+        # the last resource is gone, nobody sees the occupants anymore
+        room['joining'] = None
+        room['left'] = time.time()
+        for connector in room['services']:
+            connector.release()
+        
+        if self._config.idle_poll_interval:
+            self._set_state(jid, CONNECTOR_IDLE)
+        else:
+            self._set_state(jid, CONNECTOR_SUSPENDED)
+    
+    def _resume(self, jid, event):
+        room = self._room_map[jid]
+        room['room'] = event['to'].bare
+        room['nick'] = event['to'].resource
+        room['left'] = None
+        self._set_state(jid, CONNECTOR_ACTIVE)
+        
+        pfrom = self._make_room_user(jid, 'Satori')
+        self._send(self._xmpp.makePresence(pfrom=pfrom, pto=event['from']), 'presence')
+        
+        # occupants changed while nobody was in the room
+        self._announce(jid)
+        if not room['services']:
+            # restored from a snapshot (or left before being admitted)
+            self._admission.put(jid, lambda: self._add_connectors(jid))
+        self._send_history(jid, HistoryRequest.from_xml(getattr(event, 'xml', None)))
+        
+        # history is already there, continue from the stored cursor in the regular slot
+        # (the occupants were released by _leave and refilled by idle polls)
+        for connector in room['services']:
+            self._poll_scheduler.schedule(connector)
+    
+    def _evict(self, jid):
+        room = self._room_map.pop(jid)
+        room['state'] = CONNECTOR_EVICTED
+        print 'Evicting {0} connectors for {1}'.format(len(room['services']), jid)
+        
+        for connector in room['services']:
+            self.cancel_poll(connector)
+            connector.drop_actions()
+            self._actions.discard(connector)
+        for store in PresenceStore.stores().values():
+            store.release(jid)
+        self._history.pop(jid, None)
+        self._book_keeper.evict(jid)
+    
+    def _announce(self, jid):
+        # occupants known from before a restart or an idle period
+        for store in PresenceStore.stores().values():
+            for (tagged_name, away) in store.occupants(jid):
+                self.send_user_presence(jid, tagged_name, not away)
+    
+    # --- admin commands
+    
+    def _add_admin_command(self, node, name, handler):
+        """
+        Register an ad-hoc command only the configured admins may execute.
+        
+        :param handler: called without arguments, returns a list of
+                        `(var, value)` tuples for the result form
+        """
+        self._admin_commands[node] = handler
+        self._xmpp.plugin['xep_0030'].add_item(self._config.jid, name, _COMMANDS_NS, node)
+    
+    def _on_command(self, xml):
+        command = xml.find('{{{0}}}command'.format(_COMMANDS_NS))
+        if command is None or not command.get('node') in self._admin_commands:
+            return
+        
+        node = command.get('node')
+        requester = sleekxmpp.xmlstream.stanzabase.JID(xml.get('from'))
+        iq = ET.Element('iq', {'type' : 'result',
+                               'id'   : xml.get('id', ''),
+                               'from' : xml.get('to'),
+                               'to'   : xml.get('from')})
+        
+        if not requester.bare in self._config.admins:
+            print 'Refused {0} command for {1}'.format(node, requester.bare)
+            iq.set('type', 'error')
+            error = ET.SubElement(iq, 'error', {'type' : 'auth'})
+            ET.SubElement(error, 'forbidden', {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-stanzas'})
+        else:
+            result = ET.SubElement(iq, 'command', {'xmlns'     : _COMMANDS_NS,
+                                                   'node'      : node,
+                                                   'status'    : 'completed',
+                                                   'sessionid' : command.get('sessionid') or str(time.time())})
+            form = ET.SubElement(result, 'x', {'xmlns' : 'jabber:x:data', 'type' : 'result'})
+            for (var, value) in self._admin_commands[node]():
+                field = ET.SubElement(form, 'field', {'var' : var})
+                ET.SubElement(field, 'value').text = unicode(value)
+        
+        self._send(ET.tostring(iq), 'iq')
+    
+    def _metrics_command(self):
+        snapshot = self._metrics.snapshot()
+        res = []
+        for (name, counter) in sorted(snapshot['counters'].items()):
+            res.append((name, '{value} ({rate}/s)'.format(**counter)))
+        for (name, histogram) in sorted(snapshot['histograms'].items()):
+            res.append((name, ', '.join(['{0}={1}'.format(k, histogram[k])
+                                         for k in ('count', 'avg', 'p50', 'p90', 'p99', 'max')
+                                         if k in histogram])))
+        for (name, gauge) in sorted(snapshot['gauges'].items()):
+            res.append((name, json.dumps(gauge)))
+        return res
+    
+    def _profile_command(self):
+        self._profiler.toggle()
+        return [('running', self._profiler.running),
+                ('last_profile', self._profiler.last_profile or ''),
+                ('stalls', self._metrics.counter('watchdog.stalls').value)]
+    
+    def _metrics_path(self):
+        if self._shard is None:
+            return os.path.join(self._config.spool, 'metrics.json')
+        return os.path.join(self._config.spool, 'metrics-shard-{0}.json'.format(self._shard))
+    
+    # --- warm restart
+    
+    def _snapshot_path(self):
+        if self._shard is None:
+            return os.path.join(self._config.spool, 'snapshot.json')
+        return os.path.join(self._config.spool, 'snapshot-shard-{0}.json'.format(self._shard))
+    
+    def _save_snapshot(self):
+        rooms = {}
+        for (jid, room) in self._room_map.items():
+            history = self._history.get(jid)
+            rooms[jid] = {'room'    : room['room'],
+                          'nick'    : room['nick'],
+                          'history' : history.snapshot() if history else []}
+        
+        presence = dict([(tag, store.snapshot())
+                         for (tag, store) in PresenceStore.stores().items()])
+        path = self._snapshot_path()
+        try:
+            with open(path + '.tmp', 'w') as snapshot:
+                json.dump({'version'  : 1,
+                           'saved'    : time.time(),
+                           'rooms'    : rooms,
+                           'presence' : presence}, snapshot)
+            os.rename(path + '.tmp', path)
+            print 'Saved snapshot of {0} rooms'.format(len(rooms))
+        except (IOError, OSError), e:
+            print 'Failed to save snapshot: {0}'.format(e)
+    
+    def _load_snapshot(self):
+        path = self._snapshot_path()
+        if not os.path.exists(path):
+            return
+        
+        try:
+            with open(path, 'r') as snapshot:
+                data = json.load(snapshot)
+        except (IOError, ValueError), e:
+            print 'Ignoring broken snapshot: {0}'.format(e)
+            return
+        finally:
+            # never restore the same snapshot twice
+            os.remove(path)
+        
+        if data.get('version') != 1:
+            return
+        
+        for (tag, rooms) in data['presence'].items():
+            PresenceStore.shared(tag, self._config.presence_ttl,
+                                 self._config.room_occupant_cap).restore(rooms)
+        
+        for (jid, entry) in data['rooms'].items():
+            room_id = sleekxmpp.xmlstream.stanzabase.JID(u'{0}/{1}'.format(entry['room'],
+                                                                            entry['nick']))
+            self._update_room_map_with_jid(jid, room_id)
+            
+            # connectors are added once the user joins again
+            self._room_map[jid]['state'] = CONNECTOR_SUSPENDED
+            self._room_map[jid]['left'] = time.time()
+            self._room_map[jid]['restored'] = data.get('saved')
+            self._history[jid] = RoomHistory(self._config.history_size,
+                                             self._config.history_chars)
+            self._history[jid].restore(entry['history'])
+        
+        self._admission.spread(len(data['rooms']), self._config.restart_window)
+        print 'Restored snapshot of {0} rooms'.format(len(data['rooms']))
+    
+    def _on_shard_release(self, jid):
+        # the user moved to another shard
+        if jid in self._room_map:
+            self._evict(jid)
+    
+    def _on_shard_release_search(self, query):
+        # the search query moved to another shard, along with all its rooms
+        for (key, room) in self._search_rooms.items():
+            if room['query'] == query:
+                self._leave_search(key)
+    
+    def _check_lifecycle(self, now=None):
+        now = now or time.time()
+        for (jid, room) in self._room_map.items():
+            if room['state'] == CONNECTOR_ACTIVE:
+                continue
+            
+            idle = now - room['left']
+            if idle > self._config.evict_after:
+                self._evict(jid)
+            elif idle > self._config.suspend_after and room['state'] == CONNECTOR_IDLE:
+                self._set_state(jid, CONNECTOR_SUSPENDED)
 
+    # --- poll scheduler
+    
+    def _poll(self, connector, show_history=False, done=None):
+        def _polled(result):
+            if done:
+                done()
+        
+        def _failed(error):
+            print 'Poll failed: {0}'.format(error)
+            self.schedule_poll(connector)
+            _polled(None)
+        
+        if self._engine:
+            self._engine.spawn(connector.key,
+                               connector.perform_updates_async(self._deferred_core,
+                                                               show_history),
+                               _polled, _failed)
+        else:
+            self._workers.submit(connector.key, connector.host,
+                                 connector.perform_updates,
+                                 (self._deferred_core, show_history),
+                                 _polled, _failed)
+    
+    # --- outbound actions
+    
+    def _run_actions(self, connector):
+        # start the next action of `connector` unless one is still running
+        action = connector.next_action()
+        if not action:
+            return
+        
+        def _performed(result):
+            self._run_actions(connector)
+        
+        def _failed(error):
+            print 'Action failed: {0}'.format(error)
+            connector.abort_action()
+            self._run_actions(connector)
+        
+        # a separate key keeps actions in order without waiting for polls
+        key = connector.key + ('actions',)
+        if self._engine:
+            self._engine.spawn(key, connector.perform_action_async(action, self._deferred_core),
+                               _performed, _failed)
+        else:
+            self._workers.submit(key, connector.host, connector.perform_action,
+                                 (action, self._deferred_core), _performed, _failed)
+    
+    def _on_poll_tick(self):
+        try:
+            # hand back anything the workers produced since the last tick
+            self._workers.drain()
+            
+            for connector in self._poll_scheduler.due():
+                self._poll(connector)
+            
+            for callback in self._admission.due():
+                callback()
+            
+            # actions held back by their rate limit or a retry back-off
+            for connector in list(self._actions):
+                if connector.pending_actions():
+                    self._run_actions(connector)
+                else:
+                    self._actions.discard(connector)
+            
+            HttpPool.prune_all()
+            
+            if time.time() - self._lifecycle_checked > _LIFECYCLE_CHECK:
+                self._lifecycle_checked = time.time()
+                self._check_lifecycle()
+            
+            late = self._poll_scheduler.lateness()
+            if late > self._config.poll_interval:
+                print 'Poll scheduler is falling behind by {0:.1f}s'.format(late)
+            
+            if self._config.metrics_interval and \
+               time.time() - self._metrics_dumped > self._config.metrics_interval:
+                self._metrics_dumped = time.time()
+                self._metrics.tick()
+                self._metrics.dump(self._metrics_path())
+            
+            # a crash should not lose more than one interval
+            if self._config.snapshot and self._config.snapshot_interval and \
+               time.time() - self._snapshot_saved > self._config.snapshot_interval:
+                self._snapshot_saved = time.time()
+                self._save_snapshot()
+        finally:
+            self.schedule(self._config.poll_tick, self._on_poll_tick, [])
+    
     # --- callbacks used by the backend connectors
     def schedule(self, delay, callback, args):
-        self._xmpp.schedule(delay, callback, args)
+        name = getattr(callback, '__name__', 'scheduled').lstrip('_')
+        self._xmpp.schedule(delay, self._watchdog.watch(name, callback), args)
+    
+    def schedule_poll(self, connector, delay=None):
+        if isinstance(connector, SearchFeed):
+            # shared searches are polled as long as anybody is subscribed
+            if self._search_feeds.get(connector.key) is not connector:
+                return None
+            return self._poll_scheduler.schedule(connector, delay)
+        
+        room = self._room_map.get(connector.key[0])
+        if not room or room['state'] not in (CONNECTOR_ACTIVE, CONNECTOR_IDLE):
+            # suspended or evicted, polling resumes with the next join
+            return None
+        
+        if room['state'] == CONNECTOR_IDLE:
+            delay = max(delay or self._config.poll_interval, self._config.idle_poll_interval)
+        return self._poll_scheduler.schedule(connector, delay)
+    
+    def cancel_poll(self, connector):
+        self._poll_scheduler.remove(connector)
+    
+    def poll_stats(self):
+        return self._poll_scheduler.stats()
+    
+    def lifecycle_stats(self):
+        """
+        :returns: a dict mapping each connector state to its number of connectors
+        """
+        res = dict([(x, 0) for x in (CONNECTOR_ACTIVE, CONNECTOR_IDLE, CONNECTOR_SUSPENDED)])
+        for room in self._room_map.values():
+            res[room['state']] += len(room['services'])
+        return res
+    
+    def outbound_stats(self):
+        return self._writer.stats()
     
     def send_room_message(self, mto, mfrom, mbody, mpubdate=None):
         mfrom = 'Satori' if not mfrom else mfrom
@@ -194,34 +1073,87 @@ class Core(object):
             print 'mfrom == None'
             return
         
-        message = self._xmpp.makeMessage(mto, mbody, None, 'groupchat', None, mfrom)#mbody, mfrom)
-        if mpubdate:
-            delay = ET.Element('{urn:xmpp:delay}delay',
-                               {'from' : mfrom,
-                                'stamp': mpubdate.isoformat().split('.')[0] + 'Z'
-                               })
-            message.append(delay)
-        self._xmpp.send(message)
+        jid = mto if type(mto) in (str, unicode) else mto.bare
+        history = self._history.get(jid)
+        if history is not None:
+            history.append(mpubdate or datetime.datetime.utcnow(),
+                           mfrom.split('/', 1)[1], mbody)
+            if mpubdate and self._room_map[jid]['joining']:
+                # sent from the buffer once the join is complete
+                return
+        
+        if self._room_map[jid]['state'] != CONNECTOR_ACTIVE:
+            # idle rooms only fill their history
+            return
+        
+        self._send(self._make_room_message(mto, mfrom, mbody, mpubdate), mto=mto)
         
 
     def send_user_message(self, mto, mfrom, mbody, mpubdate=None):
         mfrom = 'Satori' if not mfrom else mfrom
         mfrom = self._make_room_user(mto, mfrom)
         
-        self._xmpp.sendMessage(mto, mbody, None, 'chat', None, mfrom)#mbody, mfrom)
+        self._send(self._xmpp.makeMessage(mto, mbody, None, 'chat', None, mfrom), mto=mto)
 
-    def send_user_presence(self, mto, mfrom, is_present):
+    def send_search_results(self, feed, statuses, history=False):
+        """
+        Fan out new results of `feed` to all subscribed search rooms.
+        """
+        for key in list(feed.subscribers):
+            room = self._search_rooms.get(key)
+            if room:
+                self._send_search(key, room, statuses, history)
+    
+    def send_search_message(self, mto, room, mbody):
+        """
+        Send a notice from Satori to the search room `room` of `mto`.
+        """
+        if not (mto, room) in self._search_rooms:
+            return
+        self._send(self._xmpp.makeMessage(mto, mbody, None, 'groupchat', None,
+                                          '{0}/Satori'.format(room)), mto=mto)
+    
+    def send_user_presence(self, mto, mfrom, is_present, is_gone=False):
         mfrom = 'Satori' if not mfrom else mfrom
         mfrom = self._make_room_user(mto, mfrom)
         
-        if is_present:
-            self._xmpp.sendPresence(pfrom=mfrom, pto=mto)
+        room = self._room_map.get(mto if type(mto) in (str, unicode) else mto.bare)
+        if not room or room['state'] != CONNECTOR_ACTIVE:
+            return
+        
+        if is_gone:
+            self._send(self._make_muc_presence(mfrom, mto, ptype='unavailable',
+                                               prole='none'), 'presence')
+        elif is_present:
+            self._send(self._xmpp.makePresence(pfrom=mfrom, pto=mto), 'presence')
         else:
-            self._xmpp.sendPresence(pfrom=mfrom, pto=mto, ptype='xa')
+            self._send(self._xmpp.makePresence(pfrom=mfrom, pto=mto, ptype='xa'), 'presence')
 
+    def _on_terminate(self, signum, frame):
+        # `satori-mb stop` sends SIGTERM, unwind so run() can flush and save
+        print 'Terminated, shutting down'
+        raise SystemExit(0)
+    
     def run(self):
         if self._xmpp.connect():
-            self._xmpp.process(threaded=False)
+            if self._engine:
+                self._engine.start()
+            self._writer.start()
+            self._watchdog.start()
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self._profiler.toggle())
+            signal.signal(signal.SIGTERM, self._on_terminate)
+            if self._config.profile:
+                self._profiler.start()
+            self.schedule(self._config.poll_tick, self._on_poll_tick, [])
+            try:
+                self._xmpp.process(threaded=False)
+            finally:
+                self._profiler.stop()
+                if self._config.snapshot:
+                    self._save_snapshot()
+                self._book_keeper.close()
+                TimelineArchive.close_all()
+                TraceRecorder.stop()
         else:
             raise RuntimeError('Connection to server failed.')
 
@@ -243,14 +1175,39 @@ def Run():
     
     if 'start' in args[0]:
         daemon.start()
-        core = Core()
-        core.run()
+        config = Config.get().core
+        if config.shards:
+            # prepare the database once, before any shard touches it
+            book_keeper = BookKeeper(os.path.join(spool_dir, 'bookkeeper.db'))
+            book_keeper.reflect_services(config)
+            book_keeper.migrate_cursors()
+            book_keeper.close()
+            
+            router = ShardRouter(config, config.shards, config.shard_replicas)
+            router.run()
+        else:
+            core = Core()
+            core.run()
     
     elif 'stop' in args[0]:
         daemon.stop()
         
     elif 'status' in args[0]:
         daemon.status()
+    
+    elif 'reload' in args[0]:
+        # a sharded front process resizes to the configured shard count
+        try:
+            with open(daemon.pid, 'r') as pidfile:
+                os.kill(int(pidfile.readline()), signal.SIGHUP)
+        except (IOError, OSError, ValueError), e:
+            print 'Reload failed: {0}'.format(e)
+    
+    elif 'migrate' in args[0]:
+        # convert an existing bookkeeper.db in place
+        book_keeper = BookKeeper(os.path.join(spool_dir, 'bookkeeper.db'))
+        print 'Migrated cursors for {0} accounts'.format(book_keeper.migrate_cursors())
+        book_keeper.close()
     else:
         print 'Wut?'
         print args
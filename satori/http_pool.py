@@ -0,0 +1,274 @@
+# encoding: utf-8
+#
+#  http_pool.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import socket
+import select
+import httplib
+import functools
+import threading
+
+class _PooledConnection(object):
+    """
+    Stand-in for :class:`httplib.HTTPConnection` as used by tweepy's binder.
+    
+    `close()` hands the underlying connection back to the pool as long as
+    the last response was read completely and the server allows keep-alive.
+    """
+    
+    def __init__(self, pool, host, timeout=None):
+        self._pool = pool
+        self._host = host
+        self._timeout = timeout
+        self._conn = None
+        self._reused = False
+        self._request = None
+        self._response = None
+    
+    def request(self, method, url, body=None, headers={}):
+        (self._conn, self._reused) = self._pool.acquire(self._host, self._timeout)
+        self._request = (method, url, body, headers)
+        try:
+            self._conn.request(method, url, body, headers)
+        except (socket.error, httplib.HTTPException):
+            if not self._reused:
+                raise
+            self._retry()
+    
+    def _retry(self):
+        # the server dropped a keep-alive connection, try once on a fresh one
+        self._pool.discard(self._conn)
+        (self._conn, self._reused) = self._pool.acquire(self._host, self._timeout, fresh=True)
+        self._conn.request(*self._request)
+    
+    def getresponse(self):
+        try:
+            self._response = self._conn.getresponse()
+        except (socket.error, httplib.BadStatusLine):
+            if not self._reused:
+                raise
+            self._retry()
+            self._response = self._conn.getresponse()
+        return self._response
+    
+    def close(self):
+        if not self._conn:
+            return
+        
+        if self._response and self._response.isclosed() and not self._response.will_close:
+            self._pool.release(self._conn)
+        else:
+            self._pool.discard(self._conn)
+        self._conn = None
+        self._response = None
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class HttpPool(object):
+    """
+    Persistent keep-alive connections shared by all accounts of a service.
+    
+    Pools are keyed on `(apiHost, useHttps)`, use :meth:`HttpPool.get` to
+    obtain the shared instance. Up to `size` idle connections are kept,
+    connections idle for longer than `idle_timeout` are closed and
+    connections idle for longer than `health_check` are probed before reuse.
+    """
+    
+    _pools = {}
+    _pools_lock = threading.Lock()
+    
+    @classmethod
+    def get(cls, host, secure, size=4, idle_timeout=60, health_check=30):
+        with cls._pools_lock:
+            if not (host, secure) in cls._pools:
+                cls._pools[(host, secure)] = HttpPool(host, secure, size,
+                                                      idle_timeout, health_check)
+            return cls._pools[(host, secure)]
+    
+    @classmethod
+    def prune_all(cls):
+        with cls._pools_lock:
+            pools = cls._pools.values()
+        for pool in pools:
+            pool.prune()
+    
+    @classmethod
+    def stats_all(cls):
+        """
+        :returns: :meth:`stats` of every pool keyed on its base URL
+        """
+        with cls._pools_lock:
+            return dict([('{0}://{1}'.format('https' if secure else 'http', host), pool.stats())
+                         for ((host, secure), pool) in cls._pools.items()])
+    
+    def __init__(self, host, secure, size=4, idle_timeout=60, health_check=30):
+        self.host = host
+        self.secure = secure
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._health_check = health_check
+        self._idle = []         # list of (last_used, connection)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._reused = 0
+        self._closed = 0
+    
+    def _healthy(self, conn, idle_for):
+        if idle_for > self._idle_timeout:
+            return False
+        if idle_for > self._health_check:
+            # an idle keep-alive socket must not be readable,
+            # if it is the server either closed it or sent garbage
+            try:
+                (readable, writable, failed) = select.select([conn.sock], [], [conn.sock], 0)
+                return not readable and not failed
+            except (socket.error, select.error, TypeError):
+                return False
+        return True
+    
+    def acquire(self, host, timeout=None, fresh=False):
+        """
+        :returns: a tuple `(connection, reused)`
+        """
+        now = time.time()
+        with self._lock:
+            while self._idle and not fresh:
+                (last_used, conn) = self._idle.pop()
+                if self._healthy(conn, now - last_used):
+                    self._reused += 1
+                    return (conn, True)
+                conn.close()
+                self._closed += 1
+            self._opened += 1
+        
+        if self.secure:
+            return (httplib.HTTPSConnection(host, timeout=timeout), False)
+        return (httplib.HTTPConnection(host, timeout=timeout), False)
+    
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append((time.time(), conn))
+                return
+            self._closed += 1
+        conn.close()
+    
+    def discard(self, conn):
+        with self._lock:
+            self._closed += 1
+        conn.close()
+    
+    def prune(self):
+        """
+        Close all idle connections which exceeded the idle timeout.
+        """
+        now = time.time()
+        with self._lock:
+            stale = [x for x in self._idle if now - x[0] > self._idle_timeout]
+            self._idle = [x for x in self._idle if now - x[0] <= self._idle_timeout]
+            self._closed += len(stale)
+        for (last_used, conn) in stale:
+            conn.close()
+    
+    def stats(self):
+        with self._lock:
+            return {'opened' : self._opened,
+                    'reused' : self._reused,
+                    'closed' : self._closed,
+                    'idle'   : len(self._idle)}
+
+class _PooledHttplib(object):
+    """
+    Replacement for the `httplib` module reference inside tweepy's binder.
+    """
+    
+    def __init__(self, pools):
+        self._pools = pools
+        self._local = threading.local()
+    
+    def _connection(self, secure, host, timeout=None, **kwargs):
+        pool = self._pools.get((host, secure))
+        if not pool:
+            # not a configured service host - no pooling
+            if secure:
+                return httplib.HTTPSConnection(host, timeout=timeout, **kwargs)
+            return httplib.HTTPConnection(host, timeout=timeout, **kwargs)
+        conn = _PooledConnection(pool, host, timeout)
+        self._opened().append(conn)
+        return conn
+    
+    def _opened(self):
+        if not hasattr(self._local, 'opened'):
+            self._local.opened = []
+        return self._local.opened
+    
+    def close_opened(self):
+        """
+        Hand back every connection this thread opened and didn't close yet
+        (tweepy raises on error responses before closing its connection).
+        """
+        opened = self._opened()
+        while opened:
+            opened.pop().close()
+    
+    def HTTPConnection(self, host, *args, **kwargs):
+        return self._connection(False, host, *args, **kwargs)
+    
+    def HTTPSConnection(self, host, *args, **kwargs):
+        return self._connection(True, host, *args, **kwargs)
+    
+    def __getattr__(self, name):
+        return getattr(httplib, name)
+
+def _closing(call, pooled):
+    @functools.wraps(call)
+    def _call(*args, **kwargs):
+        try:
+            return call(*args, **kwargs)
+        finally:
+            pooled.close_opened()
+    _call.pooled = True
+    return _call
+
+def install(binder, api=None):
+    """
+    Route all connections opened by `binder` (tweepy.binder) through the
+    shared pools. With `api` (tweepy.API) given, every bound API method
+    releases its connections even if the binder raised. Safe to call more
+    than once.
+    """
+    if not isinstance(binder.httplib, _PooledHttplib):
+        binder.httplib = _PooledHttplib(HttpPool._pools)
+    
+    if api is None:
+        return
+    for (name, call) in api.__dict__.items():
+        if getattr(call, '__name__', None) == '_call' and not getattr(call, 'pooled', False):
+            setattr(api, name, _closing(call, binder.httplib))
@@ -0,0 +1,186 @@
+# encoding: utf-8
+#
+#  metrics.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import json
+import time
+import bisect
+import threading
+
+# upper bounds of the histogram buckets in seconds
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+            0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+class Counter(object):
+    __slots__ = ('value', 'rate', '_last', '_lock')
+    
+    def __init__(self):
+        self.value = 0
+        self.rate = 0.0
+        self._last = 0
+        self._lock = threading.Lock()
+    
+    def inc(self, count=1):
+        with self._lock:
+            self.value += count
+    
+    def _tick(self, elapsed):
+        with self._lock:
+            self.rate = (self.value - self._last) / elapsed if elapsed > 0 else 0.0
+            self._last = self.value
+    
+    def snapshot(self):
+        return {'value' : self.value,
+                'rate'  : round(self.rate, 3)}
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets.
+    
+    Percentiles are reported as the upper bound of the bucket they fall
+    into, which is plenty to spot a slow API or a stalled database.
+    """
+    
+    __slots__ = ('count', 'total', 'max', '_buckets', '_lock')
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = [0] * len(_BUCKETS)
+        self._lock = threading.Lock()
+    
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self._buckets[bisect.bisect_left(_BUCKETS, seconds)] += 1
+    
+    def _percentile(self, fraction):
+        # caller holds self._lock
+        rank = fraction * self.count
+        seen = 0
+        for (bound, count) in zip(_BUCKETS, self._buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+    
+    def snapshot(self):
+        with self._lock:
+            if not self.count:
+                return {'count' : 0}
+            return {'count' : self.count,
+                    'avg'   : round(self.total / self.count, 6),
+                    'max'   : round(self.max, 6),
+                    'p50'   : self._percentile(0.5),
+                    'p90'   : self._percentile(0.9),
+                    'p99'   : self._percentile(0.99)}
+
+class Metrics(object):
+    """
+    Process wide registry of counters, latency histograms and gauges.
+    
+    Counters and histograms are created on first use, gauges are
+    callables evaluated whenever a snapshot is taken. Counter rates are
+    per second between the last two calls to :meth:`tick`.
+    """
+    
+    _shared = None
+    _shared_lock = threading.Lock()
+    
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if not cls._shared:
+                cls._shared = Metrics()
+            return cls._shared
+    
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._ticked = time.time()
+        self._lock = threading.Lock()
+    
+    def counter(self, name):
+        with self._lock:
+            if not name in self._counters:
+                self._counters[name] = Counter()
+            return self._counters[name]
+    
+    def histogram(self, name):
+        with self._lock:
+            if not name in self._histograms:
+                self._histograms[name] = Histogram()
+            return self._histograms[name]
+    
+    def gauge(self, name, func):
+        with self._lock:
+            self._gauges[name] = func
+    
+    def tick(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            (elapsed, self._ticked) = (now - self._ticked, now)
+            counters = self._counters.values()
+        for counter in counters:
+            counter._tick(elapsed)
+    
+    def snapshot(self):
+        """
+        :returns: all metrics as JSON serializable dict
+        """
+        with self._lock:
+            counters = self._counters.items()
+            histograms = self._histograms.items()
+            gauges = self._gauges.items()
+        
+        res = {'time'       : time.time(),
+               'counters'   : dict([(k, v.snapshot()) for (k, v) in counters]),
+               'histograms' : dict([(k, v.snapshot()) for (k, v) in histograms]),
+               'gauges'     : {}}
+        for (name, func) in gauges:
+            try:
+                res['gauges'][name] = func()
+            except Exception, e:
+                res['gauges'][name] = None
+        return res
+    
+    def dump(self, path):
+        """
+        Atomically write a snapshot to `path`.
+        """
+        try:
+            with open(path + '.tmp', 'w') as stats:
+                json.dump(self.snapshot(), stats, indent=1, sort_keys=True)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            print 'Failed to write metrics: {0}'.format(e)
@@ -0,0 +1,223 @@
+# encoding: utf-8
+#
+#  presence_store.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import datetime
+import threading
+
+_AWAY_AFTER = datetime.timedelta(0, 300, 0)
+
+def _intern(value):
+    # intern() only takes byte strings, keep non-ascii names as they are
+    try:
+        return intern(str(value))
+    except UnicodeError:
+        return value
+
+class _Author(object):
+    __slots__ = ('screen_name', 'tagged_name', 'refs')
+    
+    def __init__(self, screen_name, tagged_name):
+        self.screen_name = screen_name
+        self.tagged_name = tagged_name
+        self.refs = 0
+
+class _Occupant(object):
+    __slots__ = ('author', 'away', 'last', 'seen')
+    
+    def __init__(self, author, stamp, seen):
+        self.author = author
+        self.away = False
+        self.last = stamp
+        self.seen = seen
+
+class PresenceStore(object):
+    """
+    Presence state of all authors shown as room occupants for one service.
+    
+    Author records (with interned screen and display names) are shared by
+    all rooms, every room only keeps a small per-occupant record. Occupants
+    which didn't post for `ttl` seconds are evicted by :meth:`expire` and at
+    most `room_cap` occupants are kept per room (0 means no limit).
+    """
+    
+    _stores = {}
+    _stores_lock = threading.Lock()
+    
+    @classmethod
+    def shared(cls, tag, ttl=86400, room_cap=0):
+        with cls._stores_lock:
+            if not tag in cls._stores:
+                cls._stores[tag] = PresenceStore(tag, ttl, room_cap)
+            return cls._stores[tag]
+    
+    @classmethod
+    def stores(cls):
+        """
+        :returns: a dict of all shared stores by service tag
+        """
+        with cls._stores_lock:
+            return dict(cls._stores)
+    
+    def __init__(self, tag, ttl=86400, room_cap=0):
+        self._tag = tag
+        self._ttl = ttl
+        self._room_cap = room_cap
+        self._authors = {}
+        self._rooms = {}
+        self._lock = threading.Lock()
+    
+    def _author(self, screen_name, name, changes):
+        # caller holds self._lock
+        author = self._authors.get(screen_name)
+        tagged_name = u'{1}| {0}'.format(name, self._tag)
+        if not author:
+            screen_name = _intern(screen_name)
+            author = self._authors[screen_name] = _Author(screen_name, None)
+        if author.tagged_name != tagged_name:
+            previous = author.tagged_name
+            author.tagged_name = _intern(tagged_name)
+            if previous:
+                # the display name changed, replace the old nick in every room
+                for (jid, room) in self._rooms.items():
+                    occupant = room.get(author.screen_name)
+                    if occupant:
+                        changes.append((jid, previous, 'gone'))
+                        changes.append((jid, author.tagged_name,
+                                        'away' if occupant.away else 'present'))
+        return author
+    
+    def _drop(self, room, screen_name):
+        # caller holds self._lock
+        occupant = room.pop(screen_name)
+        occupant.author.refs -= 1
+        if not occupant.author.refs:
+            del self._authors[occupant.author.screen_name]
+        return occupant.author.tagged_name
+    
+    def update(self, jid, screen_name, name, stamp):
+        """
+        Record a status by `screen_name` created at `stamp` for room `jid`.
+        
+        :returns: a list of `(jid, tagged_name, state)` presence changes to
+                  send, state is one of 'present', 'away' or 'gone'. A
+                  changed display name affects every room of that author.
+        """
+        changes = []
+        with self._lock:
+            room = self._rooms.setdefault(jid, {})
+            occupant = room.get(screen_name)
+            if not occupant:
+                if self._room_cap and len(room) >= self._room_cap:
+                    # make room by dropping the longest idle occupant
+                    idle = min(room.values(), key=lambda x: x.seen)
+                    changes.append((jid, self._drop(room, idle.author.screen_name), 'gone'))
+                
+                author = self._author(screen_name, name, changes)
+                author.refs += 1
+                occupant = room[author.screen_name] = _Occupant(author, stamp, time.time())
+                changes.append((jid, author.tagged_name, 'present'))
+            else:
+                self._author(screen_name, name, changes)
+            
+            if occupant.last - stamp > _AWAY_AFTER:
+                if not occupant.away:
+                    occupant.away = True
+                    changes.append((jid, occupant.author.tagged_name, 'away'))
+            elif occupant.away:
+                occupant.away = False
+                changes.append((jid, occupant.author.tagged_name, 'present'))
+            
+            occupant.last = stamp
+            occupant.seen = time.time()
+        return changes
+    
+    def expire(self, jid, now=None):
+        """
+        Evict all occupants of `jid` idle for longer than the TTL.
+        
+        :returns: a list of evicted tagged names
+        """
+        now = now or time.time()
+        with self._lock:
+            room = self._rooms.get(jid, {})
+            return [self._drop(room, screen_name) for (screen_name, occupant) in room.items()
+                    if now - occupant.seen > self._ttl]
+    
+    def release(self, jid):
+        """
+        Forget everything about room `jid` (e.g. once the user left).
+        """
+        with self._lock:
+            room = self._rooms.get(jid, {})
+            for screen_name in room.keys():
+                self._drop(room, screen_name)
+            self._rooms.pop(jid, None)
+    
+    def occupants(self, jid):
+        """
+        :returns: a list of `(tagged_name, away)` tuples for room `jid`
+        """
+        with self._lock:
+            return [(x.author.tagged_name, x.away) for x in self._rooms.get(jid, {}).values()]
+    
+    def snapshot(self):
+        """
+        :returns: all rooms as JSON serializable dict (e.g. for a warm restart)
+        """
+        with self._lock:
+            return dict([(jid, [(x.author.screen_name, x.author.tagged_name,
+                                 x.last.isoformat().split('.')[0], x.away) for x in room.values()])
+                         for (jid, room) in self._rooms.items()])
+    
+    def restore(self, rooms):
+        """
+        Restore the rooms returned by :meth:`snapshot`.
+        """
+        now = time.time()
+        with self._lock:
+            for (jid, occupants) in rooms.items():
+                room = self._rooms.setdefault(jid, {})
+                for (screen_name, tagged_name, last, away) in occupants:
+                    if screen_name in room:
+                        continue
+                    author = self._authors.get(screen_name)
+                    if not author:
+                        screen_name = _intern(screen_name)
+                        author = self._authors[screen_name] = _Author(screen_name, _intern(tagged_name))
+                    author.refs += 1
+                    occupant = room[screen_name] = _Occupant(author,
+                                    datetime.datetime.strptime(last, '%Y-%m-%dT%H:%M:%S'), now)
+                    occupant.away = away
+    
+    def stats(self):
+        with self._lock:
+            return {'authors'   : len(self._authors),
+                    'rooms'     : len(self._rooms),
+                    'occupants' : sum([len(x) for x in self._rooms.values()])}
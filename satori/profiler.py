@@ -0,0 +1,214 @@
+# encoding: utf-8
+#
+#  profiler.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import time
+import thread
+import threading
+import traceback
+
+from metrics import Metrics
+
+class Watchdog(object):
+    """
+    Detects handlers blocking the XMPP thread.
+    
+    Callables wrapped by :meth:`watch` record their run time in the
+    `handler.<name>` histogram. A monitor thread checks the running
+    handlers twice per `threshold` and dumps the stack of every handler
+    running longer than that to `log_path` (and stdout).
+    """
+    
+    def __init__(self, threshold=2.0, log_path=None):
+        self._threshold = threshold
+        self._log_path = log_path
+        self._running = {}      # thread id -> [name, start, reported]
+        self._lock = threading.Lock()
+        self._metrics = Metrics.shared()
+        self._thread = None
+    
+    def start(self):
+        if not self._threshold or self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='satori-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def watch(self, name, func):
+        """
+        :returns: `func` wrapped to be watched under `name`
+        """
+        if not self._threshold:
+            return func
+        
+        histogram = self._metrics.histogram('handler.{0}'.format(name))
+        def _watched(*args, **kwargs):
+            ident = thread.get_ident()
+            entry = [name, time.time(), False]
+            with self._lock:
+                outer = self._running.get(ident)
+                self._running[ident] = entry
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - entry[1]
+                with self._lock:
+                    if outer:
+                        self._running[ident] = outer
+                    else:
+                        del self._running[ident]
+                histogram.observe(elapsed)
+                if entry[2]:
+                    print 'Handler {0} finished after {1:.2f}s'.format(name, elapsed)
+        
+        _watched.__name__ = getattr(func, '__name__', name)
+        return _watched
+    
+    def _run(self):
+        while True:
+            time.sleep(self._threshold / 2.0)
+            
+            now = time.time()
+            with self._lock:
+                stalled = [(ident, entry) for (ident, entry) in self._running.items()
+                           if not entry[2] and now - entry[1] > self._threshold]
+                for (ident, entry) in stalled:
+                    entry[2] = True
+            
+            if stalled:
+                frames = sys._current_frames()
+                for (ident, entry) in stalled:
+                    self._report(entry[0], now - entry[1], frames.get(ident))
+    
+    def _report(self, name, elapsed, frame):
+        self._metrics.counter('watchdog.stalls').inc()
+        report = 'Handler {0} stalled for {1:.2f}s at {2}:\n{3}'.format(
+                    name, elapsed, time.strftime('%Y-%m-%d %H:%M:%S'),
+                    ''.join(traceback.format_stack(frame)) if frame else '  (no stack)\n')
+        print report
+        
+        if self._log_path:
+            try:
+                with open(self._log_path, 'a') as log:
+                    log.write(report + '\n')
+            except IOError, e:
+                print 'Failed to write stall report: {0}'.format(e)
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler sampling the stacks of all threads.
+    
+    Every `interval` seconds the current frame of each thread is
+    recorded. Samples are aggregated in memory and written to
+    `spool/profile-<time>.txt` in collapsed stack format (one
+    `thread;outer;...;inner count` line per distinct stack) when the
+    profiler is stopped, ready for flamegraph.pl or similar tools.
+    """
+    
+    def __init__(self, spool, interval=0.01):
+        self._spool = spool
+        self._interval = interval
+        self._samples = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self.last_profile = None
+    
+    @property
+    def running(self):
+        return self._thread is not None
+    
+    def start(self):
+        if self._thread:
+            return
+        self._samples = {}
+        self._started = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='satori-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        print 'Profiler started'
+    
+    def stop(self):
+        """
+        :returns: the path of the written profile
+        """
+        if not self._thread:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.last_profile = self._write()
+        print 'Profiler stopped, wrote {0}'.format(self.last_profile)
+        return self.last_profile
+    
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+    
+    def _run(self):
+        own = thread.get_ident()
+        while not self._stop.is_set():
+            names = dict([(x.ident, x.name) for x in threading.enumerate()])
+            for (ident, frame) in sys._current_frames().items():
+                if ident == own:
+                    continue
+                
+                # raw code locations, formatting is left to _write()
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                
+                key = (names.get(ident, str(ident)), tuple(stack))
+                self._samples[key] = self._samples.get(key, 0) + 1
+            self._stop.wait(self._interval)
+    
+    def _write(self):
+        path = os.path.join(self._spool, 'profile-{0}.txt'.format(
+                                time.strftime('%Y%m%d-%H%M%S', time.localtime(self._started))))
+        try:
+            # different code objects may collapse into the same line
+            lines = {}
+            for ((name, stack), count) in self._samples.items():
+                line = ';'.join([name] + ['{0}:{1}'.format(os.path.basename(x[0]), x[2])
+                                          for x in reversed(stack)])
+                lines[line] = lines.get(line, 0) + count
+            
+            with open(path, 'w') as profile:
+                for (line, count) in sorted(lines.items(), key=lambda x: -x[1]):
+                    profile.write('{0} {1}\n'.format(line, count))
+        except IOError, e:
+            print 'Failed to write profile: {0}'.format(e)
+            return None
+        return path
@@ -0,0 +1,166 @@
+# encoding: utf-8
+#
+#  room_history.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import datetime
+from collections import deque
+
+_MUC_NS = '{http://jabber.org/protocol/muc}'
+
+def _parse_stamp(value):
+    # XEP-0082 DateTime, fractions and offsets other than 'Z' are ignored
+    value = value.strip().rstrip('Z').split('.')[0].split('+')[0]
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+class HistoryRequest(object):
+    """
+    The `<history/>` limits a client sent along with its MUC join.
+    
+    Missing limits are `None`, a join without `<history/>` element
+    gets whatever the room buffer holds.
+    """
+    
+    __slots__ = ('max_stanzas', 'max_chars', 'seconds', 'since')
+    
+    def __init__(self, max_stanzas=None, max_chars=None, seconds=None, since=None):
+        self.max_stanzas = max_stanzas
+        self.max_chars = max_chars
+        self.seconds = seconds
+        self.since = since
+    
+    @classmethod
+    def from_xml(cls, xml):
+        """
+        Parse the history request of a join presence.
+        
+        :param xml: the presence element
+        :returns: a :class:`HistoryRequest` (invalid attributes are ignored)
+        """
+        request = cls()
+        history = xml.find('{0}x/{0}history'.format(_MUC_NS)) if xml is not None else None
+        if history is None:
+            return request
+        
+        for (attr, name) in (('maxstanzas', 'max_stanzas'),
+                             ('maxchars', 'max_chars'),
+                             ('seconds', 'seconds')):
+            try:
+                value = history.get(attr)
+                if value is not None:
+                    setattr(request, name, max(0, int(value)))
+            except ValueError:
+                print 'Ignoring invalid history {0}: {1}'.format(attr, value)
+        
+        try:
+            if history.get('since'):
+                request.since = _parse_stamp(history.get('since'))
+        except ValueError:
+            print 'Ignoring invalid history since: {0}'.format(history.get('since'))
+        return request
+    
+    @property
+    def wants_history(self):
+        return self.max_stanzas != 0 and self.max_chars != 0 and self.seconds != 0
+
+class RoomHistory(object):
+    """
+    Bounded ring buffer of the most recent groupchat messages of one room.
+    
+    At most `max_stanzas` entries and `max_chars` characters of message
+    bodies are kept, the oldest entries are dropped first. Entries are
+    `(stamp, nick, body)` tuples with `stamp` as naive UTC datetime.
+    """
+    
+    def __init__(self, max_stanzas=50, max_chars=65536):
+        self._max_chars = max_chars
+        self._entries = deque(maxlen=max_stanzas)
+        self._chars = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def append(self, stamp, nick, body):
+        if self._entries and len(self._entries) == self._entries.maxlen:
+            self._chars -= len(self._entries[0][2])
+        self._entries.append((stamp, nick, body))
+        self._chars += len(body)
+        
+        while self._chars > self._max_chars and len(self._entries) > 1:
+            self._chars -= len(self._entries.popleft()[2])
+    
+    def select(self, request, now=None):
+        """
+        Pick the entries matching `request`.
+        
+        `maxchars` is counted on message bodies rather than on the
+        serialized stanzas.
+        
+        :param request: a :class:`HistoryRequest`
+        :param now:     reference time for `seconds` (defaults to utcnow)
+        :returns: a list of `(stamp, nick, body)` tuples, oldest first
+        """
+        if not request.wants_history:
+            return []
+        
+        cutoff = request.since
+        if request.seconds is not None:
+            now = now or datetime.datetime.utcnow()
+            start = now - datetime.timedelta(0, request.seconds)
+            cutoff = max(cutoff, start) if cutoff else start
+        
+        res = []
+        chars = 0
+        for entry in reversed(self._entries):
+            if request.max_stanzas is not None and len(res) >= request.max_stanzas:
+                break
+            if cutoff and entry[0] < cutoff:
+                break
+            chars += len(entry[2])
+            if request.max_chars is not None and chars > request.max_chars:
+                break
+            res.append(entry)
+        res.reverse()
+        return res
+    
+    def snapshot(self):
+        """
+        :returns: all entries as JSON serializable list (e.g. for a warm restart)
+        """
+        return [(x[0].isoformat().split('.')[0], x[1], x[2]) for x in self._entries]
+    
+    def restore(self, entries):
+        """
+        Append the entries returned by :meth:`snapshot`.
+        """
+        for (stamp, nick, body) in entries:
+            self.append(_parse_stamp(stamp), nick, body)
+    
+    def stats(self):
+        return {'stanzas' : len(self._entries),
+                'chars'   : self._chars}
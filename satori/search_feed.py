@@ -0,0 +1,223 @@
+# encoding: utf-8
+#
+#  search_feed.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import json
+import urllib
+import datetime
+import threading
+from collections import deque
+from email.utils import parsedate
+
+import tweepy
+from async_engine import AsyncError, HttpRequest, split_host
+from http_pool import HttpPool
+from config import Config
+from status_cache import CachedStatus, StatusCache
+from metrics import Metrics
+import http_pool
+
+# XEP-0106 escapes usable in a room name
+_ESCAPES = [('\\20', ' '), ('\\22', '"'), ('\\26', '&'), ('\\27', "'"), ('\\2f', '/'),
+            ('\\3a', ':'), ('\\3c', '<'), ('\\3e', '>'), ('\\40', '@'), ('\\5c', '\\')]
+
+def room_query(node):
+    """
+    Return the search query tracked by the room named `node`.
+    
+    Rooms starting with '#' track that hashtag, rooms starting with
+    'search.' track the rest of the name. Spaces and other characters not
+    allowed in a JID are written as XEP-0106 escapes (``search.satori\\20xmpp``).
+    
+    :returns: the query or None if `node` is no search room
+    """
+    if not node:
+        return None
+    if node.startswith('#'):
+        query = node
+    elif node.startswith('search.'):
+        query = node[len('search.'):]
+    else:
+        return None
+    
+    for (escaped, char) in _ESCAPES:
+        query = query.replace(escaped, char)
+    return normalize_query(query)
+
+def normalize_query(query):
+    """
+    Normalise `query` so trivially different spellings share one poll.
+    
+    Terms are lower-cased (the search is case-insensitive anyway) and
+    duplicate white-space is dropped. Unless the query contains a phrase
+    or an OR the terms are also de-duplicated and sorted.
+    
+    :returns: the normalised query or None if it is empty
+    """
+    terms = [x if x == 'OR' else x.lower() for x in query.split()]
+    if not terms:
+        return None
+    if not '"' in query and not 'OR' in terms:
+        terms = sorted(set(terms))
+    return ' '.join(terms)
+
+class SearchFeed(object):
+    """
+    Shared poll of one search query on one service.
+    
+    Every distinct `(service tag, query)` is polled once per interval no
+    matter how many rooms track it, the feed keeps its own since_id
+    cursor and hands new results to :meth:`Core.send_search_results`
+    which fans them out to all subscribed rooms. The last results are
+    kept to give newly joined rooms something to read.
+    """
+    
+    def __init__(self, service_data, query, interval=60, recent=20):
+        self._service_data = service_data
+        self._query = query
+        self._interval = interval
+        self._since_id = None
+        self._recent = deque(maxlen=recent)
+        self._lock = threading.Lock()
+        self._status_cache = StatusCache.shared(Config.get().core.status_cache_size)
+        self._metrics = Metrics.shared()
+        self.subscribers = set()
+        
+        self._host = service_data['searchHost']
+        self._root = (service_data['searchRoot'] or '').rstrip('/')
+        self._secure = service_data['useHttps']
+        
+        http_pool.install(tweepy.binder)
+        HttpPool.get(self._host, self._secure,
+                     service_data['poolSize'],
+                     service_data['poolIdleTimeout'],
+                     service_data['poolHealthCheck'])
+        # the search API doesn't need any authentication
+        self._api = tweepy.API(None, host=service_data['apiHost'],
+                               api_root=service_data['apiRoot'].rstrip('/'),
+                               search_host=self._host, search_root=self._root,
+                               secure=self._secure)
+    
+    def __repr__(self):
+        return '<SearchFeed({0}, "{1}", subscribers={2})>'.format(self._service_data['tag'],
+                                                                 self._query,
+                                                                 len(self.subscribers))
+    
+    @property
+    def key(self):
+        return ('search', self._service_data['tag'], self._query)
+    
+    @property
+    def host(self):
+        return self._host
+    
+    @property
+    def query(self):
+        return self._query
+    
+    def recent(self):
+        """
+        :returns: the last delivered results, oldest first
+        """
+        with self._lock:
+            return list(self._recent)
+    
+    def _render(self, id_, screen_name, text, created_at, source):
+        tag = self._service_data['tag']
+        body = text + '\n'
+        body += '[@{0}:{1}:{2} - from {3}]'.format(tag, screen_name, id_, source)
+        return CachedStatus(id_, screen_name, screen_name,
+                            u'{1}| {0}'.format(screen_name, tag), created_at, body)
+    
+    def _deliver(self, core, statuses):
+        # replies to search results don't need to validate the status either
+        tag = self._service_data['tag']
+        statuses = [self._status_cache.fetch((tag, x.id), lambda x=x: x) for x in statuses]
+        statuses.sort(key=lambda x: x.id)
+        with self._lock:
+            # the first page is what happened before anybody subscribed
+            history = self._since_id is None
+            if statuses:
+                self._since_id = statuses[-1].id
+            self._recent.extend(statuses)
+        
+        self._metrics.counter('statuses.searched').inc(len(statuses))
+        core.send_search_results(self, statuses, history)
+        core.schedule_poll(self, self._interval)
+    
+    def _poll_failed(self, core, error):
+        self._metrics.counter('api.errors.{0}'.format(self._service_data['tag'])).inc()
+        print 'Search "{0}" on {1} failed: {2}'.format(self._query, self._service_data['tag'], error)
+        core.schedule_poll(self, self._interval)
+    
+    def perform_updates(self, core, show_history=False):
+        params = {'q' : self._query, 'rpp' : self._service_data['pollPageSize']}
+        if self._since_id:
+            params['since_id'] = self._since_id
+        
+        self._metrics.counter('polls.search').inc()
+        start = time.time()
+        try:
+            results = self._api.search(**params)
+        except tweepy.TweepError, e:
+            self._poll_failed(core, e)
+            return
+        finally:
+            self._metrics.histogram('api.latency.search').observe(time.time() - start)
+        
+        self._deliver(core, [self._render(x.id, x.from_user, x.text, x.created_at, x.source)
+                             for x in results])
+    
+    def perform_updates_async(self, core, show_history=False):
+        """
+        Coroutine version of :meth:`perform_updates` for the :class:`AsyncEngine`.
+        """
+        params = {'q' : self._query.encode('utf-8'), 'rpp' : self._service_data['pollPageSize']}
+        if self._since_id:
+            params['since_id'] = self._since_id
+        
+        self._metrics.counter('polls.search').inc()
+        start = time.time()
+        try:
+            (host, port) = split_host(self._host, self._secure)
+            response = yield HttpRequest(host, port, self._secure, 'GET',
+                                         '{0}/search.json?{1}'.format(self._root, urllib.urlencode(params)),
+                                         {'User-Agent' : 'Satori'})
+            self._metrics.histogram('api.latency.search').observe(time.time() - start)
+            if response.status != 200:
+                raise tweepy.TweepError('Twitter error response: status code = {0}'.format(response.status))
+            results = json.loads(response.body)['results']
+        except (tweepy.TweepError, AsyncError, ValueError, KeyError), e:
+            self._poll_failed(core, e)
+            return
+        
+        self._deliver(core, [self._render(x['id'], x['from_user'], x['text'],
+                                          datetime.datetime(*parsedate(x['created_at'])[:6]),
+                                          x.get('source', ''))
+                             for x in results])
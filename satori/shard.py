@@ -0,0 +1,402 @@
+# encoding: utf-8
+#
+#  shard.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import signal
+import heapq
+import bisect
+import hashlib
+import itertools
+import threading
+import traceback
+import multiprocessing
+from xml.etree import cElementTree as ET
+
+import satori
+from satori.config import Config
+from satori.search_feed import room_query
+
+sleekxmpp = satori.sleekxmpp
+
+_EVENTS = ('message', 'changed_status', 'got_offline')
+_COMMANDS_NS = 'http://jabber.org/protocol/commands'
+_STANZAS_NS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+# can't be part of a JID, marks routing keys of search queries
+_SEARCH_PREFIX = u'<search>'
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping bare JIDs to shard numbers.
+    
+    Every shard owns `replicas` points on the ring, so changing the
+    number of shards only moves the JIDs between the affected points.
+    """
+    
+    def __init__(self, shards, replicas=100):
+        self._replicas = replicas
+        self._points = []
+        self._owners = []
+        self.resize(shards)
+    
+    @staticmethod
+    def _hash(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return long(hashlib.md5(value).hexdigest()[:16], 16)
+    
+    def resize(self, shards):
+        ring = sorted([(self._hash('{0}-{1}'.format(shard, replica)), shard)
+                       for shard in range(0, shards)
+                       for replica in range(0, self._replicas)])
+        self._points = [x[0] for x in ring]
+        self._owners = [x[1] for x in ring]
+        self.shards = shards
+    
+    def shard(self, jid):
+        pos = bisect.bisect(self._points, self._hash(jid))
+        return self._owners[pos % len(self._owners)]
+
+class _ShardEvent(object):
+    """
+    A routed presence or message as seen by the handlers of a shard.
+    """
+    
+    def __init__(self, data):
+        self._data = data
+        self.xml = ET.fromstring(data['xml']) if data.get('xml') else None
+    
+    def __getitem__(self, name):
+        value = self._data.get(name)
+        if name in ('from', 'to'):
+            return sleekxmpp.xmlstream.stanzabase.JID(value)
+        return value
+    
+    @classmethod
+    def pack(cls, event):
+        return {'type' : event['type'],
+                'from' : event['from'].full,
+                'to'   : event['to'].full,
+                'body' : event['body'] if event.xml.tag.endswith('message') else None,
+                'xml'  : ET.tostring(event.xml)}
+
+class ShardStream(object):
+    """
+    Stand-in for the component stream inside a shard worker process.
+    
+    Stanzas are built by a component instance which never connects,
+    sending goes through the pipe to the front process and
+    :meth:`schedule` is served from a local timer heap.
+    """
+    
+    def __init__(self, conn, jid, secret, server, port):
+        self._conn = conn
+        self._builder = sleekxmpp.componentxmpp.ComponentXMPP(jid, secret, server, port)
+        self._handlers = {}
+        self._timers = []
+        self._seq = itertools.count()
+        self._running = False
+    
+    def makeMessage(self, *args, **kwargs):
+        return self._builder.makeMessage(*args, **kwargs)
+    
+    def makePresence(self, *args, **kwargs):
+        return self._builder.makePresence(*args, **kwargs)
+    
+    def add_event_handler(self, name, callback):
+        self._handlers.setdefault(name, []).append(callback)
+    
+    def send(self, data):
+        self._conn.send(('send', data))
+    
+    def schedule(self, delay, callback, args):
+        heapq.heappush(self._timers, (time.time() + delay, self._seq.next(), callback, args))
+    
+    def connect(self):
+        return True
+    
+    def _dispatch(self, name, *args):
+        for callback in self._handlers.get(name, []):
+            try:
+                callback(*args)
+            except Exception, e:
+                print 'Shard handler failed: {0}'.format(traceback.format_exc())
+    
+    def process(self, threaded=False):
+        self._running = True
+        while self._running:
+            timeout = 1.0
+            if self._timers:
+                timeout = min(timeout, max(0, self._timers[0][0] - time.time()))
+            
+            try:
+                if self._conn.poll(timeout):
+                    msg = self._conn.recv()
+                    if msg[0] == 'event':
+                        self._dispatch(msg[1], _ShardEvent(msg[2]))
+                    elif msg[0] == 'release':
+                        self._dispatch('shard_release', msg[1])
+                    elif msg[0] == 'release_search':
+                        self._dispatch('shard_release_search', msg[1])
+                    elif msg[0] == 'stop':
+                        self._running = False
+            except EOFError:
+                # the front process is gone
+                self._running = False
+            
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                (due, seq, callback, args) = heapq.heappop(self._timers)
+                try:
+                    callback(*args)
+                except Exception, e:
+                    print 'Scheduled call failed: {0}'.format(traceback.format_exc())
+
+def _run_shard(conn, shard):
+    from satori.core import Core
+    
+    # resizing is up to the front process
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    config = Config.get().core
+    print 'Shard {0} started'.format(shard)
+    stream = ShardStream(conn, config.jid, config.secret, config.server, config.port)
+    Core(stream, shard).run()
+
+class ShardRouter(object):
+    """
+    Front process of a sharded deployment.
+    
+    Keeps the component connection and routes every presence and message
+    by consistent hash of the sender's bare JID to one of the shard
+    worker processes, which in turn run a :class:`satori.core.Core`
+    each. Stanzas to search rooms are routed by their query instead, so
+    every query is polled by a single shard no matter who joined.
+    Stanzas produced by the shards are written to the stream unchanged.
+    The last join presence of every online resource is kept so users
+    (and search queries) can be moved when a shard dies or the shard
+    count changes.
+    
+    SIGHUP re-reads the config and resizes to the configured number of
+    shards. Ad-hoc admin commands are refused, every shard writes its own
+    `metrics-shard-<n>.json` and takes SIGUSR2 for profiling instead. All
+    shards share the BookKeeper database, their writers serialize on
+    `bookkeeper.lock` in the spool directory.
+    """
+    
+    def __init__(self, config, shards, replicas=100, stop_timeout=10):
+        self._config = config
+        self._ring = HashRing(shards, replicas)
+        self._shards = {}
+        self._joins = {}        # routing key -> {(full jid, room) -> packed join presence}
+        self._lock = threading.Lock()
+        self._resize_lock = threading.Lock()
+        self._stop_timeout = stop_timeout
+        self._running = False
+        self._xmpp = sleekxmpp.componentxmpp.ComponentXMPP(
+                        config.jid,
+                        config.secret,
+                        config.server,
+                        config.port)
+        
+        for name in _EVENTS:
+            self._xmpp.add_event_handler(name, lambda event, name=name: self._route(name, event))
+        
+        # discovery is answered by the front, just like a single process does
+        self._xmpp.registerPlugin('xep_0030')
+        self._xmpp.plugin['xep_0030'].identities['main'] = []
+        self._xmpp.plugin['xep_0030'].add_identity(category='client', itype='AI', name='Satori')
+        self._xmpp.plugin['xep_0030'].add_identity(category='conference', itype='microblog', name='Satori')
+        self._xmpp.plugin['xep_0030'].add_feature('http://jabber.org/protocol/muc')
+        self._xmpp.add_handler("<iq type='set' xmlns='jabber:component:accept'><command xmlns='{0}'/></iq>".format(_COMMANDS_NS), self._on_command)
+    
+    def _start(self, shard):
+        (front, back) = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_run_shard, args=(back, shard),
+                                          name='satori-shard-{0}'.format(shard))
+        process.daemon = True
+        process.start()
+        self._shards[shard] = (process, front, threading.Lock())
+        
+        reader = threading.Thread(target=self._read, args=(shard, front),
+                                  name='satori-shard-reader-{0}'.format(shard))
+        reader.daemon = True
+        reader.start()
+    
+    def _post(self, shard, msg):
+        (process, conn, lock) = self._shards[shard]
+        with lock:
+            conn.send(msg)
+    
+    def _read(self, shard, conn):
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, IOError), e:
+                break
+            if msg[0] == 'send':
+                self._xmpp.send(msg[1])
+        
+        if self._running and self._shards.get(shard, (None, None))[1] is conn:
+            print 'Shard {0} died, restarting'.format(shard)
+            self._start(shard)
+            self._rejoin([key for key in self._joins if self._ring.shard(key) == shard])
+    
+    @staticmethod
+    def _key(event):
+        query = room_query(event['to'].user)
+        if query:
+            return _SEARCH_PREFIX + query
+        return event['from'].bare
+    
+    def _route(self, name, event):
+        key = self._key(event)
+        data = _ShardEvent.pack(event)
+        
+        with self._lock:
+            if name != 'message':
+                joins = self._joins.setdefault(key, {})
+                if data['type'] == 'unavailable':
+                    joins.pop((data['from'], event['to'].bare), None)
+                    if not joins:
+                        del self._joins[key]
+                else:
+                    joins[(data['from'], event['to'].bare)] = data
+            shard = self._ring.shard(key)
+        self._post(shard, ('event', name, data))
+    
+    def _release(self, shard, key):
+        if key.startswith(_SEARCH_PREFIX):
+            self._post(shard, ('release_search', key[len(_SEARCH_PREFIX):]))
+        else:
+            self._post(shard, ('release', key))
+    
+    def _rejoin(self, keys):
+        # replay the join presences without asking for history again
+        with self._lock:
+            for key in keys:
+                shard = self._ring.shard(key)
+                for data in self._joins.get(key, {}).values():
+                    presence = ET.fromstring(data['xml'])
+                    for x in presence.findall('{http://jabber.org/protocol/muc}x'):
+                        presence.remove(x)
+                    x = ET.SubElement(presence, '{http://jabber.org/protocol/muc}x')
+                    ET.SubElement(x, '{http://jabber.org/protocol/muc}history', {'maxstanzas' : '0'})
+                    data = dict(data, xml=ET.tostring(presence))
+                    self._post(shard, ('event', 'changed_status', data))
+    
+    def _on_command(self, xml):
+        # admin commands need a Core and there is one per shard
+        iq = ET.Element('iq', {'type' : 'error',
+                               'id'   : xml.get('id', ''),
+                               'from' : xml.get('to'),
+                               'to'   : xml.get('from')})
+        error = ET.SubElement(iq, 'error', {'type' : 'cancel'})
+        ET.SubElement(error, 'service-unavailable', {'xmlns' : _STANZAS_NS})
+        ET.SubElement(error, 'text', {'xmlns' : _STANZAS_NS}).text = \
+            'Admin commands are not available in sharded mode.'
+        self._xmpp.send(ET.tostring(iq))
+    
+    def _on_reload(self, signum, frame):
+        try:
+            shards = Config.reload().core.shards
+        except Exception, e:
+            print 'Reloading the config failed: {0}'.format(e)
+            return
+        
+        if shards < 1:
+            print 'Refusing to resize to {0} shards'.format(shards)
+        elif shards != self._ring.shards:
+            # not from within the signal handler
+            resize = threading.Thread(target=self.resize, args=(shards,),
+                                      name='satori-shard-resize')
+            resize.daemon = True
+            resize.start()
+    
+    def _on_terminate(self, signum, frame):
+        # `satori-mb stop` sends SIGTERM, unwind so run() can stop the shards
+        print 'Terminated, stopping shards'
+        raise SystemExit(0)
+    
+    def _stop(self, shards):
+        # ask every shard to save its state, then wait for all of them
+        for (process, conn, lock) in shards:
+            try:
+                with lock:
+                    conn.send(('stop',))
+            except (IOError, EOFError), e:
+                pass
+        
+        deadline = time.time() + self._stop_timeout
+        for (process, conn, lock) in shards:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                print '{0} did not stop in time, terminating'.format(process.name)
+                process.terminate()
+    
+    def resize(self, shards):
+        """
+        Change the number of shard processes.
+        
+        Only users (and search queries) whose position on the ring changed
+        owner are released on their old shard and joined again on the new one.
+        """
+        with self._resize_lock:
+            with self._lock:
+                before = dict([(key, self._ring.shard(key)) for key in self._joins])
+                self._ring.resize(shards)
+                moved = [key for key in before if before[key] != self._ring.shard(key)]
+            
+            for shard in range(0, shards):
+                if not shard in self._shards:
+                    self._start(shard)
+            
+            for key in moved:
+                self._release(before[key], key)
+            self._rejoin(moved)
+            
+            self._stop([self._shards.pop(shard) for shard in self._shards.keys() if shard >= shards])
+            searches = len([x for x in moved if x.startswith(_SEARCH_PREFIX)])
+            print 'Resized to {0} shards, moved {1} users and {2} searches'.format(
+                    shards, len(moved) - searches, searches)
+    
+    def run(self):
+        self._running = True
+        for shard in range(0, self._ring.shards):
+            self._start(shard)
+        
+        if self._xmpp.connect():
+            signal.signal(signal.SIGHUP, self._on_reload)
+            signal.signal(signal.SIGTERM, self._on_terminate)
+            try:
+                self._xmpp.process(threaded=False)
+            finally:
+                self._running = False
+                with self._resize_lock:
+                    self._stop(self._shards.values())
+        else:
+            raise RuntimeError('Connection to server failed.')
@@ -0,0 +1,160 @@
+# encoding: utf-8
+#
+#  stanza_writer.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import threading
+import traceback
+from collections import deque
+
+from metrics import Metrics
+
+class StanzaWriter(object):
+    """
+    Bounded outbound stanza queue drained by a dedicated writer thread.
+    
+    Pending stanzas are coalesced into a single `send()` of up to `batch`
+    stanzas. Once `depth` stanzas are queued the overflow `policy` kicks in:
+    
+    - `block`: :meth:`put` waits until the writer caught up
+    - `drop_presence`: the oldest queued presence is dropped (blocks if there is none)
+    - `summarize`: messages are counted per recipient and replaced by a single
+      stanza built by `summarize(mto, count)` once the queue drained
+      (presences block)
+    """
+    
+    POLICIES = ('block', 'drop_presence', 'summarize')
+    
+    def __init__(self, send, summarize=None, depth=5000, policy='block', batch=50):
+        self._send = send
+        self._summarize = summarize
+        self._depth = depth
+        self._policy = policy
+        self._batch = batch
+        self._queue = deque()
+        self._skipped = {}
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._sent = Metrics.shared().counter('stanzas.sent')
+        
+        self._written = 0
+        self._writes = 0
+        self._dropped = 0
+        self._max_depth = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+        self._latency_count = 0
+    
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='satori-writer')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+    
+    def _drop_presence(self):
+        # caller holds self._cond
+        for i in range(0, len(self._queue)):
+            if self._queue[i][1] == 'presence':
+                del self._queue[i]
+                self._dropped += 1
+                return True
+        return False
+    
+    def put(self, stanza, kind='message', mto=None):
+        """
+        Queue `stanza` for sending.
+        
+        :param kind: either 'message' or 'presence'
+        :param mto:  recipient, used to summarize dropped messages
+        """
+        with self._cond:
+            while len(self._queue) >= self._depth:
+                if self._policy == 'drop_presence' and self._drop_presence():
+                    break
+                if self._policy == 'summarize' and kind == 'message' and self._summarize:
+                    self._skipped[mto] = self._skipped.get(mto, 0) + 1
+                    self._dropped += 1
+                    return
+                if not self._running:
+                    # nobody to wait for (yet)
+                    break
+                self._cond.wait()
+            
+            self._queue.append((time.time(), kind, mto, stanza))
+            self._max_depth = max(self._max_depth, len(self._queue))
+            self._cond.notify_all()
+    
+    def _run(self):
+        while True:
+            summaries = []
+            with self._cond:
+                while self._running and not self._queue and not self._skipped:
+                    self._cond.wait()
+                if not self._running and not self._queue:
+                    return
+                
+                batch = [self._queue.popleft() for i in range(0, min(self._batch, len(self._queue)))]
+                if not self._queue and self._skipped:
+                    summaries = self._skipped.items()
+                    self._skipped = {}
+                self._cond.notify_all()
+            
+            stanzas = [x[3] for x in batch]
+            stanzas.extend([self._summarize(mto, count) for (mto, count) in summaries])
+            try:
+                self._send(u''.join([unicode(x) for x in stanzas if x is not None]))
+                self._sent.inc(len(stanzas))
+            except Exception, e:
+                print 'Failed to write stanzas: {0}'.format(traceback.format_exc())
+            
+            now = time.time()
+            with self._cond:
+                self._writes += 1
+                self._written += len(stanzas)
+                self._latency_count += len(batch)
+                for (stamp, kind, mto, stanza) in batch:
+                    self._latency_sum += now - stamp
+                    self._latency_max = max(self._latency_max, now - stamp)
+    
+    def stats(self):
+        with self._cond:
+            return {'depth'       : len(self._queue),
+                    'max_depth'   : self._max_depth,
+                    'written'     : self._written,
+                    'writes'      : self._writes,
+                    'dropped'     : self._dropped,
+                    'latency_avg' : self._latency_sum / self._latency_count if self._latency_count else 0.0,
+                    'latency_max' : self._latency_max}
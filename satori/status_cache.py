@@ -0,0 +1,107 @@
+# encoding: utf-8
+#
+#  status_cache.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+from collections import OrderedDict
+
+class CachedStatus(object):
+    """
+    Compact, immutable view of a status as delivered to the rooms.
+    """
+    __slots__ = ('id', 'screen_name', 'name', 'tagged_name', 'created_at', 'body')
+    
+    def __init__(self, id_, screen_name, name, tagged_name, created_at, body):
+        self.id = id_
+        self.screen_name = screen_name
+        self.name = name
+        self.tagged_name = tagged_name
+        self.created_at = created_at
+        self.body = body
+    
+    def __repr__(self):
+        return '<CachedStatus(id={0}, screen_name="{1}")>'.format(self.id, self.screen_name)
+
+class StatusCache(object):
+    """
+    Size bounded LRU cache of rendered statuses keyed by (service tag, status id).
+    
+    A single instance is shared by all connectors of the process
+    (see :meth:`StatusCache.shared`) so every status is parsed and
+    rendered only once no matter how many rooms it is delivered to.
+    """
+    
+    _shared = None
+    _shared_lock = threading.Lock()
+    
+    @classmethod
+    def shared(cls, size=10000):
+        with cls._shared_lock:
+            if not cls._shared:
+                cls._shared = StatusCache(size)
+            return cls._shared
+    
+    def __init__(self, size=10000):
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+    
+    def fetch(self, key, factory):
+        """
+        Return the entry for `key`, calling `factory()` to create it on a miss.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self._hits += 1
+                return entry
+            self._misses += 1
+        
+        # render outside the lock, a concurrent miss just renders twice
+        entry = factory()
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+        return entry
+    
+    def lookup(self, key):
+        with self._lock:
+            return self._entries.get(key)
+    
+    def stats(self):
+        with self._lock:
+            return {'size'      : len(self._entries),
+                    'hits'      : self._hits,
+                    'misses'    : self._misses,
+                    'evictions' : self._evictions}
@@ -0,0 +1,161 @@
+# encoding: utf-8
+#
+#  trace_recorder.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import calendar
+import threading
+
+_MUC_NS = '{http://jabber.org/protocol/muc}'
+
+class TraceRecorder(object):
+    """
+    Records an anonymised trace of the traffic Satori handles.
+    
+    Every line of the gzip compressed trace file is a JSON object with
+    `k` (kind) and `t` (seconds since the trace started):
+    
+    - `p`: a presence from user `u`, resource `r` to room `o` as nick
+      `n`, with type `y` and the `<history/>` attributes `h` of a join
+    - `m`: a message from user `u` to room `o` with body `b`
+    - `tl`: a timeline poll of user `u` with statuses `s`, each as
+      `[id, author, created_at, length]`
+    
+    JIDs, resources, room names (search rooms keep their `#` or `search.`
+    prefix), nicks and authors are replaced by salted hashes which are
+    stable within one trace only, message bodies keep their command
+    prefix and length but not their text. Status ids are numbered in the
+    order they are first seen, in timelines and in `@tag:nick:id:`
+    commands alike. Times are kept as they are.
+    """
+    
+    _active = None
+    
+    @classmethod
+    def active(cls):
+        """
+        :returns: the running recorder (or None)
+        """
+        return cls._active
+    
+    @classmethod
+    def start(cls, path):
+        if not cls._active:
+            cls._active = TraceRecorder(path)
+            print 'Recording trace to {0}'.format(path)
+        return cls._active
+    
+    @classmethod
+    def stop(cls):
+        if cls._active:
+            cls._active.close()
+            cls._active = None
+    
+    def __init__(self, path):
+        self._salt = os.urandom(16)
+        self._ids = {}
+        self._started = time.time()
+        self._file = gzip.open(path, 'ab')
+        self._lock = threading.Lock()
+        self._write({'k' : 'trace', 'version' : 2, 'started' : self._started})
+    
+    def _anon(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return hashlib.sha1(self._salt + str(value)).hexdigest()[:12]
+    
+    def _status_id(self, status_id):
+        # caller holds self._lock
+        if not status_id in self._ids:
+            self._ids[status_id] = len(self._ids) + 1
+        return self._ids[status_id]
+    
+    def _room(self, jid):
+        node = jid.user or ''
+        for prefix in ('#', 'search.'):
+            if node.startswith(prefix):
+                return prefix + self._anon(node[len(prefix):])
+        return self._anon(node)
+    
+    def _write(self, entry):
+        entry.setdefault('t', round(time.time() - self._started, 3))
+        with self._lock:
+            if self._file:
+                self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    
+    def _body(self, body):
+        # keep '@tag:nick:id:' commands recognizable, drop the text
+        if not body.startswith('@'):
+            return 'x' * len(body)
+        
+        parts = body.split(':', 3)
+        if len(parts) > 1:
+            parts[1] = self._anon(parts[1])
+        if len(parts) > 3 and parts[2].strip().isdigit():
+            with self._lock:
+                parts[2] = str(self._status_id(long(parts[2])))
+        parts[-1] = 'x' * len(parts[-1])
+        return ':'.join(parts)
+    
+    def presence(self, event):
+        xml = getattr(event, 'xml', None)
+        history = xml.find('{0}x/{0}history'.format(_MUC_NS)) if xml is not None else None
+        self._write({'k' : 'p',
+                     'u' : self._anon(event['from'].bare),
+                     'r' : self._anon(event['from'].resource),
+                     'o' : self._room(event['to']),
+                     'n' : self._anon(event['to'].resource),
+                     'y' : event['type'] or 'available',
+                     'h' : dict(history.items()) if history is not None else None})
+    
+    def message(self, event):
+        self._write({'k' : 'm',
+                     'u' : self._anon(event['from'].bare),
+                     'o' : self._room(event['to']),
+                     'b' : self._body(event['body'] or '')})
+    
+    def timeline(self, jid, statuses):
+        with self._lock:
+            # oldest first, so ids keep their order within a poll
+            ids = dict([(x.id, self._status_id(x.id))
+                        for x in sorted(statuses, key=lambda x: x.id)])
+        self._write({'k' : 'tl',
+                     'u' : self._anon(jid),
+                     's' : [(ids[x.id], self._anon(x.screen_name),
+                             calendar.timegm(x.created_at.utctimetuple()), len(x.body))
+                            for x in statuses]})
+    
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
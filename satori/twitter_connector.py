@@ -27,9 +27,28 @@
 # OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import time
+import json
+import urllib
 import tweepy
-import datetime
 from config import Config
+from async_engine import AsyncError, Call, HttpRequest, split_host
+from http_pool import HttpPool
+from status_cache import CachedStatus, StatusCache
+from action_queue import ActionQueue
+from presence_store import PresenceStore
+from book_keeper import CURSOR_HOME, CURSOR_DM
+from archive import TimelineArchive
+from metrics import Metrics
+from trace_recorder import TraceRecorder
+import http_pool
+
+_ACTION_NAMES = {'update'  : 'status update',
+                 'reply'   : 'reply',
+                 'favor'   : 'favorite',
+                 'retweet' : 'retweet',
+                 'block'   : 'block',
+                 'report'  : 'spam report'}
 
 class TwitterConnector(object):
     def __init__(self, book_keeper, account_data):
@@ -37,7 +56,10 @@ class TwitterConnector(object):
         self._account_data = book_keeper.account(account_data.user.jid, 
                                                  account_data.service.name)
         self._service_data = None
-        self._user_cache = {}
+        self._interval = Config.get().core.poll_interval
+        self._last_response = None
+        self._status_cache = StatusCache.shared(Config.get().core.status_cache_size)
+        self._metrics = Metrics.shared()
         
         if self._account_data:
             self._account_data = self._account_data[0]
@@ -52,6 +74,25 @@ class TwitterConnector(object):
                    self._service_data = service
                    break
             
+        core_config = Config.get().core
+        self._presence = PresenceStore.shared(self._service_data['tag'],
+                                              core_config.presence_ttl,
+                                              core_config.room_occupant_cap)
+        self._actions = ActionQueue(self._service_data['actionRate'],
+                                    self._service_data['actionBurst'],
+                                    self._service_data['actionRetries'],
+                                    self._service_data['actionBackoff'],
+                                    self._service_data['actionQueueSize'])
+        self._archive = None
+        self._archive_history = core_config.archive_history
+        if core_config.archive:
+            self._archive = TimelineArchive.shared(core_config.archive_spool,
+                                                   self._service_data['tag'],
+                                                   segment_size=core_config.archive_segment_size,
+                                                   segment_age=core_config.archive_segment_age,
+                                                   retention=core_config.archive_retention,
+                                                   max_size=core_config.archive_max_size)
+        
         if self._service_data['type'] == 'twitter_oAuth':
             try:
                 self._auth = tweepy.OAuthHandler(self._service_data['oAuthKey'],
@@ -71,169 +112,474 @@ class TwitterConnector(object):
             except tweepy.TweepError, e:
                 raise
         
+        # share keep-alive connections between all accounts of this service
+        http_pool.install(tweepy.binder, tweepy.API)
+        kwargs = {'host'     : self._service_data['apiHost'],
+                  'api_root' : self._service_data['apiRoot'].rstrip('/'),
+                  'secure'   : self._service_data['useHttps']}
+        if self._service_data['searchHost']:
+            kwargs['search_host'] = self._service_data['searchHost']
+            kwargs['search_root'] = (self._service_data['searchRoot'] or '').rstrip('/')
+        
+        for host in [kwargs['host'], kwargs.get('search_host')]:
+            if host:
+                HttpPool.get(host, kwargs['secure'],
+                             self._service_data['poolSize'],
+                             self._service_data['poolIdleTimeout'],
+                             self._service_data['poolHealthCheck'])
+        
         try:
-            self._api = tweepy.API(self._auth)
+            self._api = tweepy.API(self._auth, **kwargs)
         except tweepy.TweepError, e:
             raise
     
-    def _update_screen_status(self, name, nick, stamp, core):
-        tagged_name = '{1}| {0}'.format(name, self._service_data['tag'])
-        if not nick in self._user_cache:
-            self._user_cache[nick] = {}
-            self._user_cache[nick]['name'] = tagged_name
-            self._user_cache[nick]['away'] = False
-            self._user_cache[nick]['last'] = stamp
-            core.send_user_presence(self._jid, tagged_name, True)
-        
-        if self._user_cache[nick]['last'] - stamp > datetime.timedelta(0, 300, 0):
-            if not self._user_cache[nick]['away']:
-                self._user_cache[nick]['away'] = True
-                core.send_user_presence(self._jid, tagged_name, False)
-        else:
-            if self._user_cache[nick]['away']:
-                self._user_cache[nick]['away'] = False
-                core.send_user_presence(self._jid, tagged_name, True)
+    @property
+    def key(self):
+        return (self._jid, self._service_data['tag'])
+    
+    @property
+    def host(self):
+        return self._service_data['apiHost']
+    
+    def release(self):
+        """
+        Forget the occupants shown in our room (e.g. once the user left).
+        """
+        self._presence.release(self._jid)
+    
+    def archived_since(self, stamp):
+        """
+        :returns: the statuses archived for this account at or after
+                  `stamp` (unix time), oldest first
+        """
+        if not self._archive or not self._account_data:
+            return []
+        tag = self._service_data['tag']
+        return [self._status_cache.fetch((tag, x.id), lambda x=x: x)
+                for x in self._archive.since(self._account_data.user_id, stamp)]
+    
+    def _rate_limit(self):
+        # tweepy keeps the last httplib response around (if supported)
+        response = self._last_response or getattr(self._api, 'last_response', None)
+        if not response:
+            return (None, None)
+        
+        try:
+            remaining = response.getheader('X-RateLimit-Remaining', None)
+            reset = response.getheader('X-RateLimit-Reset', None)
+            return (int(remaining) if remaining is not None else None,
+                    int(reset) if reset is not None else None)
+        except (AttributeError, ValueError):
+            return (None, None)
+    
+    def _next_interval(self, fetched, failed=False):
+        if not self._service_data['pollAdaptive']:
+            return self._interval
         
-        self._user_cache[nick]['last'] = stamp
+        min_interval = self._service_data['pollMinInterval']
+        max_interval = self._service_data['pollMaxInterval']
+        
+        if failed or not fetched:
+            # nothing new (or an error) - back off
+            self._interval *= self._service_data['pollBackoff']
+        elif fetched >= self._service_data['pollPageSize']:
+            # full page - we are probably missing statuses
+            self._interval *= self._service_data['pollSpeedup']
+        
+        (remaining, reset) = self._rate_limit()
+        if remaining is not None and reset:
+            # spread what is left of the quota until it is reset
+            window = max(0, reset - time.time())
+            if remaining <= 0:
+                self._interval = max(self._interval, window)
+            else:
+                self._interval = max(self._interval, window / remaining)
+            max_interval = max(max_interval, window)
+        
+        self._interval = min(max(self._interval, min_interval), max_interval)
+        return self._interval
+    
+    def _update_screen_status(self, name, nick, stamp, core):
+        for (jid, tagged_name, state) in self._presence.update(self._jid, nick, name, stamp):
+            core.send_user_presence(jid, tagged_name, state == 'present',
+                                    state == 'gone')
+    
+    def _expire_screen_status(self, core):
+        for tagged_name in self._presence.expire(self._jid):
+            core.send_user_presence(self._jid, tagged_name, False, True)
     
-    def handle_message(self, mto, mbody, is_direct=False):
+    def _parse_message(self, mbody):
         # it's up to us to decide if we actually *need* this message..
+        if not mbody.startswith('@'):
+            # out with it
+            return ('update', None, None, mbody)
+        
+        if not mbody.startswith('@{0}:'.format(self._service_data['tag'])):
+            # not our business
+            return None
+        
+        # targeted reply - parse it
         try:
-            if not mbody.startswith('@'):
-                # out with it
-                self._api.update_status(status=mbody)
-                return '{0} '.format(self._service_data['tag'])
+            (tag, nick, status_id, message) = mbody.split(':')
+        except ValueError:
+            return None
+        
+        # check if it is a 'command' or a reply..
+        message = message.strip()
+        action = {'/favor'   : 'favor',
+                  '/retweet' : 'retweet',
+                  '/block'   : 'block',
+                  '/report'  : 'report'}.get(message.lower(), 'reply')
+        return (action, status_id, nick, message)
+    
+    def _perform_action(self, action, status_id, nick, message):
+        if action == 'update':
+            self._api.update_status(status=message)
             
-            if not mbody.startswith('@{0}:'.format(self._service_data['tag'])):
-                # not our business
-                return ''
+        elif action == 'favor':
+            # add a star
+            self._api.create_favorite(status_id)
             
-            # targeted reply - parse it
-            try:
-                (tag, nick, status_id, message) = mbody.split(':')
-            except ValueError:
-                return ''
+        elif action == 'retweet':
+            # api-retweet
+            self._api.retweet(status_id)
             
-            try:
-                self._api.get_status(status_id)
-            except tweepy.TweepError:
-                core.send_room_message(self._jid, None, '{0}: {1}'.format(self._service_data['tag'], str(e)))
-                return ''
+        elif action == 'block':
+            # block user
+            self._api.create_block(screen_name=nick)
             
-            # check if it is a 'command' or a reply..
-            message = message.strip()
-            if message.lower() == '/favor':
-                # add a star
-                self._api.create_favorite(status_id)
-                
-            elif message.lower() == '/retweet':
-                # api-retweet
-                self._api.retweet(status_id)
-                
-            elif message.lower() == '/block':
-                # block user
-                self._api.create_block(screen_name=nick)
-                
-            elif message.lower() == '/report':
-                # report user for spamming
-                self._api.report_spam(screen_name=nick)
-                
-            else:
-                # just reply
-                self._api.update_status(message, in_reply_to_status_id=status_id)
-            
-            return '{0} '.format(self._service_data['tag'])
+        elif action == 'report':
+            # report user for spamming
+            self._api.report_spam(screen_name=nick)
             
+        else:
+            # just reply
+            self._api.update_status(message, in_reply_to_status_id=status_id)
+    
+    def _action_request(self, action, status_id, nick, message):
+        # (method, path, parameters) used by the async engine
+        if action == 'update':
+            return ('POST', '/statuses/update.json', {'status' : message})
+        elif action == 'favor':
+            return ('POST', '/favorites/create/{0}.json'.format(status_id), {})
+        elif action == 'retweet':
+            return ('POST', '/statuses/retweet/{0}.json'.format(status_id), {})
+        elif action == 'block':
+            return ('POST', '/blocks/create.json', {'screen_name' : nick})
+        elif action == 'report':
+            return ('POST', '/report_spam.json', {'screen_name' : nick})
+        return ('POST', '/statuses/update.json', {'status' : message,
+                                                  'in_reply_to_status_id' : status_id})
+    
+    def _known_status(self, status_id, nick):
+        # statuses we delivered ourselves don't need a round trip to validate
+        try:
+            status = self._status_cache.lookup((self._service_data['tag'], long(status_id)))
+        except (TypeError, ValueError):
+            status = None
+        if status and (not nick or status.screen_name.lower() == nick.lower()):
+            self._metrics.counter('status_index.hits').inc()
+            return True
+        self._metrics.counter('status_index.misses').inc()
+        return False
+    
+    def queue_message(self, mbody, core, room=None):
+        """
+        Queue the action requested by a room message.
+        
+        :param room: the search room `mbody` was sent to, the action is
+                     acknowledged there instead of in the account's room
+        :returns: True if an action was queued, it is performed later by
+                  :meth:`perform_action` (or :meth:`perform_action_async`)
+        """
+        command = self._parse_message(mbody)
+        if not command:
+            return False
+        
+        if not self._actions.put(*command, room=room):
+            self._notify(core, room, '{0}: too many pending actions, '
+                         'dropped "{1}"'.format(self._service_data['tag'], mbody))
+            return False
+        return True
+    
+    def next_action(self):
+        """
+        :returns: the next action to perform or None (see :meth:`ActionQueue.next`)
+        """
+        return self._actions.next()
+    
+    def pending_actions(self):
+        return len(self._actions)
+    
+    def abort_action(self):
+        """
+        Give up on the action handed out by :meth:`next_action`.
+        """
+        self._actions.done()
+    
+    def drop_actions(self):
+        """
+        Drop all queued actions (e.g. once the room is evicted).
+        """
+        return self._actions.clear()
+    
+    def _transient(self, error):
+        # transport errors (no response at all), server errors and rate
+        # limits are worth another try
+        status = getattr(getattr(error, 'response', None), 'status', None)
+        return status is None or status >= 500 or status in (420, 429)
+    
+    def _notify(self, core, room, text):
+        if room:
+            core.send_search_message(self._jid, room, text)
+        else:
+            core.send_room_message(self._jid, None, text)
+    
+    def _action_done(self, action, core):
+        self._actions.done()
+        self._metrics.counter('actions.{0}'.format(self._service_data['tag'])).inc()
+        self._metrics.histogram('actions.latency').observe(time.time() - action.queued)
+        self._notify(core, action.room, '{0}: {1} done'.format(self._service_data['tag'],
+                                                               _ACTION_NAMES[action.action]))
+    
+    def _action_failed(self, action, core, error):
+        if self._transient(error) and self._actions.retry():
+            self._metrics.counter('actions.retries').inc()
+            return
+        
+        self._actions.done()
+        self._metrics.counter('api.errors.{0}'.format(self._service_data['tag'])).inc()
+        self._notify(core, action.room, '{0}: {1}'.format(self._service_data['tag'], str(error)))
+    
+    def perform_action(self, action, core):
+        """
+        Perform `action` as returned by :meth:`next_action`.
+        """
+        try:
+            if action.status_id and not self._known_status(action.status_id, action.nick):
+                self._api.get_status(action.status_id)
+            self._perform_action(action.action, action.status_id, action.nick, action.message)
         except tweepy.TweepError, e:
-            core.send_room_message(self._jid, None, '{0}: {1}'.format(self._service_data['tag'], str(e)))
-            return ''
+            self._action_failed(action, core, e)
+            return
+        self._action_done(action, core)
     
-    def perform_updates(self, core, show_history=False):        
-        user_msgs = []
-        user_dms = []
+    def perform_action_async(self, action, core):
+        """
+        Coroutine version of :meth:`perform_action` for the :class:`AsyncEngine`.
+        """
+        try:
+            if action.status_id and not self._known_status(action.status_id, action.nick):
+                self._check_response((yield self._request('GET', '/statuses/show/{0}.json'.format(action.status_id))))
+            
+            (method, path, params) = self._action_request(action.action, action.status_id,
+                                                          action.nick, action.message)
+            self._check_response((yield self._request(method, path, params)))
+        except (tweepy.TweepError, AsyncError), e:
+            self._action_failed(action, core, e)
+            return
+        self._action_done(action, core)
+    
+    # --- async engine helpers
+    
+    def _request(self, method, path, params={}):
+        secure = self._service_data['useHttps']
+        (host, port) = split_host(self._service_data['apiHost'], secure)
+        path = self._service_data['apiRoot'].rstrip('/') + path
+        # signed with the configured host, just like tweepy does
+        url = '{0}://{1}{2}'.format('https' if secure else 'http', self._service_data['apiHost'], path)
+        params = dict([(k, unicode(v).encode('utf-8')) for (k, v) in params.items()])
+        
+        headers = {'User-Agent' : 'Satori'}
+        self._auth.apply_auth(url, method, headers, params)
+        
+        query = urllib.urlencode(params)
+        if method == 'GET':
+            return HttpRequest(host, port, secure, method,
+                               path + ('?' + query if query else ''), headers)
+        
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return HttpRequest(host, port, secure, method,
+                           path, headers, query)
+    
+    def _check_response(self, response):
+        self._last_response = response
+        if response.status != 200:
+            try:
+                error = json.loads(response.body)['error']
+            except (ValueError, KeyError, TypeError):
+                error = 'Twitter error response: status code = {0}'.format(response.status)
+            # just like tweepy's binder, see _transient()
+            raise tweepy.TweepError(error, response)
+        return json.loads(response.body)
+    
+    # --- timeline updates
+    
+    def _load_cursor(self):
         account_data = self._book_keeper.account(self._jid,
                                                  self._service_data['tag'])
         if not account_data:
-            # FIXME: handle this!
-            return
+            return (None, None)
         account_data = account_data[0]
         
-        status_ids = account_data.status.split(':')
-        if len(status_ids) < 2:
-            status_ids = ['0', '0']
+        cursors = {CURSOR_HOME : self._book_keeper.cursor(account_data, CURSOR_HOME),
+                   CURSOR_DM   : self._book_keeper.cursor(account_data, CURSOR_DM)}
+        return (account_data, cursors)
+    
+    def _poll_failed(self, core, error):
+        self._metrics.counter('api.errors.{0}'.format(self._service_data['tag'])).inc()
+        core.send_room_message(self._jid, None, '{0}: {1}'.format(self._service_data['tag'], str(error)))
+        core.schedule_poll(self, self._next_interval(0, True))
+    
+    def perform_updates(self, core, show_history=False):
+        user_msgs = []
+        user_dms = []
+        (account_data, cursors) = self._load_cursor()
+        if not account_data:
+            # FIXME: handle this!
+            return
         
+        self._metrics.counter('polls.{0}'.format(self._service_data['tag'])).inc()
+        start = time.time()
         try:
-            if account_data.status:
-                user_msgs = self._api.home_timeline(long(status_ids[0]))
-                #user_dms = self._api.direct_messages(long(status_ids[1]))
+            if cursors[CURSOR_HOME]:
+                user_msgs = self._api.home_timeline(cursors[CURSOR_HOME])
+                #user_dms = self._api.direct_messages(cursors[CURSOR_DM])
             else:
                 user_msgs = self._api.home_timeline()
                 #user_dms = self._api.direct_messages()
                 
         except tweepy.TweepError, e:
-            core.send_room_message(self._jid, None, '{0}: {1}'.format(self._service_data['tag'], str(e)))
-            core.schedule(60, self.perform_updates, [core])
+            self._poll_failed(core, e)
             return
+        finally:
+            self._metrics.histogram('api.latency.{0}'.format(self._service_data['tag'])).observe(time.time() - start)
         
+        self._deliver(core, account_data, cursors,
+                      [self._compact_status(x) for x in user_msgs],
+                      [self._render_dm(x) for x in user_dms], show_history)
+    
+    def perform_updates_async(self, core, show_history=False):
+        """
+        Coroutine version of :meth:`perform_updates` for the :class:`AsyncEngine`.
+        """
+        # the bookkeeping and the archive block, they run on a worker
+        (account_data, cursors) = yield Call(self._load_cursor)
+        if not account_data:
+            # FIXME: handle this!
+            return
+        
+        params = {}
+        if cursors[CURSOR_HOME]:
+            params['since_id'] = cursors[CURSOR_HOME]
+        
+        self._metrics.counter('polls.{0}'.format(self._service_data['tag'])).inc()
+        start = time.time()
+        try:
+            response = yield self._request('GET', '/statuses/home_timeline.json', params)
+            self._metrics.histogram('api.latency.{0}'.format(self._service_data['tag'])).observe(time.time() - start)
+            user_msgs = self._compact_payload(self._check_response(response))
+        except (tweepy.TweepError, AsyncError), e:
+            self._poll_failed(core, e)
+            return
+        
+        yield Call(self._deliver, core, account_data, cursors, user_msgs, [], show_history)
+    
+    def _render_status(self, status):
+        tagged_name = '{1}| {0}'.format(status.author.name, self._service_data['tag'])
+        
+        body = ''
+        body = status.text + '\n'
+        body += '[@{0}:{1}:{2} - from {3}]'.format(self._service_data['tag'],
+                                                   status.author.screen_name,
+                                                   status.id,
+                                                   status.source)
+        return CachedStatus(status.id, status.author.screen_name, status.author.name,
+                            tagged_name, status.created_at, body)
+    
+    def _render_dm(self, status):
+        tagged_name = '{1}| {0}'.format(status.sender.name, self._service_data['tag'])
+        body = ''
+        body = status.text + '\n'
+        body += '[@{0}:{1}]'.format(status.sender.screen_name,
+                                               status.id)
+        return CachedStatus(status.id, status.sender.screen_name, status.sender.name,
+                            tagged_name, status.created_at, body)
+    
+    def _compact_status(self, status):
+        return self._status_cache.fetch((self._service_data['tag'], status.id),
+                                        lambda: self._render_status(status))
+    
+    def _compact_payload(self, payload):
+        # look up raw JSON statuses before handing them to tweepy's parser
+        parse = self._api.parser.model_factory.status.parse
+        return [self._status_cache.fetch((self._service_data['tag'], item['id']),
+                                         lambda item=item: self._render_status(parse(self._api, item)))
+                for item in payload]
+    
+    def _deliver(self, core, account_data, cursors, user_msgs, user_dms, show_history):
         user_msgs.sort(key=lambda x: x.id)
         user_dms.sort(key=lambda x: x.id)
         
+        if TraceRecorder.active():
+            TraceRecorder.active().timeline(self._jid, user_msgs)
+        
+        replayed = []
+        if show_history and self._archive and cursors[CURSOR_HOME]:
+            # everything up to the cursor was delivered before, replay it from disk
+            replayed = self._archive.replay(account_data.user_id, self._archive_history,
+                                            cursors[CURSOR_HOME])
+            # so replies to them are validated from the cache as well
+            replayed = [self._status_cache.fetch((self._service_data['tag'], x.id), lambda x=x: x)
+                        for x in replayed]
+        
         if show_history:
             # send initial presence for all known users
             known_users = {}
-            for status in user_msgs:
-                if not status.author.screen_name in known_users:
-                    known_users[status.author.screen_name] = (status.author.name,
-                                                              status.created_at)
-            
-            for status in user_dms:
-                if not status.sender.screen_name in known_users:
-                    known_users[status.sender.screen_name] = (status.sender.name,
-                                                              status.created_at)
+            for status in replayed + user_msgs + user_dms:
+                if not status.screen_name in known_users:
+                    known_users[status.screen_name] = (status.name,
+                                                       status.created_at)
             
             for name in known_users:
                 self._update_screen_status(known_users[name][0], name, 
                                            known_users[name][1], core)
+        
+        for status in replayed:
+            core.send_room_message(self._jid, status.tagged_name, status.body, status.created_at)
+        
         for status in user_msgs:
-            tagged_name = '{1}| {0}'.format(status.author.name, self._service_data['tag'])
-            
-            body = ''
-            body = status.text + '\n'
-            body += '[@{0}:{1}:{2} - from {3}]'.format(self._service_data['tag'],
-                                                       status.author.screen_name,
-                                                       status.id,
-                                                       status.source)
-            
-            self._update_screen_status(status.author.name,
-                                       status.author.screen_name,
+            self._update_screen_status(status.name,
+                                       status.screen_name,
                                        status.created_at, core)
             
             if show_history:
-                core.send_room_message(self._jid, tagged_name, body, status.created_at)
+                core.send_room_message(self._jid, status.tagged_name, status.body, status.created_at)
             else:
-                core.send_room_message(self._jid, tagged_name, body)
-            status_ids[0] = str(status.id)
+                core.send_room_message(self._jid, status.tagged_name, status.body)
+            cursors[CURSOR_HOME] = status.id
             
         for status in user_dms:
-            tagged_name = '{1}| {0}'.format(status.sender.name, self._service_data['tag'])
-            body = ''
-            body = status.text + '\n'
-            body += '[@{0}:{1}]'.format(status.sender.screen_name,
-                                                   status.id)
-            self._update_screen_status(status.sender.name,
-                                       status.sender.screen_name,
+            self._update_screen_status(status.name,
+                                       status.screen_name,
                                        status.created_at, core)
             
             if show_history:
-                core.send_user_message(self._jid, tagged_name, body, status.created_at)
+                core.send_user_message(self._jid, status.tagged_name, status.body, status.created_at)
             else:
-                core.send_user_message(self._jid, tagged_name, body)
-            status_ids[1] = str(status.id)
+                core.send_user_message(self._jid, status.tagged_name, status.body)
+            cursors[CURSOR_DM] = status.id
         
-        account_data.status = ':'.join(status_ids)
-        self._book_keeper.commit(account_data)
-        self._book_keeper.release()
+        self._expire_screen_status(core)
+        self._metrics.counter('statuses.delivered').inc(len(user_msgs) + len(user_dms))
         
-        core.schedule(60, self.perform_updates, [core])
-
+        if self._archive and user_msgs:
+            self._archive.append(account_data.user_id, user_msgs)
+        
+        if user_msgs:
+            self._book_keeper.update_cursor(account_data, CURSOR_HOME, cursors[CURSOR_HOME])
+        if user_dms:
+            self._book_keeper.update_cursor(account_data, CURSOR_DM, cursors[CURSOR_DM])
+        self._book_keeper.release()
         
+        core.schedule_poll(self, self._next_interval(len(user_msgs) + len(user_dms)))
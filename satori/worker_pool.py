@@ -0,0 +1,163 @@
+# encoding: utf-8
+#
+#  worker_pool.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import Queue
+import threading
+import traceback
+from collections import deque
+
+class _Job(object):
+    __slots__ = ('key', 'host', 'func', 'args', 'callback', 'errback')
+
+    def __init__(self, key, host, func, args, callback, errback):
+        self.key = key
+        self.host = host
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+
+class WorkerPool(object):
+    """
+    Bounded pool of worker threads for blocking connector I/O.
+    
+    Jobs sharing the same `key` (usually one per account) are run strictly
+    one after another, jobs sharing the same `host` are limited to
+    `host_limit` concurrent requests. Results (and any call queued by
+    :meth:`defer`) are handed back through a thread-safe queue and run by
+    :meth:`drain` on the caller's thread.
+    """
+    
+    def __init__(self, workers=8, host_limit=4):
+        self._host_limit = host_limit
+        self._jobs = Queue.Queue()
+        self._results = Queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}      # key  -> deque of jobs waiting for that key
+        self._hosts = {}        # host -> number of jobs in flight
+        self._blocked = {}      # host -> deque of jobs waiting for that host
+        self._threads = []
+        
+        for i in range(0, workers):
+            worker = threading.Thread(target=self._run, name='satori-worker-{0}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+    
+    def _dispatch(self, job):
+        # caller holds self._lock
+        if self._hosts.get(job.host, 0) >= self._host_limit:
+            self._blocked.setdefault(job.host, deque()).append(job)
+            return
+        self._hosts[job.host] = self._hosts.get(job.host, 0) + 1
+        self._jobs.put(job)
+    
+    def _finish(self, job):
+        with self._lock:
+            self._hosts[job.host] -= 1
+            
+            blocked = self._blocked.get(job.host)
+            if blocked:
+                self._dispatch(blocked.popleft())
+                if not blocked:
+                    del self._blocked[job.host]
+            
+            pending = self._pending[job.key]
+            if pending:
+                self._dispatch(pending.popleft())
+            else:
+                del self._pending[job.key]
+    
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                result = job.func(*job.args)
+                if job.callback:
+                    self._results.put((job.callback, (result,), {}))
+            except Exception, e:
+                error = traceback.format_exc()
+                if job.errback:
+                    self._results.put((job.errback, (error,), {}))
+                else:
+                    print 'Worker job failed: {0}'.format(error)
+            finally:
+                self._finish(job)
+    
+    def submit(self, key, host, func, args=(), callback=None, errback=None):
+        """
+        Queue `func(*args)` for execution on a worker thread.
+        
+        :param key:      serialization key, jobs with the same key never overlap
+        :param host:     service host used for the in-flight limit
+        :param callback: called as `callback(result)` from :meth:`drain`
+        :param errback:  called as `errback(traceback)` from :meth:`drain`
+        """
+        job = _Job(key, host, func, args, callback, errback)
+        with self._lock:
+            if job.key in self._pending:
+                self._pending[job.key].append(job)
+            else:
+                self._pending[job.key] = deque()
+                self._dispatch(job)
+    
+    def defer(self, func, args=(), kwargs={}):
+        """
+        Queue `func(*args, **kwargs)` to be run by the next :meth:`drain`.
+        """
+        self._results.put((func, args, kwargs))
+    
+    def drain(self, limit=None):
+        """
+        Run queued results and deferred calls on the calling thread.
+        
+        :param limit: maximum number of entries to process (`None` for all)
+        :returns: the number of processed entries
+        """
+        count = 0
+        while limit is None or count < limit:
+            try:
+                (func, args, kwargs) = self._results.get_nowait()
+            except Queue.Empty:
+                break
+            
+            count += 1
+            try:
+                func(*args, **kwargs)
+            except Exception, e:
+                print 'Deferred call failed: {0}'.format(traceback.format_exc())
+        return count
+    
+    def busy(self, key):
+        with self._lock:
+            return key in self._pending
+    
+    def in_flight(self):
+        with self._lock:
+            return dict(self._hosts)
@@ -52,6 +52,6 @@ setup(name='Satori',
             'satori-mb = satori.core:Run',
         ],
       },
-#      test_suite="tests.suite"
+      test_suite="tests.suite"
 )
 
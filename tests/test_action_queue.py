@@ -0,0 +1,154 @@
+# encoding: utf-8
+#
+#  test_action_queue.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import unittest
+
+import tweepy
+
+from satori.metrics import Metrics
+from satori.async_engine import AsyncError
+from satori.action_queue import ActionQueue, TokenBucket
+from satori.twitter_connector import TwitterConnector
+
+class _Response(object):
+    def __init__(self, status):
+        self.status = status
+
+class _Core(object):
+    def __init__(self):
+        self.messages = []
+    
+    def send_room_message(self, mto, mfrom, mbody, mpubdate=None):
+        self.messages.append(mbody)
+    
+    def send_search_message(self, mto, room, mbody):
+        self.messages.append((room, mbody))
+
+class TokenBucketTest(unittest.TestCase):
+    
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(1.0, 2)
+        now = bucket._stamp
+        self.assertTrue(bucket.take(now))
+        self.assertTrue(bucket.take(now))
+        self.assertFalse(bucket.take(now))
+        self.assertAlmostEqual(bucket.wait(now + 0.5), 0.5)
+        self.assertTrue(bucket.take(now + 1))
+    
+    def test_no_rate(self):
+        bucket = TokenBucket(0, 1)
+        self.assertTrue(bucket.take())
+        self.assertEqual(bucket.wait(), None)
+
+class ActionQueueTest(unittest.TestCase):
+    
+    def test_order_and_busy(self):
+        queue = ActionQueue(rate=3600, burst=10)
+        queue.put('update', None, None, 'first')
+        queue.put('update', None, None, 'second')
+        head = queue.next()
+        self.assertEqual(head.message, 'first')
+        self.assertTrue(queue.busy)
+        self.assertEqual(queue.next(), None)
+        queue.done()
+        self.assertEqual(queue.next().message, 'second')
+    
+    def test_size_and_clear(self):
+        queue = ActionQueue(rate=3600, burst=10, size=2)
+        self.assertTrue(queue.put('update', None, None, 'a'))
+        self.assertTrue(queue.put('update', None, None, 'b'))
+        self.assertEqual(queue.put('update', None, None, 'c'), None)
+        queue.next()
+        self.assertEqual(queue.clear(), 1)
+        self.assertEqual(len(queue), 1)
+    
+    def test_retry_backs_off_and_keeps_the_head(self):
+        queue = ActionQueue(rate=3600, burst=10, retries=1, backoff=5.0)
+        queue.put('update', None, None, 'first')
+        queue.put('update', None, None, 'second')
+        now = time.time()
+        queue.next(now)
+        self.assertTrue(queue.retry(now))
+        self.assertEqual(queue.next(now + 4), None)
+        self.assertEqual(queue.next(now + 5).attempts, 2)
+        self.assertFalse(queue.retry(now + 5))
+        self.assertEqual(len(queue), 2)
+        queue.done()
+        self.assertEqual(queue.next(now + 5).message, 'second')
+
+class ActionFailedTest(unittest.TestCase):
+    
+    def setUp(self):
+        # only the parts _action_failed() relies on
+        self.connector = TwitterConnector.__new__(TwitterConnector)
+        self.connector._service_data = {'tag' : 'tw'}
+        self.connector._metrics = Metrics()
+        self.connector._jid = 'a@x'
+        self.connector._actions = ActionQueue(rate=3600, burst=10, retries=1, backoff=0)
+        self.core = _Core()
+    
+    def test_transient(self):
+        transient = self.connector._transient
+        self.assertTrue(transient(tweepy.TweepError('Failed to send request: timed out')))
+        self.assertTrue(transient(AsyncError('connection reset')))
+        self.assertTrue(transient(tweepy.TweepError('x', _Response(503))))
+        self.assertTrue(transient(tweepy.TweepError('x', _Response(420))))
+        self.assertTrue(transient(tweepy.TweepError('x', _Response(429))))
+        self.assertFalse(transient(tweepy.TweepError('status code = 500', _Response(403))))
+    
+    def test_given_up_action_does_not_drop_the_next(self):
+        queue = self.connector._actions
+        queue.put('update', None, None, 'first')
+        queue.put('update', None, None, 'second')
+        error = tweepy.TweepError('Over capacity', _Response(503))
+        
+        self.connector._action_failed(queue.next(), self.core, error)
+        self.assertEqual(self.core.messages, [])
+        self.connector._action_failed(queue.next(), self.core, error)
+        self.assertEqual(self.core.messages, ['tw: Over capacity'])
+        self.assertEqual(queue.next().message, 'second')
+    
+    def test_permanent_error_gives_up_at_once(self):
+        queue = self.connector._actions
+        queue.put('update', None, None, 'first')
+        queue.put('update', None, None, 'second')
+        self.connector._action_failed(queue.next(), self.core,
+                                      tweepy.TweepError('Duplicate status', _Response(403)))
+        self.assertEqual(queue.next().message, 'second')
+
+    def test_search_room_actions_are_acknowledged_there(self):
+        queue = self.connector._actions
+        queue.put('update', None, None, 'first', room='#satori@satori.example.org')
+        self.connector._action_failed(queue.next(), self.core,
+                                      tweepy.TweepError('Duplicate status', _Response(403)))
+        self.assertEqual(self.core.messages, [('#satori@satori.example.org', 'tw: Duplicate status')])
+
+if __name__ == '__main__':
+    unittest.main()
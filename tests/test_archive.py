@@ -0,0 +1,172 @@
+# encoding: utf-8
+#
+#  test_archive.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import time
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from satori.archive import TimelineArchive, _RECORD, _STATUS, _DELIVERY
+from satori.status_cache import CachedStatus
+
+_NOW = datetime.datetime(2010, 10, 10, 10, 10, 10)
+_STAMP = 1286705410
+
+def _status(id_, created_at=_NOW):
+    return CachedStatus(id_, u'bob', u'Bob', u'tw| Bob', created_at, u'body {0} ♥'.format(id_))
+
+class TimelineArchiveTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='satori-archive-')
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def _segments(self, ext='.dat'):
+        return sorted([x for x in os.listdir(self.path) if x.endswith(ext)])
+    
+    def _open(self, **kwargs):
+        return TimelineArchive(self.path, 'tw', **kwargs)
+    
+    def test_record_format(self):
+        archive = self._open()
+        archive.append(7, [_status(42)])
+        archive.close()
+        
+        with open(os.path.join(self.path, self._segments()[0]), 'rb') as data:
+            buf = data.read()
+        payload = u'bob\0Bob\0body 42 ♥'.encode('utf-8')
+        self.assertEqual(_RECORD.unpack_from(buf, 0), (_STATUS, 42, _STAMP, 0, len(payload)))
+        self.assertEqual(buf[_RECORD.size:_RECORD.size + len(payload)], payload)
+        
+        (rtype, status_id, stamp, account, length) = _RECORD.unpack_from(buf, _RECORD.size + len(payload))
+        self.assertEqual((rtype, status_id, account, length), (_DELIVERY, 42, 7, 0))
+        self.assertTrue(abs(stamp - time.time()) < 5)
+        self.assertEqual(len(buf), 2 * _RECORD.size + len(payload))
+    
+    def test_status_is_stored_once_per_segment(self):
+        archive = self._open()
+        archive.append(1, [_status(42)])
+        archive.append(2, [_status(42)])
+        archive.close()
+        size = os.path.getsize(os.path.join(self.path, self._segments()[0]))
+        self.assertEqual(size, 3 * _RECORD.size + len(u'bob\0Bob\0body 42 ♥'.encode('utf-8')))
+    
+    def test_replay_and_since(self):
+        archive = self._open()
+        archive.append(1, [_status(1), _status(2), _status(3)])
+        archive.append(2, [_status(2)])
+        self.assertEqual([x.id for x in archive.replay(1)], [1, 2, 3])
+        self.assertEqual([x.id for x in archive.replay(1, limit=2)], [2, 3])
+        self.assertEqual([x.id for x in archive.replay(1, max_id=2)], [1, 2])
+        self.assertEqual([x.id for x in archive.replay(2)], [2])
+        
+        status = archive.replay(2)[0]
+        self.assertEqual((status.screen_name, status.tagged_name, status.created_at, status.body),
+                         (u'bob', u'tw| Bob', _NOW, u'body 2 ♥'))
+        
+        # since() goes by delivery time, not by created_at
+        old = _status(4, _NOW - datetime.timedelta(days=30))
+        stamp = int(time.time())
+        archive.append(1, [old])
+        self.assertTrue(4 in [x.id for x in archive.since(1, stamp)])
+        self.assertEqual(archive.since(1, stamp + 3600), [])
+        self.assertEqual(archive.since(3, 0), [])
+        archive.close()
+    
+    def test_rotation_and_reopen(self):
+        archive = self._open(segment_size=1)
+        for i in range(1, 4):
+            archive.append(1, [_status(i)])
+        archive.close()
+        self.assertEqual(len(self._segments()), 3)
+        self.assertEqual(len(self._segments('.idx')), 2)
+        
+        # the active segment gets sealed on reopen, sealed ones are loaded from their index
+        archive = self._open(segment_size=1)
+        self.assertEqual(len(self._segments('.idx')), 3)
+        self.assertEqual([x.id for x in archive.replay(1)], [1, 2, 3])
+        self.assertEqual([x.id for x in archive.since(1, 0)], [1, 2, 3])
+        archive.close()
+    
+    def test_outdated_index_is_rebuilt(self):
+        archive = self._open(segment_size=1)
+        archive.append(1, [_status(1)])
+        archive.append(1, [_status(2)])
+        archive.close()
+        
+        idx = os.path.join(self.path, self._segments('.idx')[0])
+        with open(idx, 'r+b') as data:
+            data.truncate(6)
+        archive = self._open()
+        self.assertEqual([x.id for x in archive.replay(1)], [1, 2])
+        archive.close()
+    
+    def test_retention_by_age(self):
+        archive = self._open(segment_size=1, retention=3600)
+        archive.append(1, [_status(1)])
+        archive.append(1, [_status(2)])
+        archive._segments[0].last_stamp -= 7200
+        archive.append(1, [_status(3)])
+        self.assertEqual([x.id for x in archive.replay(1)], [2, 3])
+        self.assertEqual(len(self._segments()), 2)
+        archive.close()
+    
+    def test_retention_by_size(self):
+        archive = self._open(segment_size=1, max_size=1)
+        for i in range(1, 5):
+            archive.append(1, [_status(i)])
+        # everything but the active segment is over the limit
+        self.assertEqual(len(self._segments()), 1)
+        self.assertEqual(len(self._segments('.idx')), 0)
+        self.assertEqual([x.id for x in archive.replay(1)], [4])
+        archive.close()
+    
+    def test_torn_tail_is_dropped(self):
+        archive = self._open()
+        archive.append(1, [_status(1), _status(2)])
+        archive.close()
+        
+        data = os.path.join(self.path, self._segments()[0])
+        size = os.path.getsize(data)
+        with open(data, 'ab') as tail:
+            tail.write(_RECORD.pack(_STATUS, 3, _STAMP, 0, 100) + 'cut')
+        
+        archive = self._open()
+        self.assertEqual(os.path.getsize(data), size)
+        self.assertEqual([x.id for x in archive.replay(1)], [1, 2])
+        archive.append(1, [_status(3)])
+        self.assertEqual([x.id for x in archive.replay(1)], [1, 2, 3])
+        archive.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# encoding: utf-8
+#
+#  test_async_engine.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import Queue
+import socket
+import threading
+import unittest
+
+from satori.async_engine import (AsyncEngine, AsyncError, Call, HttpRequest, Return,
+                                 _HttpConnection)
+from satori.worker_pool import WorkerPool
+
+class _Engine(object):
+    def __init__(self):
+        self.done = []
+    
+    def _request_done(self, connection, request, response, keep_alive):
+        self.done.append((request, response, keep_alive))
+
+class _Connection(_HttpConnection):
+    # a connection without a socket, fed by hand
+    def __init__(self):
+        self._engine = _Engine()
+        self.pool_key = ('localhost', 80, False)
+    
+    def close(self):
+        pass
+
+def _connection(method='GET'):
+    connection = _Connection()
+    connection.start(HttpRequest('localhost', 80, False, method, '/'))
+    return connection
+
+def _feed(connection, *parts):
+    for part in parts:
+        connection._in += part
+        response = connection._parse()
+        if response:
+            return response
+
+class HttpParserTest(unittest.TestCase):
+    
+    def test_content_length(self):
+        connection = _connection()
+        self.assertEqual(_feed(connection, 'HTTP/1.1 200 OK\r\nContent-', 'Length: 5\r\n\r\nab'), None)
+        response = _feed(connection, 'cde')
+        self.assertEqual((response.status, response.reason, response.body), (200, 'OK', 'abcde'))
+        self.assertEqual(response.getheader('Content-Length'), '5')
+    
+    def test_chunked(self):
+        connection = _connection()
+        head = 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+        self.assertEqual(_feed(connection, head, '3\r\nabc\r\n', 'a;ext=1\r\n0123'), None)
+        self.assertEqual(_feed(connection, '456789\r\n'), None)
+        response = _feed(connection, '0\r\n\r\n')
+        self.assertEqual(response.body, 'abc0123456789')
+    
+    def test_no_body(self):
+        self.assertEqual(_feed(_connection(), 'HTTP/1.1 304 Not Modified\r\n\r\n').body, '')
+        self.assertEqual(_feed(_connection('HEAD'), 'HTTP/1.1 200 OK\r\nContent-Length: 9\r\n\r\n').body, '')
+    
+    def test_keep_alive(self):
+        connection = _connection()
+        connection._complete(_feed(connection, 'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'))
+        self.assertEqual(connection._engine.done[0][2], True)
+        
+        connection = _connection()
+        connection._complete(_feed(connection, 'HTTP/1.1 200 OK\r\nConnection: close\r\n'
+                                               'Content-Length: 0\r\n\r\n'))
+        self.assertEqual(connection._engine.done[0][2], False)
+    
+    def test_body_until_close(self):
+        connection = _connection()
+        self.assertEqual(_feed(connection, 'HTTP/1.0 200 OK\r\n\r\nall of it'), None)
+        connection.handle_close()
+        (request, response, keep_alive) = connection._engine.done[0]
+        self.assertEqual((response.body, keep_alive), ('all of it', False))
+    
+    def test_early_close(self):
+        connection = _connection()
+        _feed(connection, 'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort')
+        connection.handle_close()
+        (request, response, keep_alive) = connection._engine.done[0]
+        self.assertTrue(isinstance(response, AsyncError))
+        self.assertEqual(keep_alive, False)
+
+class _Server(threading.Thread):
+    """Answers every request with `body`, counting the connections."""
+    
+    def __init__(self, body):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.body = body
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+    
+    def run(self):
+        while True:
+            (client, addr) = self.sock.accept()
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(client,)).start()
+    
+    def _serve(self, client):
+        data = ''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+            while '\r\n\r\n' in data:
+                (head, sep, data) = data.partition('\r\n\r\n')
+                client.sendall('HTTP/1.1 200 OK\r\nContent-Length: {0}\r\n\r\n{1}'.format(len(self.body),
+                                                                                       self.body))
+        client.close()
+
+class AsyncEngineTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.results = Queue.Queue()
+        self.pool = WorkerPool(1)
+        self.engine = AsyncEngine(lambda func, args: func(*args), offload=self.pool.submit)
+        self.engine.start()
+    
+    def tearDown(self):
+        self.engine.stop()
+    
+    def _run(self, gen):
+        self.engine.spawn('key', gen, self.results.put, self.results.put)
+        return self.results.get(timeout=10)
+    
+    def test_keep_alive_reuse(self):
+        server = _Server('pong')
+        server.start()
+        
+        def _coroutine():
+            bodies = []
+            for i in range(3):
+                response = yield HttpRequest('127.0.0.1', server.port, False, 'GET', '/ping')
+                bodies.append(response.body)
+            yield Return(bodies)
+        
+        self.assertEqual(self._run(_coroutine()), ['pong'] * 3)
+        self.assertEqual(server.connections, 1)
+    
+    def test_call_runs_on_a_worker(self):
+        def _coroutine():
+            thread = yield Call(lambda: threading.current_thread().name)
+            try:
+                yield Call(int, 'x')
+            except ValueError:
+                yield Return(thread)
+        
+        self.assertEqual(self._run(_coroutine()), 'satori-worker-0')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+# encoding: utf-8
+#
+#  test_book_keeper.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from satori.book_keeper import BookKeeper, _Session, CURSOR_HOME, CURSOR_DM
+
+class _Config(object):
+    def __init__(self, *tags):
+        self.services = [{'tag' : x, 'type' : 'twitter'} for x in tags]
+
+class BookKeeperCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='satori-bookkeeper-')
+        self.book_keeper = BookKeeper(os.path.join(self.path, 'bookkeeper.db'))
+        self.book_keeper.reflect_services(_Config('tw', 'id'))
+        self.book_keeper.user('bob@example.com', create=True)
+        self.book_keeper.account('bob@example.com', 'tw', create=True)
+    
+    def tearDown(self):
+        self.book_keeper.close()
+        # the scoped session would stay bound to this database
+        _Session.remove()
+        shutil.rmtree(self.path)
+    
+    def _lookup(self):
+        return self.book_keeper.account('bob@example.com', 'tw')
+    
+    def test_lookups_are_cached(self):
+        self._lookup()
+        misses = self.book_keeper.cache_stats()['misses']
+        self._lookup()
+        self.assertEqual(self.book_keeper.cache_stats()['misses'], misses)
+        self.assertEqual(self.book_keeper.cache_stats()['entries'], 1)
+    
+    def test_commit_invalidates(self):
+        account = self._lookup()[0]
+        account.auth_key = 'key'
+        self.book_keeper.commit(account)
+        self.assertEqual(self.book_keeper.cache_stats()['entries'], 0)
+        self.assertEqual(self._lookup()[0].auth_key, 'key')
+    
+    def test_remove_invalidates(self):
+        self.book_keeper.user('bob@example.com')
+        self.book_keeper.remove(self._lookup()[0])
+        self.assertEqual(self._lookup(), [])
+        self.assertEqual(self.book_keeper.user('bob@example.com')[0].accounts, [])
+    
+    def test_reflect_services_invalidates(self):
+        self._lookup()
+        # dropping the service removes its accounts, the cache must not keep them
+        self.book_keeper.reflect_services(_Config('id'))
+        self.assertEqual(self.book_keeper.cache_stats()['entries'], 0)
+        self.assertEqual(self._lookup(), [])
+    
+    def test_unrelated_entries_survive(self):
+        self.book_keeper.user('alice@example.com', create=True)
+        self.book_keeper.user('alice@example.com')
+        account = self._lookup()[0]
+        self.book_keeper.commit(account)
+        self.assertEqual(self.book_keeper.cache_stats()['entries'], 1)
+        self.book_keeper.user('alice@example.com')
+        self.assertEqual(self.book_keeper.cache_stats()['hits'], 1)
+
+class BookKeeperCursorTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='satori-bookkeeper-')
+        self.db = os.path.join(self.path, 'bookkeeper.db')
+        self.book_keeper = self._open(flush_interval=3600, flush_updates=3)
+    
+    def tearDown(self):
+        self.book_keeper.close()
+        _Session.remove()
+        shutil.rmtree(self.path)
+    
+    def _open(self, **kwargs):
+        book_keeper = BookKeeper(self.db, **kwargs)
+        book_keeper.reflect_services(_Config('tw'))
+        for jid in ['bob@example.com', 'alice@example.com']:
+            book_keeper.user(jid, create=True)
+            book_keeper.account(jid, 'tw', create=True)
+        return book_keeper
+    
+    def _account(self, jid='bob@example.com'):
+        return self.book_keeper.account(jid, 'tw')[0]
+    
+    def _stored(self, account, kind=CURSOR_HOME):
+        # what actually made it to disk
+        conn = sqlite3.connect(self.db)
+        try:
+            row = conn.execute('SELECT since_id FROM cursor WHERE user_id = ? AND service_id = ? AND kind = ?',
+                               (account.user_id, account.service_id, kind)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+    
+    def test_updates_are_coalesced(self):
+        account = self._account()
+        for since_id in [10, 20, 30]:
+            self.book_keeper.update_cursor(account, CURSOR_HOME, since_id)
+        self.assertEqual(self.book_keeper.cursor(account), 30)
+        self.assertEqual(self._stored(account), None)
+        
+        self.assertEqual(self.book_keeper.flush(), 1)
+        self.assertEqual(self._stored(account), 30)
+        self.assertEqual(self.book_keeper.flush(), 0)
+    
+    def test_flush_after_enough_updates(self):
+        (bob, alice) = (self._account(), self._account('alice@example.com'))
+        self.book_keeper.update_cursor(bob, CURSOR_HOME, 10)
+        self.book_keeper.update_cursor(bob, CURSOR_DM, 5)
+        self.assertEqual(self._stored(bob), None)
+        self.book_keeper.update_cursor(alice, CURSOR_HOME, 20)
+        self.assertEqual((self._stored(bob), self._stored(bob, CURSOR_DM), self._stored(alice)), (10, 5, 20))
+    
+    def test_newer_update_during_flush_wins(self):
+        account = self._account()
+        self.book_keeper.update_cursor(account, CURSOR_HOME, 10)
+        
+        call = self.book_keeper._writer.call
+        def _call(func, *args):
+            # a poll finishing while the transaction is running
+            self.book_keeper.update_cursor(account, CURSOR_HOME, 20)
+            self.assertEqual(self.book_keeper.cursor(account), 20)
+            return call(func, *args)
+        self.book_keeper._writer.call = _call
+        self.book_keeper.flush()
+        self.book_keeper._writer.call = call
+        
+        self.assertEqual(self._stored(account), 10)
+        self.assertEqual(self.book_keeper.cursor(account), 20)
+        self.book_keeper.flush()
+        self.assertEqual(self._stored(account), 20)
+    
+    def test_failed_flush_keeps_newer_updates(self):
+        account = self._account()
+        self.book_keeper.update_cursor(account, CURSOR_HOME, 10)
+        self.book_keeper.update_cursor(account, CURSOR_DM, 5)
+        
+        def _fail(func, *args):
+            self.book_keeper.update_cursor(account, CURSOR_HOME, 20)
+            raise SQLAlchemyError('database is locked')
+        call = self.book_keeper._writer.call
+        self.book_keeper._writer.call = _fail
+        self.assertEqual(self.book_keeper.flush(), 0)
+        self.book_keeper._writer.call = call
+        
+        self.assertEqual((self.book_keeper.cursor(account), self.book_keeper.cursor(account, CURSOR_DM)), (20, 5))
+        self.assertEqual(self.book_keeper.flush(), 2)
+        self.assertEqual((self._stored(account), self._stored(account, CURSOR_DM)), (20, 5))
+    
+    def test_migrate_legacy_database(self):
+        (bob, alice) = (self._account(), self._account('alice@example.com'))
+        self.book_keeper.close()
+        _Session.remove()
+        
+        # a database from before the cursor table, with a corrupt entry
+        conn = sqlite3.connect(self.db)
+        conn.execute('DROP TABLE cursor')
+        conn.execute("UPDATE account SET status = '100:200' WHERE user_id = ?", (bob.user_id,))
+        conn.execute("UPDATE account SET status = 'abc:50' WHERE user_id = ?", (alice.user_id,))
+        conn.commit()
+        conn.close()
+        
+        self.book_keeper = self._open()
+        # written by the new code already, newer than the legacy one
+        self.book_keeper.update_cursor(bob, CURSOR_HOME, 150)
+        self.assertEqual(self.book_keeper.migrate_cursors(), 2)
+        self.assertEqual((self._stored(bob), self._stored(bob, CURSOR_DM)), (150, 200))
+        self.assertEqual((self._stored(alice), self._stored(alice, CURSOR_DM)), (None, 50))
+        self.assertEqual([x.status for x in self.book_keeper.account()], ['', ''])
+        self.assertEqual(self.book_keeper.migrate_cursors(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
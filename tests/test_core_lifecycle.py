@@ -0,0 +1,142 @@
+# encoding: utf-8
+#
+#  test_core_lifecycle.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import datetime
+import unittest
+from xml.etree import cElementTree as ET
+
+from satori import sleekxmpp
+from satori.core import Core, PollScheduler, AdmissionQueue, CONNECTOR_ACTIVE, CONNECTOR_IDLE
+from satori.presence_store import PresenceStore
+from satori.room_history import RoomHistory
+
+JID = sleekxmpp.xmlstream.stanzabase.JID
+
+class _Config(object):
+    idle_poll_interval = 600
+
+class _XMPP(object):
+    def makePresence(self, pfrom=None, pto=None, pshow=None, ptype=None):
+        return {'from' : pfrom, 'to' : pto, 'type' : ptype}
+
+class _Event(dict):
+    xml = None
+
+class _Connector(object):
+    def __init__(self, store, jid):
+        self.key = (jid, 'tw-test')
+        self._store = store
+        self._jid = jid
+    
+    def release(self):
+        self._store.release(self._jid)
+
+class ResumeTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.store = PresenceStore.shared('tw-test')
+        self.sent = []
+        # only the parts the join / leave handling relies on
+        core = self.core = Core.__new__(Core)
+        core._config = _Config()
+        core._xmpp = _XMPP()
+        core._room_map = {}
+        core._history = {'bob@x' : RoomHistory()}
+        core._poll_scheduler = PollScheduler(interval=60, batch=100, jitter=0)
+        core._admission = AdmissionQueue(0)
+        core._send = lambda stanza, kind='message', mto=None: self.sent.append(stanza)
+        
+        core._update_room_map_with_jid(JID('bob@x/home'), JID('room@satori.x/bob'))
+        self.connector = _Connector(self.store, 'bob@x')
+        core._room_map['bob@x']['services'].append(self.connector)
+        core._room_map['bob@x']['resources'].add('bob@x/home')
+    
+    def tearDown(self):
+        PresenceStore._stores.pop('tw-test', None)
+    
+    def _presences(self, nick):
+        return [x for x in self.sent if x['from'] == 'room@satori.x/{0}'.format(nick)]
+    
+    def test_resume_keeps_occupants_polled_while_idle(self):
+        now = datetime.datetime.utcnow()
+        self.store.update('bob@x', 'alice', 'Alice', now)
+        
+        self.core._leave('bob@x', 'bob@x/home')
+        self.assertEqual(self.core._room_map['bob@x']['state'], CONNECTOR_IDLE)
+        self.assertEqual(self.store.occupants('bob@x'), [])
+        
+        # an idle poll refills the store without sending anything
+        self.store.update('bob@x', 'alice', 'Alice', now)
+        self.core._resume('bob@x', _Event({'from' : JID('bob@x/home'),
+                                           'to'   : JID('room@satori.x/bob')}))
+        
+        self.assertEqual(self.core._room_map['bob@x']['state'], CONNECTOR_ACTIVE)
+        self.assertEqual(self.store.occupants('bob@x'), [(u'tw-test| Alice', False)])
+        self.assertEqual(len(self._presences(u'tw-test| Alice')), 1)
+        self.assertEqual(self.core._poll_scheduler.due(now=9999999999), [self.connector])
+        
+        # the next poll sees a known occupant and announces nothing
+        self.assertEqual(self.store.update('bob@x', 'alice', 'Alice', now), [])
+
+class _AdminConfig(object):
+    admins = ['admin@x']
+
+class AdminCommandTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.sent = []
+        core = self.core = Core.__new__(Core)
+        core._config = _AdminConfig()
+        core._admin_commands = {'satori-test' : lambda: [('answer', 42)]}
+        core._send = lambda stanza, kind='message', mto=None: self.sent.append(ET.fromstring(stanza))
+    
+    def _execute(self, mfrom, node='satori-test'):
+        self.core._on_command(ET.fromstring(
+            "<iq type='set' id='c1' from='{0}/home' to='satori.x'>"
+            "<command xmlns='http://jabber.org/protocol/commands' node='{1}' action='execute'/>"
+            "</iq>".format(mfrom, node)))
+        return self.sent[-1] if self.sent else None
+    
+    def test_admin_gets_the_result(self):
+        iq = self._execute('admin@x')
+        self.assertEqual((iq.get('type'), iq.get('id'), iq.get('to')), ('result', 'c1', 'admin@x/home'))
+        command = iq.find('{http://jabber.org/protocol/commands}command')
+        self.assertEqual(command.get('status'), 'completed')
+        self.assertEqual(command.findtext('{jabber:x:data}x/{jabber:x:data}field/{jabber:x:data}value'), '42')
+    
+    def test_others_are_refused(self):
+        iq = self._execute('bob@x')
+        self.assertEqual(iq.get('type'), 'error')
+        self.assertTrue(iq.find('error/{urn:ietf:params:xml:ns:xmpp-stanzas}forbidden') is not None)
+    
+    def test_unknown_nodes_are_ignored(self):
+        self.assertEqual(self._execute('admin@x', 'other'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# encoding: utf-8
+#
+#  test_http_pool.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import socket
+import httplib
+import unittest
+
+from satori.http_pool import HttpPool
+
+class _Connection(object):
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+
+class HttpPoolTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.pool = HttpPool('api.example.com', False, size=2, idle_timeout=60, health_check=30)
+    
+    def _age(self, seconds):
+        self.pool._idle = [(last_used - seconds, conn) for (last_used, conn) in self.pool._idle]
+    
+    def test_reuse(self):
+        conn = _Connection()
+        self.pool.release(conn)
+        self.assertEqual(self.pool.acquire('api.example.com'), (conn, True))
+        self.assertEqual(self.pool.stats(), {'opened' : 0, 'reused' : 1, 'closed' : 0, 'idle' : 0})
+        
+        (fresh, reused) = self.pool.acquire('api.example.com')
+        self.assertTrue(isinstance(fresh, httplib.HTTPConnection))
+        self.assertFalse(reused)
+    
+    def test_size_limit(self):
+        conns = [_Connection() for i in range(3)]
+        for conn in conns:
+            self.pool.release(conn)
+        self.assertEqual([x.closed for x in conns], [False, False, True])
+        self.assertEqual(self.pool.stats()['idle'], 2)
+        self.assertEqual(self.pool.stats()['closed'], 1)
+    
+    def test_idle_timeout(self):
+        (old, new) = (_Connection(), _Connection())
+        self.pool.release(old)
+        self._age(120)
+        self.pool.release(new)
+        self.pool.prune()
+        self.assertTrue(old.closed)
+        self.assertFalse(new.closed)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        
+        # expired connections are not handed out either
+        self._age(120)
+        (conn, reused) = self.pool.acquire('api.example.com')
+        self.assertTrue(new.closed)
+        self.assertFalse(reused)
+    
+    def test_health_check(self):
+        (local, remote) = socket.socketpair()
+        try:
+            conn = _Connection(local)
+            self.pool.release(conn)
+            self._age(45)
+            self.assertEqual(self.pool.acquire('api.example.com'), (conn, True))
+            
+            # the server hung up (or sent garbage) while the socket was idle
+            remote.close()
+            self.pool.release(conn)
+            self._age(45)
+            (other, reused) = self.pool.acquire('api.example.com')
+            self.assertFalse(reused)
+            self.assertTrue(conn.closed)
+        finally:
+            local.close()
+    
+    def test_health_check_skipped_when_recent(self):
+        conn = _Connection()
+        self.pool.release(conn)
+        # no socket to probe, but it was used too recently to need it
+        self.assertEqual(self.pool.acquire('api.example.com'), (conn, True))
+    
+    def test_stats_all(self):
+        HttpPool.get('search.example.com', True)
+        try:
+            self.assertTrue('https://search.example.com' in HttpPool.stats_all())
+        finally:
+            del HttpPool._pools[('search.example.com', True)]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# encoding: utf-8
+#
+#  test_poll_scheduler.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import unittest
+
+from satori.core import PollScheduler
+
+class PollSchedulerTest(unittest.TestCase):
+    
+    def test_new_slots_are_spread_over_the_interval(self):
+        scheduler = PollScheduler(interval=60, batch=100, jitter=0)
+        now = time.time()
+        dues = [scheduler.schedule(x) for x in range(0, 50)]
+        self.assertTrue(all([now <= x <= now + 61 for x in dues]))
+        self.assertTrue(len(set([int(x) for x in dues])) > 1)
+    
+    def test_due_hands_out_each_slot_once(self):
+        scheduler = PollScheduler(interval=10, batch=100, jitter=0)
+        scheduler.schedule('a')
+        scheduler.schedule('b')
+        later = time.time() + 11
+        self.assertEqual(sorted(scheduler.due(later)), ['a', 'b'])
+        self.assertEqual(scheduler.due(later + 100), [])
+    
+    def test_reschedule_uses_interval_and_jitter(self):
+        scheduler = PollScheduler(interval=10, batch=100, jitter=0.1)
+        scheduler.schedule('a')
+        scheduler.due(time.time() + 11)
+        now = time.time()
+        due = scheduler.schedule('a', 100)
+        self.assertTrue(now + 89 <= due <= now + 111)
+        self.assertEqual(scheduler.due(now + 80), [])
+        self.assertEqual(scheduler.due(now + 120), ['a'])
+    
+    def test_reschedule_replaces_pending_slot(self):
+        scheduler = PollScheduler(interval=10, batch=100, jitter=0)
+        scheduler.schedule('a')
+        scheduler.schedule('a', 1000)
+        self.assertEqual(scheduler.due(time.time() + 20), [])
+        self.assertEqual(scheduler.due(time.time() + 1001), ['a'])
+    
+    def test_batch_limit(self):
+        scheduler = PollScheduler(interval=10, batch=3, jitter=0)
+        for x in range(0, 5):
+            scheduler.schedule(x)
+        later = time.time() + 11
+        self.assertEqual(len(scheduler.due(later)), 3)
+        self.assertEqual(len(scheduler.due(later)), 2)
+    
+    def test_removed_slots_are_skipped(self):
+        scheduler = PollScheduler(interval=10, batch=100, jitter=0)
+        scheduler.schedule('a')
+        scheduler.schedule('b')
+        scheduler.remove('a')
+        self.assertEqual(scheduler.due(time.time() + 11), ['b'])
+        self.assertEqual([x[0] for x in scheduler.stats()], ['b'])
+    
+    def test_lateness(self):
+        scheduler = PollScheduler(interval=10, batch=100, jitter=0)
+        due = scheduler.schedule('a')
+        self.assertEqual(scheduler.lateness(due - 1), 0.0)
+        self.assertAlmostEqual(scheduler.lateness(due + 5), 5.0, 3)
+        scheduler.due(due + 5)
+        # handed out slots are no longer pending
+        self.assertEqual(scheduler.lateness(due + 10), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
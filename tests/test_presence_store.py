@@ -0,0 +1,89 @@
+# encoding: utf-8
+#
+#  test_presence_store.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import datetime
+import unittest
+
+from satori.presence_store import PresenceStore
+
+_NOW = datetime.datetime(2010, 10, 10, 10, 10, 10)
+
+class PresenceStoreTest(unittest.TestCase):
+    
+    def test_new_occupant(self):
+        store = PresenceStore('tw')
+        self.assertEqual(store.update('a@x', 'bob', 'Bob', _NOW), [('a@x', u'tw| Bob', 'present')])
+        self.assertEqual(store.update('a@x', 'bob', 'Bob', _NOW), [])
+        self.assertEqual(store.stats(), {'authors' : 1, 'rooms' : 1, 'occupants' : 1})
+    
+    def test_away_and_back(self):
+        store = PresenceStore('tw')
+        store.update('a@x', 'bob', 'Bob', _NOW)
+        old = _NOW - datetime.timedelta(0, 600)
+        self.assertEqual(store.update('a@x', 'bob', 'Bob', old), [('a@x', u'tw| Bob', 'away')])
+        self.assertEqual(store.update('a@x', 'bob', 'Bob', _NOW), [('a@x', u'tw| Bob', 'present')])
+    
+    def test_rename_replaces_nick_in_every_room(self):
+        store = PresenceStore('tw')
+        store.update('a@x', 'bob', 'Bob', _NOW)
+        store.update('b@x', 'bob', 'Bob', _NOW)
+        store.update('c@x', 'eve', 'Eve', _NOW)
+        changes = store.update('a@x', 'bob', 'Robert', _NOW)
+        self.assertEqual(sorted(changes), [('a@x', u'tw| Bob', 'gone'),
+                                           ('a@x', u'tw| Robert', 'present'),
+                                           ('b@x', u'tw| Bob', 'gone'),
+                                           ('b@x', u'tw| Robert', 'present')])
+        self.assertEqual(store.occupants('b@x'), [(u'tw| Robert', False)])
+    
+    def test_room_cap_drops_longest_idle(self):
+        store = PresenceStore('tw', room_cap=2)
+        store.update('a@x', 'bob', 'Bob', _NOW)
+        store.update('a@x', 'eve', 'Eve', _NOW)
+        changes = store.update('a@x', 'amy', 'Amy', _NOW)
+        self.assertEqual(changes, [('a@x', u'tw| Bob', 'gone'), ('a@x', u'tw| Amy', 'present')])
+    
+    def test_release_and_expire(self):
+        store = PresenceStore('tw', ttl=10)
+        store.update('a@x', 'bob', 'Bob', _NOW)
+        store.update('b@x', 'bob', 'Bob', _NOW)
+        store.release('a@x')
+        self.assertEqual(store.stats(), {'authors' : 1, 'rooms' : 1, 'occupants' : 1})
+        self.assertEqual(store.expire('b@x', time.time() + 20), [u'tw| Bob'])
+        self.assertEqual(store.stats(), {'authors' : 0, 'rooms' : 1, 'occupants' : 0})
+    
+    def test_snapshot_restore(self):
+        store = PresenceStore('tw')
+        store.update('a@x', 'bob', 'Bob', _NOW)
+        restored = PresenceStore('tw')
+        restored.restore(store.snapshot())
+        self.assertEqual(restored.occupants('a@x'), [(u'tw| Bob', False)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# encoding: utf-8
+#
+#  test_room_history.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import datetime
+import unittest
+from xml.etree import cElementTree as ET
+
+from satori.room_history import HistoryRequest, RoomHistory
+
+_NOW = datetime.datetime(2010, 10, 10, 10, 10, 10)
+
+def _join(history=None):
+    return ET.fromstring('<presence xmlns="jabber:component:accept">'
+                         '<x xmlns="http://jabber.org/protocol/muc">{0}</x>'
+                         '</presence>'.format(history or ''))
+
+class HistoryRequestTest(unittest.TestCase):
+    
+    def test_no_history_element(self):
+        request = HistoryRequest.from_xml(_join())
+        self.assertEqual((request.max_stanzas, request.max_chars, request.seconds, request.since),
+                         (None, None, None, None))
+        self.assertTrue(request.wants_history)
+    
+    def test_limits(self):
+        request = HistoryRequest.from_xml(_join('<history maxstanzas="5" maxchars="100" '
+                                                'seconds="60" since="2010-10-10T10:00:00.123Z"/>'))
+        self.assertEqual((request.max_stanzas, request.max_chars, request.seconds),
+                         (5, 100, 60))
+        self.assertEqual(request.since, datetime.datetime(2010, 10, 10, 10, 0, 0))
+    
+    def test_invalid_attributes_are_ignored(self):
+        request = HistoryRequest.from_xml(_join('<history maxstanzas="many" since="yesterday"/>'))
+        self.assertEqual((request.max_stanzas, request.since), (None, None))
+    
+    def test_zero_disables_history(self):
+        self.assertFalse(HistoryRequest.from_xml(_join('<history maxstanzas="0"/>')).wants_history)
+        self.assertFalse(HistoryRequest.from_xml(_join('<history seconds="0"/>')).wants_history)
+
+class RoomHistoryTest(unittest.TestCase):
+    
+    def _history(self, count, **kwargs):
+        history = RoomHistory(**kwargs)
+        for i in range(0, count):
+            history.append(_NOW - datetime.timedelta(0, 60 * (count - i)), 'nick', 'body {0}'.format(i))
+        return history
+    
+    def test_bounded_by_stanzas(self):
+        history = self._history(10, max_stanzas=3)
+        self.assertEqual([x[2] for x in history.select(HistoryRequest())],
+                         ['body 7', 'body 8', 'body 9'])
+    
+    def test_bounded_by_chars(self):
+        history = self._history(10, max_chars=20)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.stats(), {'stanzas' : 3, 'chars' : 18})
+    
+    def test_select_limits(self):
+        history = self._history(10)
+        self.assertEqual(len(history.select(HistoryRequest(max_stanzas=4))), 4)
+        self.assertEqual(len(history.select(HistoryRequest(max_chars=13))), 2)
+        self.assertEqual(len(history.select(HistoryRequest(seconds=150), now=_NOW)), 2)
+        self.assertEqual(len(history.select(HistoryRequest(since=_NOW - datetime.timedelta(0, 180)))), 3)
+        self.assertEqual(history.select(HistoryRequest(max_stanzas=0)), [])
+    
+    def test_snapshot_roundtrip(self):
+        history = self._history(3)
+        restored = RoomHistory()
+        restored.restore(history.snapshot())
+        self.assertEqual(restored.select(HistoryRequest()), history.select(HistoryRequest()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# encoding: utf-8
+#
+#  test_search_feed.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import unittest
+
+from satori.search_feed import normalize_query, room_query
+
+class NormalizeQueryTest(unittest.TestCase):
+    
+    def test_terms_are_sorted_and_unique(self):
+        self.assertEqual(normalize_query(u'  XMPP satori  xmpp '), u'satori xmpp')
+    
+    def test_phrase_and_or_keep_their_order(self):
+        self.assertEqual(normalize_query(u'"Hello  World" satori'), u'"hello world" satori')
+        self.assertEqual(normalize_query(u'xmpp OR Satori'), u'xmpp OR satori')
+    
+    def test_empty(self):
+        self.assertEqual(normalize_query(u'   '), None)
+
+class RoomQueryTest(unittest.TestCase):
+    
+    def test_no_search_room(self):
+        self.assertEqual(room_query(None), None)
+        self.assertEqual(room_query(u'satori'), None)
+    
+    def test_hashtag(self):
+        self.assertEqual(room_query(u'#Satori'), u'#satori')
+    
+    def test_escaped_search(self):
+        self.assertEqual(room_query(u'search.Satori\\20xmpp'), u'satori xmpp')
+        self.assertEqual(room_query(u'search.from\\3ashirk'), u'from:shirk')
+        self.assertEqual(room_query(u'search.'), None)
+
+if __name__ == '__main__':
+    unittest.main()
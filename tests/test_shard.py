@@ -0,0 +1,131 @@
+# encoding: utf-8
+#
+#  test_shard.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+import unittest
+from xml.etree import cElementTree as ET
+
+import satori
+from satori.shard import HashRing, ShardRouter
+
+JID = satori.sleekxmpp.xmlstream.stanzabase.JID
+
+_JIDS = [u'user{0}@example.org'.format(i) for i in range(0, 1000)]
+
+class HashRingTest(unittest.TestCase):
+    
+    def test_stable(self):
+        ring = HashRing(4)
+        self.assertEqual([ring.shard(x) for x in _JIDS],
+                         [HashRing(4).shard(x) for x in _JIDS])
+        self.assertEqual(ring.shard(u'jöhn@example.org'), ring.shard(u'jöhn@example.org'.encode('utf-8')))
+    
+    def test_spread(self):
+        ring = HashRing(4)
+        counts = [0] * 4
+        for jid in _JIDS:
+            counts[ring.shard(jid)] += 1
+        self.assertTrue(min(counts) > 150, counts)
+    
+    def test_resize_moves_only_to_new_shard(self):
+        ring = HashRing(4)
+        before = dict([(x, ring.shard(x)) for x in _JIDS])
+        ring.resize(5)
+        self.assertEqual(ring.shards, 5)
+        moved = [x for x in _JIDS if before[x] != ring.shard(x)]
+        self.assertTrue(0 < len(moved) < 350, len(moved))
+        self.assertEqual(set([ring.shard(x) for x in moved]), set([4]))
+    
+    def test_shrink_keeps_remaining_owners(self):
+        ring = HashRing(5)
+        before = dict([(x, ring.shard(x)) for x in _JIDS])
+        ring.resize(4)
+        for jid in _JIDS:
+            if before[jid] != 4:
+                self.assertEqual(ring.shard(jid), before[jid])
+
+class _Presence(dict):
+    def __init__(self, mfrom, mto, ptype='available'):
+        dict.__init__(self, {'from' : JID(mfrom), 'to' : JID(mto), 'type' : ptype, 'body' : None})
+        self.xml = ET.Element('presence', {'from' : mfrom, 'to' : mto})
+
+class ShardRouterTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.router = ShardRouter.__new__(ShardRouter)
+        self.router._ring = HashRing(4)
+        self.router._joins = {}
+        self.router._lock = threading.Lock()
+        self.router._resize_lock = threading.Lock()
+        self.router._shards = dict([(x, None) for x in range(0, 4)])
+        self.router._start = lambda shard: self.router._shards.setdefault(shard, None)
+        self.router._stop = lambda shards: None
+        self.posted = []
+        self.router._post = lambda shard, msg: self.posted.append((shard, msg))
+    
+    def _join(self, mfrom, mto, ptype='available'):
+        self.router._route('changed_status', _Presence(mfrom, mto, ptype))
+        return self.posted[-1][0]
+    
+    def test_account_rooms_follow_the_user(self):
+        jid = u'user1@example.org'
+        self.assertEqual(self._join(jid + '/home', u'tw@mb.example.org/user1'), self.router._ring.shard(jid))
+    
+    def test_search_rooms_share_a_shard(self):
+        # different users, different spellings of the same query
+        shards = set([self._join(u'user{0}@example.org/home'.format(i),
+                                 u'search.satori\\20xmpp@mb.example.org/user{0}'.format(i))
+                      for i in range(0, 50)])
+        shards.add(self._join(u'user0@example.org/home', u'search.XMPP\\20satori@mb.example.org/user0'))
+        self.assertEqual(len(shards), 1)
+        self.assertEqual(len(self.router._joins), 1)
+        self.assertEqual(len(self.router._joins.values()[0]), 51)
+    
+    def test_leaving_one_room_keeps_the_others(self):
+        self._join(u'user1@example.org/home', u'tw@mb.example.org/user1')
+        self._join(u'user1@example.org/home', u'#satori@mb.example.org/user1')
+        self._join(u'user1@example.org/home', u'#satori@mb.example.org/user1', 'unavailable')
+        self.assertEqual(self.router._joins.keys(), [u'user1@example.org'])
+    
+    def test_resize_releases_searches(self):
+        queries = [u'#tag{0}'.format(i) for i in range(0, 50)]
+        for query in queries:
+            self._join(u'user1@example.org/home', u'{0}@mb.example.org/user1'.format(query))
+        del self.posted[:]
+        self.router.resize(5)
+        
+        released = [msg[1] for (shard, msg) in self.posted if msg[0] == 'release_search']
+        joined = [ET.fromstring(msg[2]['xml']).get('to') for (shard, msg) in self.posted if msg[0] == 'event']
+        self.assertTrue(released)
+        self.assertTrue(set(released) <= set(queries))
+        self.assertEqual(sorted([x.split('@')[0] for x in joined]), sorted(released))
+        self.assertFalse([msg for (shard, msg) in self.posted if msg[0] == 'release'])
+
+if __name__ == '__main__':
+    unittest.main()
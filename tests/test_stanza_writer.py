@@ -0,0 +1,118 @@
+# encoding: utf-8
+#
+#  test_stanza_writer.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import threading
+import unittest
+
+from satori.stanza_writer import StanzaWriter
+
+class StanzaWriterTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.sent = []
+        self.gate = threading.Event()
+        self.gate.set()
+    
+    def _send(self, data):
+        self.gate.wait()
+        self.sent.append(data)
+    
+    def _summarize(self, mto, count):
+        return u'<skipped to="{0}" count="{1}"/>'.format(mto, count)
+    
+    def test_batches(self):
+        writer = StanzaWriter(self._send, depth=10, batch=2)
+        for i in range(0, 5):
+            writer.put(u'<m{0}/>'.format(i))
+        writer.start()
+        writer.stop()
+        self.assertEqual(self.sent, [u'<m0/><m1/>', u'<m2/><m3/>', u'<m4/>'])
+        stats = writer.stats()
+        self.assertEqual((stats['depth'], stats['max_depth'], stats['written'], stats['writes'], stats['dropped']),
+                         (0, 5, 5, 3, 0))
+        self.assertTrue(stats['latency_max'] >= stats['latency_avg'] > 0)
+    
+    def test_drop_presence_drops_the_oldest_presence(self):
+        writer = StanzaWriter(self._send, depth=3, policy='drop_presence')
+        for stanza in [u'<p1/>', u'<p2/>']:
+            writer.put(stanza, 'presence')
+        writer.put(u'<m1/>')
+        writer.put(u'<m2/>')
+        writer.put(u'<m3/>')
+        self.assertEqual(writer.stats()['dropped'], 2)
+        self.assertEqual(writer.stats()['depth'], 3)
+        writer.start()
+        writer.stop()
+        self.assertEqual(u''.join(self.sent), u'<m1/><m2/><m3/>')
+    
+    def test_summarize(self):
+        writer = StanzaWriter(self._send, self._summarize, depth=2, policy='summarize')
+        writer.put(u'<m1/>', mto='bob@x')
+        writer.put(u'<m2/>', mto='bob@x')
+        writer.put(u'<m3/>', mto='bob@x')
+        writer.put(u'<m4/>', mto='bob@x')
+        writer.put(u'<m5/>', mto='alice@x')
+        self.assertEqual(writer.stats()['dropped'], 3)
+        self.assertEqual(writer.stats()['depth'], 2)
+        
+        writer.start()
+        writer.stop()
+        data = u''.join(self.sent)
+        self.assertTrue(data.startswith(u'<m1/><m2/>'))
+        self.assertTrue(u'<skipped to="bob@x" count="2"/>' in data)
+        self.assertTrue(u'<skipped to="alice@x" count="1"/>' in data)
+        self.assertEqual(writer.stats()['written'], 4)
+    
+    def test_block(self):
+        writer = StanzaWriter(self._send, depth=1, batch=1)
+        self.gate.clear()
+        writer.start()
+        writer.put(u'<m1/>')
+        while writer.stats()['depth']:
+            time.sleep(0.001)
+        # the writer is stuck in send(), one more fits into the queue
+        writer.put(u'<m2/>')
+        
+        blocked = threading.Thread(target=writer.put, args=(u'<m3/>',))
+        blocked.start()
+        blocked.join(0.05)
+        self.assertTrue(blocked.is_alive())
+        self.assertEqual(writer.stats()['depth'], 1)
+        
+        self.gate.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        writer.stop()
+        self.assertEqual(self.sent, [u'<m1/>', u'<m2/>', u'<m3/>'])
+        self.assertEqual(writer.stats()['dropped'], 0)
+        self.assertEqual(writer.stats()['max_depth'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
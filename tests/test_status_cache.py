@@ -0,0 +1,85 @@
+# encoding: utf-8
+#
+#  test_status_cache.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import datetime
+import unittest
+
+from satori.metrics import Metrics
+from satori.status_cache import CachedStatus, StatusCache
+from satori.twitter_connector import TwitterConnector
+
+_NOW = datetime.datetime(2010, 10, 10, 10, 10, 10)
+
+def _status(id_, screen_name='Bob'):
+    return CachedStatus(id_, screen_name, 'Bob', u'tw| Bob', _NOW, u'body')
+
+class StatusCacheTest(unittest.TestCase):
+    
+    def test_fetch_and_lookup(self):
+        cache = StatusCache(2)
+        self.assertEqual(cache.lookup(('tw', 1)), None)
+        status = _status(1)
+        self.assertTrue(cache.fetch(('tw', 1), lambda: status) is status)
+        self.assertTrue(cache.fetch(('tw', 1), lambda: _status(1)) is status)
+        self.assertTrue(cache.lookup(('tw', 1)) is status)
+        self.assertEqual(cache.lookup(('other', 1)), None)
+        self.assertEqual(cache.stats(), {'size' : 1, 'hits' : 1, 'misses' : 1, 'evictions' : 0})
+    
+    def test_lookup_does_not_count_or_refresh(self):
+        cache = StatusCache(2)
+        cache.fetch(('tw', 1), lambda: _status(1))
+        cache.fetch(('tw', 2), lambda: _status(2))
+        cache.lookup(('tw', 1))
+        cache.fetch(('tw', 3), lambda: _status(3))
+        self.assertEqual(cache.lookup(('tw', 1)), None)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+class KnownStatusTest(unittest.TestCase):
+    
+    def setUp(self):
+        # only the parts _known_status() relies on
+        self.connector = TwitterConnector.__new__(TwitterConnector)
+        self.connector._service_data = {'tag' : 'tw'}
+        self.connector._status_cache = StatusCache(10)
+        self.connector._metrics = Metrics()
+        self.connector._status_cache.fetch(('tw', 42), lambda: _status(42))
+    
+    def test_delivered_status(self):
+        self.assertTrue(self.connector._known_status('42', 'bob'))
+        self.assertTrue(self.connector._known_status(42, None))
+    
+    def test_unknown_or_mismatching(self):
+        self.assertFalse(self.connector._known_status('43', 'bob'))
+        self.assertFalse(self.connector._known_status('42', 'eve'))
+        self.assertFalse(self.connector._known_status('x', 'bob'))
+        counters = self.connector._metrics.snapshot()['counters']
+        self.assertEqual(counters['status_index.misses']['value'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
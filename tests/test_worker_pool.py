@@ -0,0 +1,96 @@
+# encoding: utf-8
+#
+#  test_worker_pool.py
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+import threading
+import unittest
+
+from satori.worker_pool import WorkerPool
+
+class WorkerPoolTest(unittest.TestCase):
+    
+    def _wait(self, pool, count, timeout=10):
+        # results are handed back through drain() like on the XMPP thread
+        deadline = time.time() + timeout
+        while count > 0 and time.time() < deadline:
+            count -= pool.drain()
+            time.sleep(0.001)
+        self.assertEqual(count, 0)
+    
+    def test_same_key_runs_in_order(self):
+        pool = WorkerPool(8, host_limit=8)
+        (order, running) = ([], [])
+        
+        def _job(i):
+            running.append(i)
+            self.assertEqual(len(running), 1)
+            time.sleep(0.001)
+            order.append(i)
+            running.remove(i)
+        
+        for i in range(0, 20):
+            pool.submit('bob@x', 'api.example.com', _job, (i,), callback=lambda res: None)
+        self._wait(pool, 20)
+        self.assertEqual(order, range(0, 20))
+        self.assertFalse(pool.busy('bob@x'))
+    
+    def test_host_limit(self):
+        pool = WorkerPool(8, host_limit=2)
+        lock = threading.Lock()
+        (running, peak) = ({}, {})
+        
+        def _job(host):
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peak[host] = max(peak.get(host, 0), running[host])
+            time.sleep(0.01)
+            with lock:
+                running[host] -= 1
+        
+        for i in range(0, 10):
+            pool.submit('user{0}@x'.format(i), 'api.example.com', _job, ('api',), callback=lambda res: None)
+        pool.submit('other@x', 'search.example.com', _job, ('search',), callback=lambda res: None)
+        self.assertTrue(pool.in_flight()['api.example.com'] <= 2)
+        self._wait(pool, 11)
+        self.assertEqual(peak, {'api' : 2, 'search' : 1})
+        self.assertEqual(pool.in_flight(), {'api.example.com' : 0, 'search.example.com' : 0})
+    
+    def test_errors_and_defer(self):
+        pool = WorkerPool(1)
+        results = []
+        pool.submit('bob@x', 'api.example.com', int, ('x',), errback=results.append)
+        self._wait(pool, 1)
+        self.assertTrue('ValueError' in results[0])
+        
+        pool.defer(results.append, ('deferred',))
+        self.assertEqual(pool.drain(), 1)
+        self.assertEqual(results[-1], 'deferred')
+
+if __name__ == '__main__':
+    unittest.main()